@@ -8,18 +8,40 @@ import cleanData
 import createDB
 import visualiseData
 import dataAnalysis
+import dataCache
+import dbConnection
+import config_template
+from instrumentation import runReport
+
+# Columns needed by both the visualisation and the analysis stages
+SHARED_COLUMNS = list(dict.fromkeys(visualiseData.VISUALISE_COLUMNS +
+                                    dataAnalysis.ANALYSIS_COLUMNS))
 
 
 def main():
-    # Create database, schema and load raw data
-    createDB.main()
-    # Clean the data and filter for years 2019 & 2020
-    cleanData.main()
-    # Visualize the data using folium heatmaps and cluster maps
-    visualiseData.main()
-    # Perform analysis and visualizations on the data
-    dataAnalysis.main()
+    try:
+        # Create database, schema and load raw data, skipped while the csv is
+        # unchanged since the last load
+        createDB.main()
+        # Clean the data unless the clean table already holds the current load,
+        # so the version stamp and the caches keyed on it survive repeated runs
+        cleanData.main(only_if_stale=True)
+        # Load the clean data once (from the on-disk cache if the clean table
+        # hasn't changed) and share it between the stages
+        with dbConnection.pooledConnection() as connection:
+            dataframe = dataCache.loadCleanData(connection, SHARED_COLUMNS,
+                                                config_template.BOROUGH,
+                                                config_template.START_DATE,
+                                                config_template.END_DATE)
+        # Visualize the data using folium heatmaps and cluster maps
+        visualiseData.main(dataframe=dataframe)
+        # Perform analysis and visualizations on the data
+        dataAnalysis.main(dataframe=dataframe)
+    finally:
+        # Close the pooled connections of this process before exiting
+        dbConnection.closePool()
 
 
 if __name__ == "__main__":
-    main()
+    with runReport('bdAnalytics'):
+        main()
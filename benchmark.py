@@ -0,0 +1,433 @@
+"""
+Filename : benchmark.py
+Author : Archit Joshi, Parth Sethia
+Description : Benchmark harness for the NYC Crash pipeline. Generates synthetic
+csv files with the exact NYC Open Data schema at configurable sizes, runs every
+pipeline stage against a separate benchmark database and records wall time,
+peak memory and rows/sec to a JSON results file that can be compared between
+commits.
+Language : python3
+
+Usage : python benchmark.py --rows 100000 1000000
+        python benchmark.py --compare bench_results/old.json bench_results/new.json
+        python benchmark.py --stream-memory --rows 500000 1500000
+"""
+import os
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+import subprocess
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import matplotlib
+
+# Charts are rendered off-screen so the benchmark never blocks on a window
+matplotlib.use('Agg')
+
+import config_template
+import createDB
+import cleanData
+import dbConnection
+import rollups
+import dataAnalysis
+import visualiseData
+import streamClean
+from dataAccess import loadCrashes
+from instrumentation import peakRSS, currentRSS, resetPeakRSS
+
+RESULTS_DIR = "bench_results"
+DATA_DIR = "bench_data"
+BENCH_DB_SUFFIX = "_bench"
+# Rows per chunk of the streaming memory check and the growth of peak RSS
+# between the smallest and the largest size it tolerates
+STREAM_CHUNK_SIZE = 50000
+STREAM_MEMORY_TOLERANCE = 0.2
+
+NYC_HEADER = [
+    'CRASH DATE', 'CRASH TIME', 'BOROUGH', 'ZIP CODE', 'LATITUDE', 'LONGITUDE',
+    'LOCATION', 'ON STREET NAME', 'CROSS STREET NAME', 'OFF STREET NAME',
+    'NUMBER OF PERSONS INJURED', 'NUMBER OF PERSONS KILLED',
+    'NUMBER OF PEDESTRIANS INJURED', 'NUMBER OF PEDESTRIANS KILLED',
+    'NUMBER OF CYCLIST INJURED', 'NUMBER OF CYCLIST KILLED',
+    'NUMBER OF MOTORIST INJURED', 'NUMBER OF MOTORIST KILLED',
+    'CONTRIBUTING FACTOR VEHICLE 1', 'CONTRIBUTING FACTOR VEHICLE 2',
+    'CONTRIBUTING FACTOR VEHICLE 3', 'CONTRIBUTING FACTOR VEHICLE 4',
+    'CONTRIBUTING FACTOR VEHICLE 5', 'COLLISION_ID',
+    'VEHICLE TYPE CODE 1', 'VEHICLE TYPE CODE 2', 'VEHICLE TYPE CODE 3',
+    'VEHICLE TYPE CODE 4', 'VEHICLE TYPE CODE 5',
+]
+
+# Borough centres (lat, lon), spread in degrees, first zip code and share of
+# crashes, roughly matching the real data
+BOROUGHS = {
+    'BROOKLYN': (40.650, -73.950, 0.045, 11201, 0.30),
+    'QUEENS': (40.715, -73.820, 0.060, 11354, 0.26),
+    'MANHATTAN': (40.770, -73.970, 0.030, 10001, 0.18),
+    'BRONX': (40.845, -73.880, 0.035, 10451, 0.17),
+    'STATEN ISLAND': (40.585, -74.140, 0.040, 10301, 0.09),
+}
+# Share of crashes by hour of the day, peaking at the evening rush hour
+HOUR_WEIGHTS = np.array([3, 2, 2, 1, 2, 2, 3, 4, 6, 5, 5, 5,
+                         6, 6, 7, 8, 8, 8, 7, 6, 5, 4, 4, 3], dtype=float)
+VEHICLES = ['Sedan', 'Station Wagon/Sport Utility Vehicle', 'Taxi', 'Bike',
+            'Pick-up Truck', 'Box Truck', 'Bus', 'Motorcycle', 'E-Bike', 'Van']
+FACTORS = ['Unspecified', 'Driver Inattention/Distraction',
+           'Failure to Yield Right-of-Way', 'Following Too Closely',
+           'Backing Unsafely', 'Passing Too Closely', 'Unsafe Speed']
+STREETS = ['ATLANTIC AVENUE', 'FLATBUSH AVENUE', 'BROADWAY', 'QUEENS BOULEVARD',
+           'GRAND CONCOURSE', 'OCEAN PARKWAY', '3 AVENUE', 'LINDEN BOULEVARD',
+           'NORTHERN BOULEVARD', 'HYLAN BOULEVARD', 'EASTERN PARKWAY']
+
+
+def syntheticChunk(rows, first_collision_id, generator):
+    """
+    Generate one chunk of synthetic crashes with the NYC csv layout.
+
+    :param rows: number of rows
+    :param first_collision_id: collision_id of the first row
+    :param generator: numpy random generator
+    :return: dataframe with NYC_HEADER columns
+    """
+    names = list(BOROUGHS)
+    shares = np.array([BOROUGHS[name][4] for name in names])
+    borough_index = generator.choice(len(names), size=rows, p=shares)
+    centres = np.array([BOROUGHS[name][:3] for name in names])
+    latitude = generator.normal(centres[borough_index, 0], centres[borough_index, 2])
+    longitude = generator.normal(centres[borough_index, 1], centres[borough_index, 2])
+    zip_code = np.array([BOROUGHS[name][3] for name in names])[borough_index] + \
+        generator.integers(0, 40, size=rows)
+
+    # More crashes in 2019 than in the 2020 lockdown months
+    days = pd.date_range('2019-01-01', '2020-12-31', freq='D')
+    day_weights = np.where((days.year == 2020) & (days.month.isin([4, 5])), 0.4, 1.0)
+    crash_date = days[generator.choice(len(days), size=rows,
+                                       p=day_weights / day_weights.sum())]
+    hour = generator.choice(24, size=rows, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    minute = generator.integers(0, 60, size=rows)
+
+    borough = np.array(names, dtype=object)[borough_index]
+    # Some crashes come without a borough or with missing/zero coordinates
+    borough[generator.random(rows) < 0.3] = ''
+    missing = generator.random(rows) < 0.02
+    zero = generator.random(rows) < 0.01
+    latitude = np.where(zero, 0.0, latitude).round(6).astype(object)
+    longitude = np.where(zero, 0.0, longitude).round(6).astype(object)
+    latitude[missing] = ''
+    longitude[missing] = ''
+
+    chunk = pd.DataFrame({
+        'CRASH DATE': crash_date.strftime('%m/%d/%Y'),
+        'CRASH TIME': [f"{h}:{m:02d}" for h, m in zip(hour, minute)],
+        'BOROUGH': borough,
+        'ZIP CODE': np.where(borough == '', '', zip_code.astype(str)),
+        'LATITUDE': latitude,
+        'LONGITUDE': longitude,
+        'LOCATION': [f"({lat}, {lon})" if lat != '' else ''
+                     for lat, lon in zip(latitude, longitude)],
+        'ON STREET NAME': generator.choice(STREETS, size=rows),
+        'CROSS STREET NAME': generator.choice(STREETS + [''], size=rows),
+        'OFF STREET NAME': '',
+        'COLLISION_ID': np.arange(first_collision_id, first_collision_id + rows),
+    })
+    for column in NYC_HEADER:
+        if column.startswith('NUMBER OF'):
+            rate = 0.3 if 'INJURED' in column else 0.002
+            chunk[column] = generator.poisson(rate, size=rows)
+    for number in range(1, 6):
+        # Fewer vehicles are involved the higher the vehicle number
+        present = generator.random(rows) < [1.0, 0.8, 0.1, 0.03, 0.01][number - 1]
+        chunk[f'CONTRIBUTING FACTOR VEHICLE {number}'] = np.where(
+            present, generator.choice(FACTORS, size=rows), '')
+        chunk[f'VEHICLE TYPE CODE {number}'] = np.where(
+            present, generator.choice(VEHICLES, size=rows), '')
+    return chunk[NYC_HEADER]
+
+
+def generateSyntheticCSV(path, rows, seed=720, chunk_size=500000):
+    """
+    Write a synthetic crash csv with the exact NYC schema in chunks.
+
+    :param path: path of the csv to write
+    :param rows: number of rows
+    :param seed: random seed, the same seed always produces the same file
+    :param chunk_size: number of rows generated at a time
+    :return: path of the csv
+    """
+    generator = np.random.default_rng(seed)
+    with open(path, 'w', newline='', encoding='utf-8') as csv_file:
+        written = 0
+        while written < rows:
+            size = min(chunk_size, rows - written)
+            syntheticChunk(size, written + 1, generator).to_csv(
+                csv_file, header=written == 0, index=False)
+            written += size
+    return path
+
+
+def megabytes(value):
+    """
+    Helper function to round a size in MB for the results file.
+
+    :param value: size in MB or None
+    :return: rounded size or None
+    """
+    return round(value, 2) if value is not None else None
+
+
+def pythonPeak(function, *args, **kwargs):
+    """
+    Run a stage again under tracemalloc and return the peak size of its
+    python allocations. Kept out of the timed run since tracing every
+    allocation slows the stage down.
+
+    :param function: stage function
+    :return: peak python heap in MB
+    """
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        _, python_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return python_peak / (1024 * 1024)
+
+
+def runStage(name, rows, function, *args, repeatable=False, **kwargs):
+    """
+    Run one pipeline stage and measure it. The timed run is untraced, its
+    RSS is reported as the growth over the RSS the stage started with, the
+    peak one against a peak reset at the start of the stage. Stages that only
+    read are run a second time to measure their python heap peak.
+
+    :param name: stage name
+    :param rows: number of rows the stage processes, for rows/sec
+    :param function: stage function
+    :param repeatable: whether the stage can run twice without side effects
+    :return: (measurement dictionary, return value of the stage) tuple
+    """
+    rss_before = currentRSS()
+    peak_reset = resetPeakRSS()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+    rss_after, rss_peak = currentRSS(), peakRSS()
+    measurement = {
+        'stage': name,
+        'rows': rows,
+        'wall_time_s': round(wall_time, 4),
+        'rows_per_s': round(rows / wall_time, 1) if wall_time else None,
+        'rss_delta_mb': megabytes(rss_after - rss_before)
+        if rss_before is not None else None,
+        'peak_rss_delta_mb': megabytes(max(rss_peak - rss_before, 0))
+        if peak_reset and rss_before is not None else None,
+        'python_peak_mb': megabytes(pythonPeak(function, *args, **kwargs))
+        if repeatable else None,
+    }
+    print(f"   {name:<40} {wall_time:8.2f}s")
+    return measurement, result
+
+
+def benchmarkSize(rows, data_dir):
+    """
+    Generate a synthetic csv of the given size and run every pipeline stage
+    on it against the benchmark database.
+
+    :param rows: number of synthetic rows
+    :param data_dir: directory holding the synthetic csv files
+    :return: list of stage measurements
+    """
+    path = os.path.join(data_dir, f"synthetic_{rows}.csv")
+    if not os.path.exists(path):
+        print(f"== Generating {rows} synthetic rows ==")
+        generateSyntheticCSV(path, rows)
+
+    print(f"== Benchmarking {rows} rows ==")
+    connection = dbConnection.connectDB()
+    with connection.cursor() as cursor:
+        # One table per statement, DuckDB doesn't take a list
+        for table in ('clean_nyc_crashes', 'nyc_crashes'):
+            cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+        connection.commit()
+
+    results = []
+
+    def stage(name, stage_rows, function, *args, repeatable=False, **kwargs):
+        measurement, result = runStage(name, stage_rows, function, *args,
+                                       repeatable=repeatable, **kwargs)
+        measurement['dataset_rows'] = rows
+        results.append(measurement)
+        return result
+
+    stage('createDB.createSchema', rows, createDB.createSchema, connection, path)
+    stage('createDB.loadData', rows, createDB.loadData, connection, path)
+    stage('cleanData.cleanData', rows, cleanData.cleanData, connection)
+    stage('rollups.refreshRollups', rows, rollups.refreshRollups, connection)
+
+    borough = config_template.BOROUGH
+    stage('dataAnalysis.top100ConsecutiveDaysWithMostAccidents', rows,
+          dataAnalysis.top100ConsecutiveDaysWithMostAccidents, connection, borough,
+          repeatable=True)
+    stage('dataAnalysis.dayWithMostAccidents', rows,
+          dataAnalysis.dayWithMostAccidents, connection, borough, repeatable=True)
+    stage('dataAnalysis.hourWithMostAccidents', rows,
+          dataAnalysis.hourWithMostAccidents, connection, borough, repeatable=True)
+    stage('dataAnalysis.twelveDaysWithMostAccidentsIn2020', rows,
+          dataAnalysis.twelveDaysWithMostAccidentsIn2020, connection, borough,
+          repeatable=True)
+
+    data = stage('dataAccess.loadCrashes', rows, loadCrashes, connection,
+                 visualiseData.VISUALISE_COLUMNS, borough,
+                 config_template.START_DATE, config_template.END_DATE,
+                 repeatable=True)
+    data_2019, data_2020 = visualiseData.separateData(data)
+    stage('visualiseData.generateHeatMap', len(data_2019),
+          visualiseData.generateHeatMap, data_2019, 'bench', repeatable=True)
+    stage('visualiseData.kMeansClustering', len(data_2019),
+          visualiseData.kMeansClustering, data_2019, 'bench', cache_dir=None)
+    dbConnection.releaseDB(connection)
+    return results
+
+
+def streamPeakRSS(path, output_dir, chunk_size):
+    """
+    Clean a csv into a Parquet dataset with streamClean and return the peak
+    RSS, runs in a fresh process per csv so peaks don't carry over.
+
+    :param path: path of the csv file
+    :param output_dir: directory of the dataset
+    :param chunk_size: number of rows per chunk
+    :return: peak RSS in MB
+    """
+    streamClean.streamToParquet(path, output_dir, chunk_size)
+    return peakRSS()
+
+
+def checkStreamMemory(sizes, data_dir, chunk_size=STREAM_CHUNK_SIZE,
+                      tolerance=STREAM_MEMORY_TOLERANCE):
+    """
+    Check that the streaming clean to Parquet runs in memory bounded by the
+    chunk size: at a fixed chunk size its peak RSS may not grow by more than
+    tolerance between the smallest and the largest csv.
+
+    :param sizes: synthetic dataset sizes
+    :param data_dir: directory holding the synthetic csv files
+    :param chunk_size: number of rows per chunk
+    :param tolerance: allowed relative growth of the peak RSS
+    :return: True if the peak stayed flat
+    """
+    peaks = {}
+    context = multiprocessing.get_context('spawn')
+    for rows in sorted(sizes):
+        path = os.path.join(data_dir, f"synthetic_{rows}.csv")
+        if not os.path.exists(path):
+            print(f"== Generating {rows} synthetic rows ==")
+            generateSyntheticCSV(path, rows)
+        with context.Pool(1) as pool:
+            peaks[rows] = pool.apply(streamPeakRSS, (
+                path, os.path.join(data_dir, f"parquet_{rows}"), chunk_size))
+        print(f"   {rows:>10} rows {peaks[rows]:>10.1f} MB peak RSS")
+    smallest, largest = peaks[min(peaks)], peaks[max(peaks)]
+    flat = largest <= smallest * (1 + tolerance)
+    print(f"== Peak RSS {'stays flat' if flat else 'grows'} with the rows at "
+          f"{chunk_size} rows per chunk ({(largest / smallest - 1) * 100:+.1f}%) ==")
+    return flat
+
+
+def gitCommit():
+    """
+    Commit the benchmark ran on, so results can be compared between commits.
+
+    :return: short commit hash or None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareResults(old_path, new_path):
+    """
+    Print the change in wall time and the peak RSS growth of every stage
+    between two results files.
+
+    :param old_path: results file of the baseline run
+    :param new_path: results file of the new run
+    :return: None
+    """
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    baseline = {(stage['dataset_rows'], stage['stage']): stage
+                for stage in old['stages']}
+    print(f"{'rows':>10} {'stage':<52} {'old s':>9} {'new s':>9} {'change':>8} "
+          f"{'old peak MB':>12} {'new peak MB':>12}")
+    for stage in new['stages']:
+        before = baseline.get((stage['dataset_rows'], stage['stage']))
+        if before is None:
+            continue
+        change = (stage['wall_time_s'] - before['wall_time_s']) / \
+            max(before['wall_time_s'], 1e-9) * 100
+        # Peak RSS is missing from older results and where it can't be reset
+        peaks = [f"{run['peak_rss_delta_mb']:>12.1f}"
+                 if run.get('peak_rss_delta_mb') is not None else f"{'-':>12}"
+                 for run in (before, stage)]
+        print(f"{stage['dataset_rows']:>10} {stage['stage']:<52} "
+              f"{before['wall_time_s']:>9.2f} {stage['wall_time_s']:>9.2f} "
+              f"{change:>+7.1f}% {peaks[0]} {peaks[1]}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the NYC crash pipeline")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000],
+                        help="synthetic dataset sizes, e.g. 100000 1000000 10000000")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two results files instead of running")
+    parser.add_argument('--stream-memory', action='store_true',
+                        help="only check that the peak memory of streamClean.py "
+                             "stays flat across the --rows sizes")
+    args = parser.parse_args()
+
+    if args.compare:
+        compareResults(*args.compare)
+        return
+    if args.stream_memory:
+        data_dir = os.path.abspath(DATA_DIR)
+        os.makedirs(data_dir, exist_ok=True)
+        if not checkStreamMemory(args.rows, data_dir):
+            raise SystemExit(1)
+        return
+
+    # Never touch the real database, and keep generated maps out of the repo
+    config_template.DB_NAME = config_template.DB_NAME + BENCH_DB_SUFFIX
+    dbConnection.ensureDatabase()
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.abspath(os.path.join(
+        RESULTS_DIR, f"{datetime.now():%Y%m%d_%H%M%S}.json"))
+    data_dir = os.path.abspath(DATA_DIR)
+    os.makedirs(data_dir, exist_ok=True)
+    os.chdir(data_dir)
+
+    stages = []
+    try:
+        for rows in args.rows:
+            stages.extend(benchmarkSize(rows, data_dir))
+    finally:
+        dbConnection.closePool()
+
+    report = {
+        'commit': gitCommit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'stages': stages,
+    }
+    with open(results_path, 'w') as results_file:
+        json.dump(report, results_file, indent=2)
+    print(f"== Results written to {results_path} ==")
+
+
+if __name__ == "__main__":
+    main()
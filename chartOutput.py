@@ -0,0 +1,96 @@
+"""
+Filename : chartOutput.py
+Author : Archit Joshi, Parth Sethia
+Description : Where finished matplotlib charts go. Interactively they are
+shown in a window, in headless mode they are rendered to memory and closed,
+and a background thread writes the rendered bytes to files in an output
+directory, so batch runs never block on a window or on disk. Rendering stays
+on the calling thread since matplotlib isn't thread-safe.
+Language : python3
+"""
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib
+import config_template
+
+if config_template.HEADLESS:
+    # Non-interactive backend, plt.show() would otherwise wait on a window
+    matplotlib.use('Agg')
+
+from matplotlib import pyplot as plt
+
+_writer = None
+_pending = []
+_lock = threading.Lock()
+
+
+def renderFigure(figure):
+    """
+    Render a figure in every configured format, runs on the calling thread.
+
+    :param figure: matplotlib figure
+    :return: dictionary of file extension to rendered bytes
+    """
+    rendered = {}
+    for extension in config_template.FIGURE_FORMATS:
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format=extension, bbox_inches='tight')
+        rendered[extension] = buffer.getvalue()
+    return rendered
+
+
+def writeFigure(rendered, name):
+    """
+    Write a rendered figure to the output directory, runs on the writer
+    thread.
+
+    :param rendered: dictionary returned by renderFigure
+    :param name: file name without extension
+    :return: list of written paths
+    """
+    os.makedirs(config_template.OUTPUT_DIR, exist_ok=True)
+    paths = []
+    for extension, data in rendered.items():
+        path = os.path.join(config_template.OUTPUT_DIR, f"{name}.{extension}")
+        with open(path, 'wb') as figure_file:
+            figure_file.write(data)
+        paths.append(path)
+    print(f"{', '.join(paths)} generated and saved successfully")
+    return paths
+
+
+def showFigure(name, figure=None):
+    """
+    Finish a chart. Shows it when running interactively, otherwise renders
+    it, closes it and queues the rendered bytes to be written to the output
+    directory.
+
+    :param name: file name of the chart without extension
+    :param figure: figure to finish, defaults to the current figure
+    :return: None
+    """
+    global _writer
+    if not config_template.HEADLESS:
+        plt.show()
+        return
+    figure = figure or plt.gcf()
+    rendered = renderFigure(figure)
+    plt.close(figure)
+    with _lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(max_workers=1)
+        _pending.append(_writer.submit(writeFigure, rendered, name))
+
+
+def flushFigures():
+    """
+    Wait until every queued chart has been written.
+
+    :return: list of written paths
+    """
+    with _lock:
+        pending = list(_pending)
+        _pending.clear()
+    return [path for future in pending for path in future.result()]
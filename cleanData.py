@@ -6,164 +6,291 @@ Language : python3
 """
 
 import os
+from datetime import date
 import psycopg2
 from psycopg2 import sql
 import pandas as pd
 import numpy as np
-import config_template
+import dbConnection
+import rollups
+import pipelineState
+import spatialIndex
+import duckdbBackend
+import queryCache
+from instrumentation import instrumented, annotate, runReport
 
 
-def connectDB():
-    """
-    Helper function to connect to a database db_720 to load NYC Crash data to.
-    If database doesn't exist, the function will create the database and
-    re-attempt to estabilish connection.
+# Cleaning rules as (rule name, condition under which a row is rejected). A
+# row is attributed to the first rule that rejects it. Conditions are written
+# to be null-safe so that every row is either kept or rejected by one rule.
+# All boroughs and years are kept, analysis functions filter by parameters.
+CLEANING_RULES = [
+    ('null_borough', "borough IS NULL"),
+    ('null_coordinates', "latitude IS NULL OR longitude IS NULL"),
+    ('zero_coordinates', "latitude = 0 OR longitude = 0"),
+    ('null_crash_date', "crash_date IS NULL"),
+]
+
 
-    :return: database connection object
+def rejectionCase():
     """
-    host = config_template.HOST
-    username = config_template.USERNAME
-    password = config_template.DB_PASSWORD
-    port = config_template.PORT
-    database = config_template.DB_NAME
+    Helper function to build a CASE expression naming the first cleaning rule
+    that rejects a row, NULL if the row is kept.
 
-    try:
-        # Attempt to connect to the existing database
-        conn = psycopg2.connect(database=database, user=username,
-                                password=password, host=host,
-                                port=port)
-        return conn
-    except psycopg2.Error as e:
-        print("Connection error, check credentials or run createDB.py")
+    :return: sql CASE expression
+    """
+    return sql.SQL("CASE {} END").format(sql.SQL(" ").join(
+        sql.SQL("WHEN {} THEN {}").format(sql.SQL(condition),
+                                          sql.Literal(rule))
+        for rule, condition in CLEANING_RULES))
 
 
-def filterBoroughs(connection, borough):
+def cleanTableFilter(borough=None, start_date=None, end_date=None):
     """
-    Helper function to clear data which doesnt have BROOKLYN as the chosen
-    borough for analysis. Removes entries with null as the boroughs as well.
+    Helper function to build the WHERE clause used by analysis queries on
+    clean_nyc_crashes. Filtering crash_date with literal bounds lets postgres
+    prune the monthly partitions it doesn't need.
 
-    :param connection: database connection object
-    :param borough: New york borough to analyse
-    :return: Success message if query worked
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash_date to include, unbounded if None
+    :param end_date: last crash_date to include, unbounded if None
+    :return: (where clause, query parameters) tuple
     """
-    # Filter data for only one borough - BROOKLYN and push to new table
-    delete_boroughs = f"""
-            CREATE TABLE clean_nyc_crashes AS
-            SELECT * FROM nyc_crashes WHERE borough = '{borough}'
-        """
-    try:
-        connection.cursor().execute(delete_boroughs)
-    except psycopg2.Error as e:
-        print(f"Error encountered : {e}")
-        return False
+    conditions = []
+    parameters = []
+    if borough is not None:
+        conditions.append("borough = %s")
+        parameters.append(borough)
+    if start_date is not None:
+        conditions.append("crash_date >= %s")
+        parameters.append(start_date)
+    if end_date is not None:
+        conditions.append("crash_date <= %s")
+        parameters.append(end_date)
+    where_clause = "where " + " and ".join(conditions) if conditions else ""
+    return where_clause, tuple(parameters)
 
-    # Delete entries with null as boroughs
-    delete_null_boroughs = "DELETE FROM clean_nyc_crashes WHERE borough is null"
-    try:
-        connection.cursor().execute(delete_null_boroughs)
-    except psycopg2.Error as e:
-        print(f"Error encountered while removing nulls :{e}")
-        return False
-    connection.commit()
-    connection.cursor().close()
-    return f"== Boroughs other than {borough} removed from data =="
 
-
-def filterTime(connection):
+def createMonthlyPartitions(connection, start_date, end_date):
     """
-    Function to filter data for June, July 2019 and 2020. All other data can be removed.
+    Create the monthly range partitions of clean_nyc_crashes covering the
+    given dates, skipping partitions that already exist. Doesn't commit.
 
     :param connection: database connection object
+    :param start_date: first date that needs a partition
+    :param end_date: last date that needs a partition
     :return: None
     """
+    with connection.cursor() as cursor:
+        month = date(start_date.year, start_date.month, 1)
+        while month <= end_date:
+            next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+            cursor.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS {} PARTITION OF clean_nyc_crashes
+                FOR VALUES FROM (%s) TO (%s)
+            """).format(sql.Identifier(f"clean_nyc_crashes_{month:%Y_%m}")),
+                           (month, next_month))
+            month = next_month
 
-    filter_dates = """
-    DELETE FROM clean_nyc_crashes
-    WHERE NOT 
-        ((crash_date BETWEEN '2019-01-01' AND '2019-12-31')
-        OR
-        (crash_date BETWEEN '2020-01-01' AND '2020-12-31'));
-"""
-    try:
-        connection.cursor().execute(filter_dates)
-    except psycopg2.Error as e:
-        print(f"Filtering for year 2020 failed: {e}")
-        return False
 
-    connection.commit()
-    connection.cursor().close()
+def createCleanTable(connection, source_table='nyc_crashes'):
+    """
+    Create clean_nyc_crashes range-partitioned by month on crash_date, with
+    partitions for every month present in the source table, a default
+    partition, indexes on (borough, crash_date) and on collision_id, which
+    the delete of cleanDelta looks rows up by in every partition, and the
+    indexed point column of spatialIndex. Doesn't commit.
 
-    return "== Records beyond 2019 and 2020 deleted. =="
+    :param connection: database connection object
+    :param source_table: table whose crash_date range needs partitions
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS clean_nyc_crashes (LIKE nyc_crashes)
+            PARTITION BY RANGE (crash_date)
+        """)
+        cursor.execute("CREATE TABLE IF NOT EXISTS clean_nyc_crashes_default "
+                       "PARTITION OF clean_nyc_crashes DEFAULT")
+        cursor.execute("CREATE INDEX IF NOT EXISTS clean_nyc_crashes_borough_date_idx "
+                       "ON clean_nyc_crashes (borough, crash_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS clean_nyc_crashes_collision_id_idx "
+                       "ON clean_nyc_crashes (collision_id)")
+        cursor.execute(sql.SQL("SELECT min(crash_date), max(crash_date) FROM {}")
+                       .format(sql.Identifier(source_table)))
+        start_date, end_date = cursor.fetchone()
+    spatialIndex.addSpatialColumn(connection)
+    if start_date is not None:
+        createMonthlyPartitions(connection, start_date, end_date)
 
 
-def filterLongitudeLatitude(connection):
+@instrumented
+def applyCleaningRules(connection):
     """
-    Helper function to filter data and remove null longitude and latitude values.
+    Clean the raw data in a single pass. Every rule is evaluated in one
+    sequential scan of nyc_crashes, rows passing all rules are routed into the
+    monthly partitions of clean_nyc_crashes and the number of rows rejected by
+    each rule is counted from the same scan. The embedded backend builds an
+    unpartitioned clean table instead.
 
     :param connection: database connection object
-    :return: None
+    :return: dictionary of rule name to number of rejected rows, 'kept' for
+    the number of clean rows
     """
-    remove_nulls = "DELETE FROM clean_nyc_crashes WHERE longitude is null or latitude is null"
+    clean_query = sql.SQL("""
+        WITH flagged AS MATERIALIZED (
+            SELECT crash, {} AS rejected_by FROM nyc_crashes AS crash
+        ), inserted AS (
+            INSERT INTO clean_nyc_crashes
+            SELECT (crash).* FROM flagged WHERE rejected_by IS NULL
+        )
+        SELECT coalesce(rejected_by, 'kept'), count(*)
+        FROM flagged GROUP BY rejected_by
+    """).format(rejectionCase())
     try:
-        connection.cursor().execute(remove_nulls)
+        if dbConnection.embedded():
+            report = duckdbBackend.applyCleaningRules(connection, rejectionCase())
+        else:
+            createCleanTable(connection)
+            with connection.cursor() as cursor:
+                cursor.execute(clean_query)
+                report = dict(cursor.fetchall())
+                connection.commit()
     except psycopg2.Error as e:
-        print(f"Error while removing nulls : {e}")
+        print(f"Error encountered while cleaning : {e}")
+        connection.rollback()
         return False
-    connection.commit()
-    connection.cursor().close()
-
-    remove_zeroes = "DELETE FROM clean_nyc_crashes WHERE cast(longitude as float) = 0 or cast(latitude as float) = 0"
-    try:
-        connection.cursor().execute(remove_zeroes)
-    except psycopg2.Error as e:
-        print(f"Error while removing nulls : {e}")
-        return False
-    connection.commit()
-    connection.cursor().close()
-
-    return "== Null latitude and longitude values removed. =="
+    # Every rule is evaluated in the same scan, their rejections are
+    # recorded per rule
+    annotate(rows_in=sum(report.values()), rows_out=report.get('kept', 0),
+             rejected_by_rule={rule: report.get(rule, 0)
+                               for rule, _ in CLEANING_RULES})
+    return report
 
 
+@instrumented
 def wipeOldTable(connection):
-    cursor = connection.cursor()
     table_name = 'clean_nyc_crashes'
-    cursor.execute(sql.SQL(
-        "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = %s)"),
-                   (table_name,))
-    table_exists = cursor.fetchone()[0]
+    with connection.cursor() as cursor:
+        cursor.execute(sql.SQL(
+            "SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = %s)"),
+                       (table_name,))
+        table_exists = cursor.fetchone()[0]
 
-    # If the table exists, drop it
+        # If the table exists, drop it
+        if table_exists:
+            # Rollup views built on the clean table are dropped with it
+            cursor.execute(
+                sql.SQL("DROP TABLE {} CASCADE").format(sql.Identifier(table_name)))
     if table_exists:
-        cursor.execute(
-            sql.SQL("DROP TABLE {}").format(sql.Identifier(table_name)))
         print(f"Table '{table_name}' has been deleted. New one will be created")
         connection.commit()
-        cursor.close()
     else:
         print(f"Table '{table_name}' does not exist. One will be created to store clean data")
 
 
-def cleanData(connection, borough):
+@instrumented
+def cleanDelta(connection, source_table):
+    """
+    Apply the same cleaning rules as cleanData to a delta of new or changed
+    rows instead of rebuilding clean_nyc_crashes. Rows of the delta that are
+    already in the clean table are replaced and the rollups of the crash dates
+    involved are recomputed. Doesn't commit, the caller commits together with
+    the raw data.
+
+    :param connection: database connection object
+    :param source_table: table holding the delta rows
+    :return: Success message if query worked
+    """
+    # Make sure months new in the delta have a partition
+    createCleanTable(connection, source_table)
+    source = sql.Identifier(source_table)
+    with connection.cursor() as cursor:
+        # Dates of the delta plus the old dates of the rows it replaces
+        cursor.execute(sql.SQL("CREATE TEMP TABLE delta_dates ON COMMIT DROP AS "
+                               "SELECT DISTINCT crash_date FROM {}").format(source))
+        cursor.execute(sql.SQL("""
+            WITH deleted AS (
+                DELETE FROM clean_nyc_crashes
+                WHERE collision_id IN (SELECT collision_id FROM {})
+                RETURNING crash_date
+            )
+            INSERT INTO delta_dates SELECT crash_date FROM deleted
+        """).format(source))
+        deleted = cursor.rowcount
+        cursor.execute(sql.SQL("""
+            INSERT INTO clean_nyc_crashes
+            SELECT * FROM {} AS crash WHERE {} IS NULL
+        """).format(source, rejectionCase()))
+        inserted = cursor.rowcount
+    # An empty delta leaves the table, and the caches keyed on its version, as is
+    if deleted > 0 or inserted > 0:
+        pipelineState.bumpCleanVersion(connection)
+        rollups.updateRollups(connection, 'delta_dates')
+    return f"== {inserted} clean rows merged into clean_nyc_crashes =="
+
+
+def cleanData(connection):
     """
     Wrapper function to call the other functions that clean the data.
     :param connection: database connection object
-    :param borough: borough to analyse data for
     :return: None
     """
     # Delete old table if it already exists
     wipeOldTable(connection)
 
-    # Clean data and push to new table
-    print(filterBoroughs(connection, borough))
-    print(filterLongitudeLatitude(connection))
-    print(filterTime(connection))
+    # Clean data and push to new table in a single pass
+    report = applyCleaningRules(connection)
+    if report is False:
+        return False
+    print(f"== Clean data stored, {report.pop('kept', 0)} rows kept ==")
+    for rule, _ in CLEANING_RULES:
+        print(f"   rejected by {rule} : {report.get(rule, 0)}")
+
+    # Stamp the rewritten table so caches built on the old one go stale, and
+    # remember which raw load it was cleaned from
+    pipelineState.createStateTable(connection)
+    pipelineState.bumpCleanVersion(connection)
+    pipelineState.setState(connection, 'clean_nyc_crashes.source',
+                           pipelineState.getState(connection, 'nyc_crashes.source'))
+    connection.commit()
+    queryCache.clear()
+
+    # Index the new table and rebuild the rollups the analysis queries read
+    rollups.createIndexes(connection)
+    rollups.createRollups(connection)
 
 
-def main():
-    conn = connectDB()
-    analyse_borough = "BROOKLYN"
-    cleanData(conn, analyse_borough)
+def cleanIsCurrent(connection):
+    """
+    Whether clean_nyc_crashes was cleaned from the current raw load, in which
+    case cleaning again would rebuild the same table under a new version and
+    make every cache keyed on the version miss.
+
+    :param connection: database connection object
+    :return: bool
+    """
+    pipelineState.createStateTable(connection)
+    raw_source = pipelineState.getState(connection, 'nyc_crashes.source')
+    return raw_source is not None and \
+        pipelineState.getState(connection, 'clean_nyc_crashes.source') == raw_source
+
+
+def main(only_if_stale=False):
+    """
+    Clean the raw data.
+
+    :param only_if_stale: skip cleaning when the clean table was already
+    cleaned from the current raw load
+    :return: None
+    """
+    with dbConnection.pooledConnection() as conn:
+        if only_if_stale and cleanIsCurrent(conn):
+            print("== Clean data is up to date with the raw load, cleaning skipped ==")
+            return
+        cleanData(conn)
 
 
 if __name__ == "__main__":
-    main()
+    with runReport('cleanData'):
+        main()
@@ -3,3 +3,45 @@ DB_NAME = "db_720"
 PORT = '5432'
 HOST = 'localhost'
 USERNAME = 'postgres'
+
+# Default analysis filters, clean_nyc_crashes holds every borough and year
+BOROUGH = 'BROOKLYN'
+START_DATE = '2019-01-01'
+END_DATE = '2020-12-31'
+
+# Number of worker processes/threads used to run independent stages
+WORKERS = 4
+
+# Headless mode writes charts to OUTPUT_DIR in FIGURE_FORMATS instead of
+# showing them, set it for unattended batch runs
+HEADLESS = False
+OUTPUT_DIR = 'output'
+FIGURE_FORMATS = ('png',)
+
+# Connection pool size per process and the statement timeout every pooled
+# connection carries
+POOL_MIN = 1
+POOL_MAX = 10
+STATEMENT_TIMEOUT = '30min'
+
+# 'postgres' or 'duckdb'. DuckDB runs embedded on a local file, DUCKDB_PATH
+# defaults to <DB_NAME>.duckdb
+BACKEND = 'postgres'
+DUCKDB_PATH = None
+
+# Instrumentation of the pipeline stages. Each run writes wall time, rows and
+# RSS growth per stage and the queries each stage ran to a JSON report in
+# REPORT_DIR. EXPLAIN_QUERIES adds the EXPLAIN (ANALYZE, BUFFERS) plan of
+# every read-only query (each is then run twice), TRACE_MEMORY the python heap
+# peak (slower) and PROFILE a cProfile dump of the main thread.
+INSTRUMENT = True
+REPORT_DIR = 'run_reports'
+EXPLAIN_QUERIES = False
+TRACE_MEMORY = False
+PROFILE = False
+
+# Results of the analysis queries are cached on disk per clean table version,
+# for QUERY_CACHE_TTL seconds and at most QUERY_CACHE_MAX_ENTRIES results
+QUERY_CACHE = True
+QUERY_CACHE_TTL = 24 * 60 * 60
+QUERY_CACHE_MAX_ENTRIES = 500
@@ -6,112 +6,259 @@ Data Set: https://data.cityofnewyork.us/Public-Safety/NYPD-Motor-Vehicle-Collisi
 Language : python3
 """
 import os
+import io
+import csv
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-import pandas as pd
 import numpy as np
 import config_template
+import dbConnection
+import duckdbBackend
+import pipelineState
+from instrumentation import instrumented, annotate, runReport
 
+CSV_FILENAME = "Motor_Vehicle_Collisions_-_Crashes_20231125.csv"
+CHUNK_SIZE = 100000
+LOAD_WORKERS = 4
 
-def databaseConnection():
+
+def csvPath():
     """
-    Helper function to connect to a database db_720 to load NYC Crash data to.
-    If database doesn't exist, the function will create the database and
-    re-attempt to establish connection.
+    Helper function to build the path of the raw crash data csv in the
+    current working directory.
 
-    :return: database connection object
+    :return: absolute path of the csv file
     """
-    host = config_template.HOST
-    username = config_template.USERNAME
-    password = config_template.DB_PASSWORD
-    port = config_template.PORT
-    database = config_template.DB_NAME
+    return os.path.join(os.getcwd(), CSV_FILENAME)
+
+
+def inferColumnType(column):
+    """
+    Infer the postgres datatype of a raw csv column from its header so that
+    later queries don't have to cast text at query time.
+
+    :param column: column name as it appears in the csv header
+    :return: postgres datatype for the column
+    """
+    if 'DATE' in column:
+        return 'date'
+    if 'TIME' in column:
+        return 'time'
+    if column in ('LATITUDE', 'LONGITUDE'):
+        return 'double precision'
+    if column.startswith('NUMBER OF'):
+        return 'smallint'
+    if column == 'COLLISION_ID':
+        return 'bigint'
+    return 'varchar'
+
+
+def csvHeader(path=None):
+    """
+    Helper function to read the header of the raw csv without parsing any
+    data rows.
+
+    :param path: path of the csv file, defaults to the csv in the working dir
+    :return: list of column names as they appear in the csv header
+    """
+    with open(path or csvPath(), newline='', encoding='utf-8') as csv_file:
+        return next(csv.reader(csv_file))
+
+
+def tableColumnName(column):
+    """
+    Helper function to name the table column of a raw csv column, e.g.
+    CRASH DATE becomes crash_date.
+
+    :param column: column name as it appears in the csv header
+    :return: table column name
+    """
+    return column.replace(' ', '_').lower()
 
-    try:
-        # Attempt to connect to the existing database
-        conn = psycopg2.connect(database=database, user=username,
-                                password=password, host=host,
-                                port=port)
-        return conn
-    except psycopg2.Error as e:
-        # If the database doesn't exist, create it
-        if 'database "db_720" does not exist' in str(e):
-            print("Provided database does not exist. Creating database db_720")
-            conn = psycopg2.connect(user=username, password=password,
-                                    host=host, port=port)
-            conn.autocommit = True
-            cursor = conn.cursor()
-            cursor.execute(f"CREATE DATABASE {database};")
-            cursor.close()
-            conn.close()
-
-            # Reconnect to the newly created database
-            conn = psycopg2.connect(database=database, user=username,
-                                    password=password, host=host,
-                                    port=port)
-            return conn
-        else:
-            print(f"Connection failed : {e}")
-
-
-def createSchema(conn):
-    """
-    Creates a POSTGRES database with attributes taken from column names from
-    csv and datatype as varchar for everything (can be sorted later). Reading
-    all this data into pandas dataframe is expensive.
+
+@instrumented
+def createSchema(conn, path=None):
+    """
+    Creates a POSTGRES table with attributes taken from column names from
+    csv. Datatypes are inferred from the header (date, time, double precision
+    lat/lon, smallint injury counts, bigint collision_id), everything else is
+    stored as varchar. Only the header is read from the csv.
 
     :param conn: database connection object
+    :param path: path of the csv file, defaults to the csv in the working dir
     :return: None
     """
-    path = os.getcwd() + "\\Motor_Vehicle_Collisions_-_Crashes_20231125.csv"
-    dataframe = pd.read_csv(path, nrows=0)
-
-    # Add '_' between column names and assign varchar datatype, set 'CRASH_DATE'
-    # to date type
+    # Add '_' between column names and assign the inferred datatype
     columns = [
-        (col.replace(' ', '_'),
-         'date' if 'DATE' in col else 'varchar')
-        for col in dataframe.columns
+        (tableColumnName(col), inferColumnType(col))
+        for col in csvHeader(path)
     ]
     # Create table with data
     try:
-        cursor = conn.cursor()
-        create_table = f"CREATE TABLE NYC_CRASHES ({', '.join([f'{col} {data_type}' for col, data_type in columns])});"
-        cursor.execute(create_table)
+        with conn.cursor() as cursor:
+            create_table = f"CREATE TABLE NYC_CRASHES ({', '.join([f'{col} {data_type}' for col, data_type in columns])});"
+            cursor.execute(create_table)
         conn.commit()
-        cursor.close()
     except psycopg2.Error as e:
         print(f"Table already exists. No action taken.\nError Message --> {e}")
+        conn.rollback()
         return False
     print("== Schema Created ==")
 
 
-def loadData(connection):
+def readChunks(path, chunk_size):
+    """
+    Generator to stream the csv from the client in fixed-size chunks. Each
+    chunk is re-serialised as csv text ready for COPY FROM STDIN.
+
+    :param path: path of the csv file
+    :param chunk_size: number of rows per chunk
+    :return: yields (number of rows, csv text buffer) tuples
     """
-    Function to load data from csv file into database.
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        reader = csv.reader(csv_file)
+        # Skip the header, the table columns are in the same order
+        next(reader, None)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        rows = 0
+        for record in reader:
+            writer.writerow(record)
+            rows += 1
+            if rows == chunk_size:
+                yield rows, buffer.getvalue()
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                rows = 0
+        if rows:
+            yield rows, buffer.getvalue()
+
+
+@instrumented
+def loadData(connection, path=None, workers=LOAD_WORKERS,
+             chunk_size=CHUNK_SIZE):
+    """
+    Function to load data from csv file into database. The csv is streamed
+    from the client in chunks and every chunk is sent with COPY FROM STDIN
+    over one of several parallel connections, the given one and workers - 1
+    borrowed ones, so the file doesn't need to sit on the database host.
+    Every connection commits its chunks once all chunks are sent. The load
+    isn't atomic, a failure while committing leaves the chunks of the
+    connections that already committed in nyc_crashes. main only stamps a
+    complete load, so its next run truncates the table and loads again.
+    The embedded backend reads the csv with DuckDB's own parallel reader.
 
     :param connection: database connection object
+    :param path: path of the csv file, defaults to the csv in the working dir
+    :param workers: number of parallel connections used for COPY
+    :param chunk_size: number of rows sent per COPY
     :return: None
     """
-    # Load data with all attributes
-    path = os.getcwd() + "\\Motor_Vehicle_Collisions_-_Crashes_20231125.csv"
-    copy_query = f" SET datestyle = 'ISO, MDY'; COPY nyc_crashes from \'{path}\' DELIMITER ',' CSV HEADER"
+    path = path or csvPath()
+    if dbConnection.embedded():
+        start = time.perf_counter()
+        try:
+            total_rows = duckdbBackend.loadData(connection, path)
+        except psycopg2.Error as e:
+            print(f"ERROR in loading data : {e}")
+            connection.rollback()
+            return False
+        annotate(rows_out=total_rows)
+        print(f"== Data loaded : {total_rows} rows in "
+              f"{time.perf_counter() - start:.1f}s ==")
+        return
+
+    copy_query = "COPY nyc_crashes FROM STDIN WITH (FORMAT csv)"
+    worker_connections = [connection]
+    while len(worker_connections) < workers:
+        worker_connection = dbConnection.connectDB()
+        if worker_connection is None:
+            print("ERROR in loading data : could not borrow a connection for "
+                  "every load worker")
+            for borrowed in worker_connections[1:]:
+                dbConnection.releaseDB(borrowed)
+            return False
+        worker_connections.append(worker_connection)
+    idle_connections = list(worker_connections)
+    local = threading.local()
+    lock = threading.Lock()
+
+    def copyChunk(chunk):
+        # Every thread keeps one connection and one transaction for the
+        # whole load
+        if not hasattr(local, 'connection'):
+            with lock:
+                local.connection = idle_connections.pop()
+            with local.connection.cursor() as cursor:
+                cursor.execute("SET LOCAL datestyle = 'ISO, MDY'")
+        with local.connection.cursor() as cursor:
+            cursor.copy_expert(copy_query, io.StringIO(chunk))
+
+    # Bound the number of chunks held in memory at once
+    in_flight = threading.BoundedSemaphore(workers * 2)
+    futures = []
+    total_rows = 0
+    start = time.perf_counter()
     try:
-        connection.cursor().execute(copy_query)
-        connection.commit()
-    except psycopg2.Error as e:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for rows, chunk in readChunks(path, chunk_size):
+                in_flight.acquire()
+                future = executor.submit(copyChunk, chunk)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append(future)
+                total_rows += rows
+            for future in futures:
+                future.result()
+        for worker_connection in worker_connections:
+            worker_connection.commit()
+    except (psycopg2.Error, OSError) as e:
         print(f"ERROR in loading data : {e}")
+        for worker_connection in worker_connections:
+            worker_connection.rollback()
         return False
+    finally:
+        # The given connection stays with the caller
+        for worker_connection in worker_connections[1:]:
+            dbConnection.releaseDB(worker_connection)
 
-    connection.cursor().close()
-    print("== Data loaded ==")
+    annotate(rows_out=total_rows)
+    elapsed = time.perf_counter() - start
+    print(f"== Data loaded : {total_rows} rows in {elapsed:.1f}s "
+          f"({total_rows / max(elapsed, 1e-9):,.0f} rows/sec) ==")
 
 
-def main():
-    connection = databaseConnection()
-    createSchema(connection)
-    loadData(connection)
-    connection.close()
+def main(force=False):
+    """
+    Create the schema and load the raw csv, unless the csv is unchanged
+    since the last load. The load is stamped with the signature of the csv
+    in pipeline_state.
+
+    :param force: reload even if the csv is unchanged
+    :return: True if the raw data was (re)loaded
+    """
+    dbConnection.ensureDatabase()
+    path = csvPath()
+    signature = pipelineState.fileSignature(path)
+    with dbConnection.pooledConnection() as connection:
+        pipelineState.createStateTable(connection)
+        if not force and \
+                pipelineState.getState(connection, 'nyc_crashes.source') == signature:
+            print("== Raw data unchanged since the last load, load skipped ==")
+            return False
+        if createSchema(connection, path) is False:
+            # Replace the rows of the previous load instead of appending
+            with connection.cursor() as cursor:
+                cursor.execute("TRUNCATE nyc_crashes")
+            connection.commit()
+        if loadData(connection, path) is False:
+            return False
+        pipelineState.setState(connection, 'nyc_crashes.source', signature)
+        connection.commit()
+    return True
 
 
 if __name__ == "__main__":
-    main()
+    with runReport('createDB'):
+        main()
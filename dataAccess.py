@@ -0,0 +1,166 @@
+"""
+Filename : dataAccess.py
+Author : Archit Joshi, Parth Sethia
+Description : Data access layer for the clean NYC Crash data. Every analysis
+declares the columns and date range it needs and only those columns are
+streamed from a server-side cursor in chunks and converted to compact dtypes.
+Analyses that only need counts per period group them in periodComparison
+instead.
+Language : python3
+"""
+import uuid
+import pandas as pd
+from pandas.api.types import union_categoricals
+from psycopg2 import sql
+import cleanData
+
+CHUNK_SIZE = 50000
+
+VEHICLE_COLUMNS = [f'vehicle_type_code_{number}' for number in range(1, 6)]
+FACTOR_COLUMNS = [f'contributing_factor_vehicle_{number}'
+                  for number in range(1, 6)]
+COUNT_COLUMNS = [f'number_of_{who}_{what}'
+                 for who in ('persons', 'pedestrians', 'cyclist', 'motorist')
+                 for what in ('injured', 'killed')]
+
+# dtypes the clean table columns are converted to once fetched
+COLUMN_DTYPES = {
+    'crash_date': 'datetime64[ns]',
+    'crash_time': 'timedelta64[ns]',
+    'borough': 'category',
+    'zip_code': 'category',
+    'latitude': 'float32',
+    'longitude': 'float32',
+    'location': 'object',
+    'on_street_name': 'category',
+    'cross_street_name': 'category',
+    'off_street_name': 'object',
+    'collision_id': 'int64',
+    **{column: 'Int16' for column in COUNT_COLUMNS},
+    **{column: 'category' for column in FACTOR_COLUMNS},
+    **{column: 'category' for column in VEHICLE_COLUMNS},
+}
+
+# Columns sent in a cheaper representation than their postgres type
+SELECT_EXPRESSIONS = {
+    'crash_time': "extract(epoch from crash_time)::int",
+}
+
+# Period keys counts can be grouped by, computed from crash_date/crash_time
+PERIOD_EXPRESSIONS = {
+    'year': "extract(year from crash_date)::int",
+    'month': "extract(month from crash_date)::int",
+    'hour': "extract(hour from crash_time)::int",
+}
+
+
+def selectList(columns):
+    """
+    Helper function to build the projection for the requested columns.
+
+    :param columns: list of clean table column names
+    :return: sql select list
+    """
+    unknown = set(columns) - set(COLUMN_DTYPES)
+    if unknown:
+        raise ValueError(f"Unknown clean_nyc_crashes columns : {sorted(unknown)}")
+    return sql.SQL(", ").join(
+        sql.SQL(f"{SELECT_EXPRESSIONS[column]} AS {{}}").format(sql.Identifier(column))
+        if column in SELECT_EXPRESSIONS else sql.Identifier(column)
+        for column in columns)
+
+
+def toFrame(rows, columns, dtypes=None):
+    """
+    Convert one chunk of fetched rows to a dataframe with compact dtypes.
+
+    :param rows: list of row tuples
+    :param columns: column names of the rows
+    :param dtypes: dtypes overriding COLUMN_DTYPES for some columns
+    :return: dataframe
+    """
+    dtypes = {**COLUMN_DTYPES, **(dtypes or {})}
+    frame = pd.DataFrame.from_records(rows, columns=columns)
+    for column in columns:
+        if column == 'crash_time':
+            frame[column] = pd.to_timedelta(frame[column], unit='s')
+        else:
+            frame[column] = frame[column].astype(dtypes[column])
+    return frame
+
+
+def concatChunks(chunks, columns, dtypes=None):
+    """
+    Concatenate dataframe chunks. Categorical columns are unioned so they stay
+    categorical instead of falling back to object strings.
+
+    :param chunks: list of dataframes
+    :param columns: column names
+    :param dtypes: dtypes overriding COLUMN_DTYPES for some columns
+    :return: dataframe
+    """
+    if not chunks:
+        return toFrame([], columns, dtypes)
+    dtypes = {**COLUMN_DTYPES, **(dtypes or {})}
+    categorical = [column for column in columns if dtypes[column] == 'category']
+    data = pd.concat([chunk.drop(columns=categorical) for chunk in chunks],
+                     ignore_index=True)
+    for column in categorical:
+        data[column] = union_categoricals([chunk[column] for chunk in chunks])
+    return data[columns]
+
+
+def loadCrashes(connection, columns, borough=None, start_date=None,
+                end_date=None, chunk_size=CHUNK_SIZE, dtypes=None):
+    """
+    Fetch only the requested columns of clean_nyc_crashes for a borough and
+    date range, ordered by crash_date. Rows are streamed through a named
+    server-side cursor in chunks, so only one chunk of raw python tuples is
+    held at a time.
+
+    :param connection: database connection object
+    :param columns: list of clean table column names the analysis needs
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
+    :param chunk_size: number of rows fetched per round trip
+    :param dtypes: dtypes overriding COLUMN_DTYPES for some columns
+    :return: dataframe with the requested columns
+    """
+    where_clause, parameters = cleanData.cleanTableFilter(borough, start_date,
+                                                          end_date)
+    # Ordered so that every period is a contiguous block of rows, the
+    # monthly partitions are appended in order
+    query = sql.SQL("SELECT {} FROM clean_nyc_crashes {} ORDER BY crash_date").format(
+        selectList(columns), sql.SQL(where_clause))
+
+    cursor = connection.cursor(name=f"crash_stream_{uuid.uuid4().hex}")
+    cursor.itersize = chunk_size
+    cursor.execute(query, parameters)
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunks.append(toFrame(rows, columns, dtypes))
+    cursor.close()
+    # Named cursors live inside a transaction, end it
+    connection.rollback()
+    return concatChunks(chunks, columns, dtypes)
+
+
+def periodKey(data, key):
+    """
+    Helper function computing one grouping key over a loaded dataframe.
+
+    :param data: dataframe returned by loadCrashes
+    :param key: period key or column name
+    :return: series named after the key
+    """
+    if key == 'year':
+        return data['crash_date'].dt.year.rename(key)
+    if key == 'month':
+        return data['crash_date'].dt.month.rename(key)
+    if key == 'hour':
+        return (data['crash_time'] // pd.Timedelta(hours=1)).rename(key)
+    return data[key]
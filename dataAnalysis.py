@@ -4,183 +4,200 @@ Author : Archit Joshi (aj6082), Parth Sethia
 Description : Analysis of the NYC crash dataset
 Language : python3
 """
-import warnings
+import calendar
 import config_template
 import psycopg2
-import pandas as pd
+import dbConnection
+from chartOutput import showFigure
 import matplotlib.patches as mpatches
 from matplotlib import pyplot as plt
-from visualiseData import separateData
+from cleanData import cleanTableFilter
+from windowAnalysis import denseDailySeries, topWindows
+from periodComparison import (Period, comparePeriods, comparePeriodsFrame,
+                              countColumn, rollUp)
+from scheduler import runStages, stage
+from instrumentation import instrumented, runReport
+from queryCache import cachedRows
 
+# Columns of clean_nyc_crashes the pandas analyses need
+ANALYSIS_COLUMNS = ['crash_date', 'crash_time', 'zip_code']
 
-def connectDB():
-    """
-    Helper function to connect to a database db_720 to load NYC Crash data to.
-    If database doesn't exist, the function will create the database and
-    re-attempt to estabilish connection.
+# Periods the charts compare
+SUMMER_PERIODS = [Period('2019', '2019-06-01', '2019-07-31'),
+                  Period('2020', '2020-06-01', '2020-07-31')]
 
-    :return: database connection object
-    """
-    host = config_template.HOST
-    username = config_template.USERNAME
-    password = config_template.DB_PASSWORD
-    port = config_template.PORT
-    database = config_template.DB_NAME
 
-    try:
-        # Attempt to connect to the existing database
-        conn = psycopg2.connect(database=database, user=username,
-                                password=password, host=host,
-                                port=port)
-        return conn
-    except psycopg2.Error as e:
-        print("Connection error, check credentials or run createDB.py")
+def withConnection(question, *args):
+    """
+    Run a question function on a pooled connection of its own, so questions can run
+    concurrently.
+    :param question: question function taking a connection first
+    :param args: remaining arguments of the question
+    :return: return value of the question
+    """
+    with dbConnection.pooledConnection() as connection:
+        return question(connection, *args)
 
 
-def dayWithMostAccidents(connection):
+@instrumented
+def dayWithMostAccidents(connection, borough=config_template.BOROUGH,
+                         start_date=config_template.START_DATE,
+                         end_date=config_template.END_DATE):
     """
     This function will find the day of the week which has most number of accidents
     :param connection: connection object
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
     """
-
-    # aggregation script to find the day which has maximum number of accidents
-    aggregation_script = "select trim(to_char(crash_date, 'Day')) as Day, " \
-                         "count(*) as count " \
-                         "from clean_nyc_crashes " \
+    where_clause, parameters = cleanTableFilter(borough, start_date, end_date)
+
+    # aggregation script to find the day which has maximum number of accidents,
+    # reads the pre-aggregated daily rollup
+    aggregation_script = "select extract(isodow from crash_date)::int as Day, " \
+                         "sum(crash_count) as count " \
+                         "from daily_crash_counts " \
+                         f"{where_clause} " \
                          "group by Day " \
                          "order by count desc"
     try:
-        connection_cursor = connection.cursor()
-        connection_cursor.execute(aggregation_script)
-        result = connection_cursor.fetchone()
+        result = cachedRows(connection, aggregation_script, parameters)[0]
     except psycopg2.Error as e:
         print(e)
         return False
-    connection.cursor().close()
     print("5. Which day of the week has the most accidents?")
-    print("Answer:", result[0])
+    print("Answer:", calendar.day_name[result[0] - 1])
     print()
 
 
-def hourWithMostAccidents(connection):
+@instrumented
+def hourWithMostAccidents(connection, borough=config_template.BOROUGH,
+                          start_date=config_template.START_DATE,
+                          end_date=config_template.END_DATE):
     """
     This function will find the hour of the day which has most accidents
     :param connection: connection object
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
     """
-
-    # aggregation script to find the hour of the day which has most number of accidents
-    aggregation_script = "select trim(split_part(crash_time, ':', 1)) as hour, " \
-                         "count(*) as count " \
-                         "from clean_nyc_crashes " \
-                         "group by hour " \
+    where_clause, parameters = cleanTableFilter(borough, start_date, end_date)
+
+    # aggregation script to find the hour of the day which has most number of accidents,
+    # reads the pre-aggregated hourly rollup
+    aggregation_script = "select crash_hour as hour, " \
+                         "sum(crash_count) as count " \
+                         "from hourly_crash_counts " \
+                         f"{where_clause} " \
+                         "group by crash_hour " \
                          "order by count desc;"
     try:
-        connection_cursor = connection.cursor()
-        connection_cursor.execute(aggregation_script)
-        result = connection_cursor.fetchone()
+        result = cachedRows(connection, aggregation_script, parameters)[0]
     except psycopg2.Error as e:
         print(e)
         return False
-    connection.cursor().close()
     print("6. Which hour of the day has the most accidents?")
     print("Answer:", result[0])
     print()
 
 
-def twelveDaysWithMostAccidentsIn2020(connection):
+@instrumented
+def twelveDaysWithMostAccidentsIn2020(connection, borough=config_template.BOROUGH,
+                                      year=2020, days=12):
     """
     This function will calculate top 12 days of 2020 which had most number of accidents
     :param connection: connection object
+    :param borough: borough to analyse, all boroughs if None
+    :param year: year to look at, only its monthly partitions are scanned
+    :param days: number of days to return
     :return:
     """
+    where_clause, parameters = cleanTableFilter(borough, f"{year}-01-01",
+                                                f"{year}-12-31")
 
     # aggregation script to calculate top 12 days of 2020 which had most number of accidents
-    aggregation_script = "select crash_date, count(*) as count from clean_nyc_crashes " \
-                         "where extract(year from crash_date) = '2020' " \
+    aggregation_script = "select crash_date, sum(crash_count) as count from daily_crash_counts " \
+                         f"{where_clause} " \
                          "group by crash_date " \
-                         "order by count desc limit 12;"
+                         "order by count desc limit %s;"
     try:
-        connection_cursor = connection.cursor()
-        connection_cursor.execute(aggregation_script)
-        result = connection_cursor.fetchall()
+        result = cachedRows(connection, aggregation_script,
+                            parameters + (days,))
     except psycopg2.Error as e:
         print(e)
         return False
-    connection.cursor().close()
     print(
         "7. In the year 2020, which 12 days had the most accidents?\nCan you speculate about why this is?")
     print("Ans: ",
           ", ".join(str(date_object) for date_object, number in result))
 
 
-def top100ConsecutiveDaysWithMostAccidents(connection):
+@instrumented
+def top100ConsecutiveDaysWithMostAccidents(connection,
+                                           borough=config_template.BOROUGH,
+                                           start_date='2019-01-01',
+                                           end_date='2020-10-31',
+                                           window=100, k=1):
     """
     This function will find top 100 consecutive days with most accidents
     :param connection: connection object
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
+    :param window: number of consecutive days in a window
+    :param k: number of non-overlapping windows to report
     """
+    where_clause, parameters = cleanTableFilter(borough, start_date, end_date)
 
     # aggregation script to count accidents on every day
     aggregation_script = "select crash_date, " \
-                         "count(*) as number_of_crash " \
-                         "from clean_nyc_crashes " \
-                         "where crash_date between '2019-01-01' and '2020-10-31' " \
+                         "sum(crash_count) as number_of_crash " \
+                         "from daily_crash_counts " \
+                         f"{where_clause} " \
                          "group by crash_date " \
                          "order by crash_date;"
 
     try:
-        connection_cursor = connection.cursor()
-        connection_cursor.execute(aggregation_script)
-        result = connection_cursor.fetchall()
+        result = cachedRows(connection, aggregation_script, parameters)
     except psycopg2.Error as e:
         print(e)
         return False
-    connection.cursor().close()
 
     print(
         "4. For the year of January 2019 to October of 2020, which 100 consecutive days had the most accidents?")
-    all_days = []
-    accidents_in_a_day = []
-    max_accidents = 0
-    start_index_for_max_accidents = None
-
-    # logic to find top 100 consecutive days with most accidents
-    for values in result:
-        all_days.append(str(values[0]))
-        accidents_in_a_day.append(values[1])
-
-    for index in range(0, 122):
-        total_accidents_in_current_range = sum(
-            accidents_in_a_day[index:index + 100])
-        if total_accidents_in_current_range > max_accidents:
-            max_accidents = total_accidents_in_current_range
-            start_index_for_max_accidents = index
-    print("Answer: The 100 consecutive days with most accidents start from",
-          all_days[start_index_for_max_accidents], "till",
-          all_days[start_index_for_max_accidents + 99])
+    # calendar-fill the daily counts so missing days aren't treated as
+    # adjacent, then rank every window with prefix sums
+    days, counts = denseDailySeries(result, start_date, end_date)
+    windows = topWindows(days, counts, window, k)
+    if not windows:
+        print(f"Answer: Fewer than {window} days between {start_date} and {end_date}")
+        print()
+        return False
+    for first_day, last_day, total in windows:
+        print(f"Answer: The {window} consecutive days with most accidents start from",
+              first_day, "till", last_day, f"({total} accidents)")
     print()
 
 
-def categorize_time_frame(hour):
+def timeFrameShares(time_frame_comparison, label):
     """
-    Function to categorize the time into time frames
-    :param hour: hour of the day based on 24 hrs clock
-    :return:
+    Helper function to turn the time frame counts of one period into shares.
+    :param time_frame_comparison: period comparison on the time_frame dimension
+    :param label: label of the period
+    :return: dataframe of time frame, accident count and percentage
     """
-    if 0 <= hour <= 5:
-        return 'Night'
-    elif 6 <= hour <= 11:
-        return 'Morning'
-    elif 12 <= hour <= 17:
-        return 'Afternoon'
-    elif 18 <= hour <= 24:
-        return 'Evening'
+    result = time_frame_comparison[['time_frame', countColumn(label)]].rename(
+        columns={countColumn(label): 'accident_count'})
+    result['percentage'] = (result['accident_count'] * 100.0 /
+                            result['accident_count'].sum()).round(1)
+    return result.sort_values(by='percentage', ascending=False)
 
 
-def dataChangeByTimeFrameFromTwoYears(crash_data_2019, crash_data_2020):
+@instrumented
+def dataChangeByTimeFrameFromTwoYears(time_frame_comparison):
     """
     This function will find out what changed in two years based on time and will create a pie chart
-    :param crash_data_2019: crash data from year 2019
-    :param crash_data_2020: crash data from year 2020
+    :param time_frame_comparison: summer 2019 vs 2020 comparison on time_frame
     """
     # Create legend
     legend_patches = [
@@ -190,35 +207,9 @@ def dataChangeByTimeFrameFromTwoYears(crash_data_2019, crash_data_2020):
         mpatches.Patch(color='red', label='Night --> 00:00 to 05:59')
     ]
 
-    # converting the varchar data format to datetime
-    crash_data_2019['crash_time'] = pd.to_datetime(
-        crash_data_2019['crash_time'])
-
-    # getting the hour from the crash time
-    crash_data_2019['time_frame'] = crash_data_2019[
-        'crash_time'].dt.hour.apply(categorize_time_frame)
-
-    # performing aggregation and getting percentage of crash in each time frame
-    result2019 = crash_data_2019.groupby('time_frame').agg(
-        accident_count=('crash_time', 'count'),
-        percentage=('crash_time',
-                    lambda x: round(len(x) * 100.0 / len(crash_data_2019), 1))
-    ).reset_index()
-
-    result2019 = result2019.sort_values(by='percentage', ascending=False)
-
-    # 2020 data
-    crash_data_2020['crash_time'] = pd.to_datetime(
-        crash_data_2020['crash_time'])
-    crash_data_2020['time_frame'] = crash_data_2020[
-        'crash_time'].dt.hour.apply(categorize_time_frame)
-    result2020 = crash_data_2020.groupby('time_frame').agg(
-        accident_count=('crash_time', 'count'),
-        percentage=('crash_time',
-                    lambda x: round(len(x) * 100.0 / len(crash_data_2020), 1))
-    ).reset_index()
-
-    result2020 = result2020.sort_values(by='percentage', ascending=False)
+    # percentage of crashes in each time frame
+    result2019 = timeFrameShares(time_frame_comparison, '2019')
+    result2020 = timeFrameShares(time_frame_comparison, '2020')
 
     # Generating pie charts
     fig, axs = plt.subplots(1, 2, figsize=(16, 8))
@@ -236,26 +227,43 @@ def dataChangeByTimeFrameFromTwoYears(crash_data_2019, crash_data_2020):
     plt.legend(handles=legend_patches, title="Time Blocks", loc="upper left",
                bbox_to_anchor=(0, 1), bbox_transform=plt.gcf().transFigure)
 
-    plt.show()
+    showFigure('time_frames_summer_2019_vs_2020')
 
 
-def dataChangeByZipcodeFromTwoYears(crash_data_2019, crash_data_2020):
+@instrumented
+def compareSummers(dimensions, borough=config_template.BOROUGH,
+                   dataframe=None):
+    """
+    Compare summer 2019 with summer 2020 on the given dimensions, in postgres
+    unless the clean data is already loaded.
+    :param dimensions: list of periodComparison dimension names
+    :param borough: borough to analyse, all boroughs if None
+    :param dataframe: already loaded clean data holding ANALYSIS_COLUMNS
+    :return: comparison dataframe with count_2019, count_2020, delta_2020 and
+    pct_change_2020 columns
+    """
+    if dataframe is not None:
+        return comparePeriodsFrame(dataframe, SUMMER_PERIODS, dimensions)
+    with dbConnection.pooledConnection() as conn:
+        return comparePeriods(conn, SUMMER_PERIODS, dimensions, borough)
+
+
+@instrumented
+def dataChangeByZipcodeFromTwoYears(zip_comparison):
     """
     This function will find out what changed in two years based on region
-    :param crash_data_2019: crash data from year 2019
-    :param crash_data_2020: crash data from year 2020
+    :param zip_comparison: summer 2019 vs 2020 comparison on zip_code x month
     :return:
     """
-    crash_data_2019['year'] = crash_data_2019['crash_date'].dt.year
-    crash_data_2020['year'] = crash_data_2020['crash_date'].dt.year
-
-    region_accidents_count_2019 = crash_data_2019.groupby(
-        ['zip_code', 'year']).size().reset_index(name='count')
-    region_accidents_count_2020 = crash_data_2020.groupby(
-        ['zip_code', 'year']).size().reset_index(name='count')
+    by_zip = rollUp(zip_comparison, ['zip_code'])
+    region_accidents_count = {
+        label: by_zip.loc[by_zip[countColumn(label)] > 0,
+                          ['zip_code', countColumn(label)]]
+        .rename(columns={countColumn(label): 'count'})
+        for label in ('2019', '2020')}
 
-    plot_time_series_for_accidents(region_accidents_count_2019,
-                                   region_accidents_count_2020)
+    plot_time_series_for_accidents(region_accidents_count['2019'],
+                                   region_accidents_count['2020'])
 
 
 def plot_time_series_for_accidents(region_accidents_count_2019,
@@ -279,17 +287,21 @@ def plot_time_series_for_accidents(region_accidents_count_2019,
     plt.xticks(rotation=90)
     plt.legend()
     plt.grid(True)
-    plt.show()
+    showFigure('accidents_by_zipcode_summer_2019_vs_2020')
 
 
-def dataDifferenceBetweenYearsForGivenMonths(data_2019, data_2020, month):
-    accidents_2019 = data_2019.groupby('zip_code').size().reset_index(
-        name='accident_count_2019')
-    accidents_2020 = data_2020.groupby('zip_code').size().reset_index(
-        name='accident_count_2020')
-
-    merged_data = pd.merge(accidents_2019, accidents_2020, on='zip_code',
-                           how='outer').fillna(0)
+@instrumented
+def dataDifferenceBetweenYearsForGivenMonths(zip_comparison, month):
+    """
+    This function will compare the accidents of a month in 2019 and 2020 by zip code
+    :param zip_comparison: summer 2019 vs 2020 comparison on zip_code x month
+    :param month: name of the month to compare
+    """
+    selected = zip_comparison[zip_comparison['month'] ==
+                              list(calendar.month_name).index(month)]
+    merged_data = rollUp(selected, ['zip_code']).rename(columns={
+        countColumn('2019'): 'accident_count_2019',
+        countColumn('2020'): 'accident_count_2020'})
 
     # Create a bar chart
     bar_width = 0.35  # Width of each bar
@@ -310,50 +322,47 @@ def dataDifferenceBetweenYearsForGivenMonths(data_2019, data_2020, month):
     plt.legend()
     plt.grid(axis='y')
 
-    plt.show()
+    showFigure(f'accidents_by_zipcode_{month.lower()}_2019_vs_2020')
 
 
-def main():
+def main(borough=config_template.BOROUGH, start_date=config_template.START_DATE,
+         end_date=config_template.END_DATE, dataframe=None):
     """
     This is the main function
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
+    :param dataframe: already loaded clean data holding ANALYSIS_COLUMNS, the
+    comparisons are grouped in postgres if None
     """
-    conn = connectDB()
-    warnings.filterwarnings("ignore",
-                            message="pandas only supports SQLAlchemy connectable.*")
-    dataframe = pd.read_sql("SELECT * FROM clean_nyc_crashes", conn)
-
-    crash_data_2019, crash_data_2020 = separateData(dataframe)
-
-    summer_2019 = crash_data_2019[
-        crash_data_2019['crash_date'].dt.month.isin([6, 7])].copy()
-    summer_2020 = crash_data_2020[
-        crash_data_2020['crash_date'].dt.month.isin([6, 7])].copy()
-
-    june_2019 = crash_data_2019[
-        crash_data_2019['crash_date'].dt.month.isin([6])].copy()
-    june_2020 = crash_data_2020[
-        crash_data_2020['crash_date'].dt.month.isin([6])].copy()
-
-    july_2019 = crash_data_2019[
-        crash_data_2019['crash_date'].dt.month.isin([7])].copy()
-    july_2020 = crash_data_2020[
-        crash_data_2020['crash_date'].dt.month.isin([7])].copy()
-
-    dataDifferenceBetweenYearsForGivenMonths(june_2019, june_2020, 'June')
-    dataDifferenceBetweenYearsForGivenMonths(july_2019, july_2020, 'July')
-
-    dataChangeByZipcodeFromTwoYears(summer_2019, summer_2020)
-
-    dataChangeByTimeFrameFromTwoYears(summer_2019, summer_2020)
-
-    top100ConsecutiveDaysWithMostAccidents(conn)
-
-    dayWithMostAccidents(conn)
-
-    hourWithMostAccidents(conn)
-
-    twelveDaysWithMostAccidentsIn2020(conn)
+    # One grouped pass per dimension set, every zip code chart is derived
+    # from the zip_code x month comparison
+    zip_comparison = compareSummers(['zip_code', 'month'], borough, dataframe)
+    time_frame_comparison = compareSummers(['time_frame'], borough, dataframe)
+
+    # Charts run on the small comparison frames, in worker processes when
+    # headless and on this thread when they open a window, the SQL questions
+    # in threads with a connection each, all of them concurrently
+    runStages([
+        stage('june_by_zipcode', dataDifferenceBetweenYearsForGivenMonths,
+              zip_comparison, 'June'),
+        stage('july_by_zipcode', dataDifferenceBetweenYearsForGivenMonths,
+              zip_comparison, 'July'),
+        stage('summer_by_zipcode', dataChangeByZipcodeFromTwoYears,
+              zip_comparison),
+        stage('summer_by_time_frame', dataChangeByTimeFrameFromTwoYears,
+              time_frame_comparison),
+        stage('question_4', withConnection,
+              top100ConsecutiveDaysWithMostAccidents, borough, kind='thread'),
+        stage('question_5', withConnection, dayWithMostAccidents, borough,
+              start_date, end_date, kind='thread'),
+        stage('question_6', withConnection, hourWithMostAccidents, borough,
+              start_date, end_date, kind='thread'),
+        stage('question_7', withConnection,
+              twelveDaysWithMostAccidentsIn2020, borough, kind='thread'),
+    ], workers=config_template.WORKERS)
 
 
 if __name__ == '__main__':
-    main()
+    with runReport('dataAnalysis'):
+        main()
@@ -0,0 +1,82 @@
+"""
+Filename : dataCache.py
+Author : Archit Joshi, Parth Sethia
+Description : On-disk columnar cache of the typed clean NYC Crash dataframe,
+keyed on the version stamp of clean_nyc_crashes. Repeated runs read the local
+file and skip postgres entirely until the cleaning stage rewrites the table.
+Language : python3
+"""
+import os
+import glob
+import hashlib
+import pandas as pd
+import pipelineState
+from dataAccess import loadCrashes
+
+CACHE_DIR = "cache"
+
+try:
+    import pyarrow  # noqa: F401
+    CACHE_EXTENSION = "parquet"
+except ImportError:
+    # Without a parquet engine fall back to pickled dataframes
+    CACHE_EXTENSION = "pkl"
+
+
+def cachePath(columns, borough, start_date, end_date, version,
+              cache_dir=CACHE_DIR):
+    """
+    Helper function to build the cache file name. The name starts with a hash
+    of the request so that files of older table versions can be found.
+
+    :param columns: list of column names
+    :param borough: borough filter
+    :param start_date: start date filter
+    :param end_date: end date filter
+    :param version: clean table version stamp
+    :param cache_dir: directory holding cache files
+    :return: (path of the cache file, glob pattern of all its versions) tuple
+    """
+    request = "|".join([",".join(columns), str(borough), str(start_date),
+                        str(end_date)])
+    request_key = hashlib.sha1(request.encode()).hexdigest()[:16]
+    prefix = os.path.join(cache_dir, f"clean_{request_key}_")
+    return f"{prefix}{version}.{CACHE_EXTENSION}", f"{prefix}*"
+
+
+def loadCleanData(connection, columns, borough=None, start_date=None,
+                  end_date=None, cache_dir=CACHE_DIR):
+    """
+    Load the typed clean dataset, from the on-disk cache when the clean table
+    hasn't changed since it was written, otherwise from postgres through
+    dataAccess.loadCrashes, refreshing the cache.
+
+    :param connection: database connection object
+    :param columns: list of clean table column names
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
+    :param cache_dir: directory holding cache files
+    :return: dataframe with the requested columns
+    """
+    path, pattern = cachePath(columns, borough, start_date, end_date,
+                              pipelineState.tableVersion(connection),
+                              cache_dir)
+    if os.path.exists(path):
+        print(f"== Clean data read from cache {path} ==")
+        if CACHE_EXTENSION == "parquet":
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    data = loadCrashes(connection, columns, borough, start_date, end_date)
+
+    # Drop files cached for older versions of the table
+    for stale in glob.glob(pattern):
+        os.remove(stale)
+    os.makedirs(cache_dir, exist_ok=True)
+    if CACHE_EXTENSION == "parquet":
+        data.to_parquet(path, index=False)
+    else:
+        data.to_pickle(path)
+    print(f"== Clean data cached to {path} ==")
+    return data
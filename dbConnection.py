@@ -0,0 +1,180 @@
+"""
+Filename : dbConnection.py
+Author : Archit Joshi, Parth Sethia
+Description : Shared, pooled access to the NYC Crash database. Every module
+borrows connections from one bounded pool per process instead of opening its
+own, and every connection carries a statement timeout. With BACKEND =
+'duckdb' the connections are to an embedded DuckDB file instead.
+Language : python3
+"""
+import os
+import threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+import config_template
+import duckdbBackend
+import instrumentation
+
+_pool = None
+_pool_pid = None
+# getconn raises once the pool is exhausted, borrowers wait on this instead
+_slots = None
+_lock = threading.Lock()
+
+
+def embedded():
+    """
+    Whether the embedded DuckDB backend is selected instead of postgres.
+
+    :return: True for the DuckDB backend
+    """
+    return config_template.BACKEND == 'duckdb'
+
+
+def duckdbPath():
+    """
+    Path of the DuckDB database file, <DB_NAME>.duckdb unless DUCKDB_PATH is
+    set.
+
+    :return: path of the database file
+    """
+    return config_template.DUCKDB_PATH or f"{config_template.DB_NAME}.duckdb"
+
+
+def connectionParameters(database=None):
+    """
+    Helper function to build the psycopg2 connection parameters from
+    config_template. Cursors record their queries for instrumentation.
+
+    :param database: database to connect to, the configured one if None
+    :return: dictionary of connection parameters
+    """
+    return {
+        'database': database or config_template.DB_NAME,
+        'user': config_template.USERNAME,
+        'password': config_template.DB_PASSWORD,
+        'host': config_template.HOST,
+        'port': config_template.PORT,
+        'options': f"-c statement_timeout={config_template.STATEMENT_TIMEOUT}",
+        'cursor_factory': instrumentation.InstrumentedCursor,
+    }
+
+
+def ensureDatabase():
+    """
+    Create the configured database if it doesn't exist yet.
+
+    :return: None
+    """
+    if embedded():
+        # The database file is created on first connect
+        return
+    database = config_template.DB_NAME
+    try:
+        psycopg2.connect(**connectionParameters()).close()
+    except psycopg2.Error as e:
+        if f'database "{database}" does not exist' not in str(e):
+            raise
+        print(f"Provided database does not exist. Creating database {database}")
+        conn = psycopg2.connect(**connectionParameters('postgres'))
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("CREATE DATABASE {}").format(
+                sql.Identifier(database)))
+        conn.close()
+
+
+def getPool():
+    """
+    Connection pool of the current process, created on first use. A process
+    forked from one that already had a pool gets a fresh pool of its own.
+
+    :return: ThreadedConnectionPool
+    """
+    global _pool, _pool_pid, _slots
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadedConnectionPool(config_template.POOL_MIN,
+                                           config_template.POOL_MAX,
+                                           **connectionParameters())
+            _slots = threading.BoundedSemaphore(config_template.POOL_MAX)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def connectDB():
+    """
+    Borrow a connection from the pool, waiting while every pooled connection
+    is in use. Hand it back with releaseDB.
+
+    :return: database connection object, None if the connection failed
+    """
+    if embedded():
+        try:
+            return duckdbBackend.connect(duckdbPath())
+        except psycopg2.Error as e:
+            print(f"Connection error --> {e}")
+            return None
+    try:
+        pool = getPool()
+    except psycopg2.Error as e:
+        print(f"Connection error, check credentials or run createDB.py --> {e}")
+        return None
+    _slots.acquire()
+    try:
+        return pool.getconn()
+    except psycopg2.Error as e:
+        _slots.release()
+        print(f"Connection error, check credentials or run createDB.py --> {e}")
+
+
+def releaseDB(connection):
+    """
+    Return a borrowed connection to the pool, rolling back any transaction
+    the caller left open.
+
+    :param connection: database connection object
+    :return: None
+    """
+    if connection is None:
+        return
+    if embedded():
+        connection.close()
+        return
+    if not connection.closed and \
+            connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+        connection.rollback()
+    getPool().putconn(connection)
+    _slots.release()
+
+
+@contextmanager
+def pooledConnection():
+    """
+    Context manager borrowing a connection from the pool for a block.
+
+    :return: database connection object
+    """
+    connection = connectDB()
+    if connection is None:
+        raise psycopg2.OperationalError("Could not borrow a database connection")
+    try:
+        yield connection
+    finally:
+        releaseDB(connection)
+
+
+def closePool():
+    """
+    Close every connection of the current process' pool.
+
+    :return: None
+    """
+    global _pool
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
@@ -0,0 +1,294 @@
+"""
+Filename : duckdbBackend.py
+Author : Archit Joshi, Parth Sethia
+Description : Embedded DuckDB backend for the NYC Crash pipeline, selected
+with BACKEND = 'duckdb' in config_template. The database is a local file
+queried in-process, so laptops and CI run the whole pipeline without a
+postgres server. Connections look like psycopg2 connections to the rest of
+the code; loading, cleaning and rollups that rely on postgres-only features
+have embedded counterparts here.
+Language : python3
+"""
+import re
+import threading
+from datetime import date, time
+import psycopg2
+from psycopg2 import sql
+import instrumentation
+
+try:
+    import duckdb
+except ImportError:
+    # Only needed when the embedded backend is selected
+    duckdb = None
+
+_database = None
+_database_path = None
+_lock = threading.Lock()
+
+# psycopg2 placeholders and escaped percent signs
+PLACEHOLDER = re.compile(r"%%|%s")
+
+
+def quoteLiteral(value):
+    """
+    Helper function to render a python value as an SQL literal.
+
+    :param value: value of a psycopg2 sql.Literal
+    :return: SQL literal string
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, date):
+        return f"DATE '{value.isoformat()}'"
+    if isinstance(value, time):
+        return f"TIME '{value.isoformat()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def composableString(query):
+    """
+    Render a psycopg2 sql composable without a postgres connection, which
+    as_string would need for quoting.
+
+    :param query: sql.Composable or string
+    :return: SQL string
+    """
+    if isinstance(query, str):
+        return query
+    if isinstance(query, sql.Composed):
+        return "".join(composableString(part) for part in query.seq)
+    if isinstance(query, sql.SQL):
+        return query.string
+    if isinstance(query, sql.Identifier):
+        return ".".join('"' + name.replace('"', '""') + '"'
+                        for name in query.strings)
+    if isinstance(query, sql.Literal):
+        return quoteLiteral(query.wrapped)
+    if isinstance(query, sql.Placeholder):
+        return "%s"
+    raise TypeError(f"Can't render {query!r}")
+
+
+def renderQuery(query, parameters=None):
+    """
+    Translate a psycopg2 query into DuckDB SQL. As in psycopg2, placeholders
+    and escaped percent signs are only interpreted when parameters are given.
+
+    :param query: sql.Composable or string
+    :param parameters: query parameters or None
+    :return: SQL string
+    """
+    text = composableString(query)
+    if parameters is None:
+        return text
+    return PLACEHOLDER.sub(lambda match: "%" if match.group() == "%%" else "?",
+                           text)
+
+
+class DuckDBCursor:
+    """
+    Cursor with the subset of the psycopg2 cursor interface the pipeline
+    uses. DuckDB errors are raised as psycopg2.DatabaseError so the existing
+    error handling applies to both backends.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.itersize = 2000
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+    def execute(self, query, parameters=None):
+        self.connection.begin()
+        text = renderQuery(query, parameters)
+        values = list(parameters) if parameters is not None else None
+        database = self.connection.database
+
+        def explain():
+            database.execute("EXPLAIN ANALYZE " + text, values)
+            return "\n".join(row[-1] for row in database.fetchall())
+
+        try:
+            instrumentation.tracedQuery(text, lambda: database.execute(text, values),
+                                        explain)
+        except duckdb.Error as e:
+            raise psycopg2.DatabaseError(str(e)) from e
+
+    def fetchone(self):
+        return self.connection.database.fetchone()
+
+    def fetchmany(self, size=None):
+        return self.connection.database.fetchmany(size or self.itersize)
+
+    def fetchall(self):
+        return self.connection.database.fetchall()
+
+    def copy_expert(self, query, file):
+        raise psycopg2.NotSupportedError("COPY FROM STDIN needs the postgres backend")
+
+    def close(self):
+        pass
+
+
+class DuckDBConnection:
+    """
+    Connection with the subset of the psycopg2 connection interface the
+    pipeline uses. Like psycopg2, a transaction is opened by the first
+    statement and lasts until commit or rollback.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.closed = False
+        self.in_transaction = False
+
+    def cursor(self, name=None):
+        # Results are streamed from DuckDB whether or not the cursor is named
+        return DuckDBCursor(self)
+
+    def begin(self):
+        if not self.in_transaction:
+            self.database.execute("BEGIN TRANSACTION")
+            self.in_transaction = True
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            try:
+                self.database.execute("COMMIT")
+            except duckdb.Error as e:
+                raise psycopg2.DatabaseError(str(e)) from e
+
+    def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.database.execute("ROLLBACK")
+
+    def close(self):
+        if not self.closed:
+            self.rollback()
+            self.database.close()
+            self.closed = True
+
+
+def connect(path):
+    """
+    Open a connection to the DuckDB database file. One database instance is
+    kept per file and every caller gets its own connection to it, so threads
+    can query concurrently.
+
+    :param path: path of the database file
+    :return: DuckDBConnection
+    """
+    global _database, _database_path
+    if duckdb is None:
+        raise psycopg2.OperationalError("BACKEND = 'duckdb' needs the duckdb package")
+    with _lock:
+        if _database is None or _database_path != path:
+            _database = duckdb.connect(path)
+            _database_path = path
+        return DuckDBConnection(_database.cursor())
+
+
+def loadData(connection, path):
+    """
+    Load the raw csv into nyc_crashes with DuckDB's parallel csv reader,
+    converting every column to the type of the table created by
+    createDB.createSchema.
+
+    :param connection: DuckDBConnection
+    :param path: path of the csv file
+    :return: number of rows loaded
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT column_name, data_type FROM information_schema.columns "
+                       "WHERE lower(table_name) = 'nyc_crashes' ORDER BY ordinal_position")
+        columns = cursor.fetchall()
+    names = ", ".join(quoteLiteral(name) for name, _ in columns)
+    expressions = ", ".join(
+        f"strptime({name}, ['%m/%d/%Y', '%Y-%m-%d'])::DATE" if data_type == 'DATE'
+        else f"CAST({name} AS {data_type})" for name, data_type in columns)
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO nyc_crashes SELECT {expressions} FROM "
+                       f"read_csv({quoteLiteral(path)}, header = true, "
+                       f"all_varchar = true, names = [{names}])")
+        cursor.execute("SELECT count(*) FROM nyc_crashes")
+        rows = cursor.fetchone()[0]
+    connection.commit()
+    return rows
+
+
+def applyCleaningRules(connection, rejection_case):
+    """
+    Embedded counterpart of cleanData.applyCleaningRules. DuckDB has neither
+    partitioned tables nor data-modifying CTEs, the clean table is created
+    from the kept rows and the rejections are counted in a second columnar
+    scan.
+
+    :param connection: DuckDBConnection
+    :param rejection_case: sql CASE expression naming the rejecting rule
+    :return: dictionary of rule name to number of rejected rows, 'kept' for
+    the number of clean rows
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql.SQL("CREATE OR REPLACE TABLE clean_nyc_crashes AS "
+                               "SELECT * FROM nyc_crashes WHERE {} IS NULL")
+                       .format(rejection_case))
+        cursor.execute(sql.SQL("SELECT coalesce({}, 'kept'), count(*) "
+                               "FROM nyc_crashes GROUP BY 1").format(rejection_case))
+        report = dict(cursor.fetchall())
+    connection.commit()
+    return report
+
+
+def createRollup(connection, name, query):
+    """
+    Embedded counterpart of a materialized rollup view, a plain table that
+    is rebuilt on refresh.
+
+    :param connection: DuckDBConnection
+    :param name: rollup name
+    :param query: rollup query
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE OR REPLACE TABLE {name} AS {query}")
+    connection.commit()
+
+
+def appendFrame(connection, table, frame):
+    """
+    Embedded counterpart of COPY FROM STDIN, insert the rows of a dataframe
+    by column name. DuckDB scans the dataframe in place.
+
+    :param connection: DuckDBConnection
+    :param table: table name
+    :param frame: dataframe whose columns are columns of the table
+    :return: None
+    """
+    connection.begin()
+    try:
+        connection.database.register('appended_frame', frame)
+        connection.database.execute(f"INSERT INTO {table} BY NAME "
+                                    f"SELECT * FROM appended_frame")
+    except duckdb.Error as e:
+        raise psycopg2.DatabaseError(str(e)) from e
+    finally:
+        connection.database.unregister('appended_frame')
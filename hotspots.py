@@ -0,0 +1,234 @@
+"""
+Filename : hotspots.py
+Author : Archit Joshi, Parth Sethia
+Description : Hotspot ranking of the NYC Crash data. Crashes are snapped to a
+grid cell or to their on_street_name/cross_street_name intersection and the
+locations are ranked by crash count and injury severity for any periods,
+with the change between periods, in one SQL aggregation or one vectorized
+groupby.
+Language : python3
+"""
+import argparse
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+import dbConnection
+from periodComparison import (Period, countColumn, periodChanges, periodCodes,
+                              periodFilter)
+
+HOTSPOT_CELL_SIZE = 0.002
+HOTSPOT_COLUMNS = ['crash_date', 'latitude', 'longitude', 'on_street_name',
+                   'cross_street_name', 'number_of_persons_injured',
+                   'number_of_persons_killed']
+# Grid cells of the frame path are snapped from the float64 coordinates, as
+# floor() does in SQL, load the crashes with these dtypes
+HOTSPOT_DTYPES = {'latitude': 'float64', 'longitude': 'float64'}
+
+# Weight of a crash, an injured person and a killed person in the severity
+# score locations are ranked by
+SEVERITY_WEIGHTS = {'count': 1, 'injured': 3, 'killed': 10}
+
+# Columns of the location key, by key kind
+KEY_COLUMNS = {
+    'intersection': ['street_1', 'street_2'],
+    'grid': ['cell_latitude', 'cell_longitude'],
+}
+
+# The two streets of an intersection are ordered so that A & B and B & A
+# are the same location
+STREET = "upper(trim({}))"
+INTERSECTION_EXPRESSIONS = [
+    f"least({STREET.format('on_street_name')}, {STREET.format('cross_street_name')})",
+    f"greatest({STREET.format('on_street_name')}, {STREET.format('cross_street_name')})",
+]
+
+
+def severityScores(ranking, labels, columns):
+    """
+    Helper function to add the severity score of every period and rank the
+    locations by the score of the last period. Ties are broken by the location
+    key, in the same order as the SQL ranking.
+
+    :param ranking: dataframe with count, injured and killed columns per period
+    :param labels: period labels in order
+    :param columns: location key columns
+    :return: ranking with severity_<label> columns, highest score first
+    """
+    for label in labels:
+        ranking[f"severity_{label}"] = sum(
+            weight * ranking[f"{metric}_{label}" if metric != 'count'
+                             else countColumn(label)]
+            for metric, weight in SEVERITY_WEIGHTS.items())
+    return ranking.sort_values([f"severity_{labels[-1]}"] + columns,
+                               ascending=[False] + [True] * len(columns),
+                               ignore_index=True)
+
+
+def rankHotspots(connection, periods, key='intersection', borough=None,
+                 cell_size=HOTSPOT_CELL_SIZE, top=20):
+    """
+    Rank grid cells or intersections by severity in postgres. Crash counts,
+    injuries and deaths of every period are filtered aggregates of a single
+    grouped scan over the crashes of the periods, only the top locations are
+    sent to the client.
+
+    :param connection: database connection object
+    :param periods: list of periodComparison.Period, non-overlapping
+    :param key: 'intersection' or 'grid'
+    :param borough: borough to analyse, all boroughs if None
+    :param cell_size: grid cell size in degrees
+    :param top: number of locations to return
+    :return: dataframe of the top locations with counts, injuries, deaths,
+    severity and the change of the count against the first period
+    """
+    labels = [period.label for period in periods]
+    where_clause, parameters = periodFilter(periods, borough)
+
+    if key == 'intersection':
+        expressions = INTERSECTION_EXPRESSIONS
+        key_parameters = ()
+        condition = "on_street_name IS NOT NULL AND cross_street_name IS NOT NULL"
+        # Byte order, as the frame path sorts the strings
+        collation = ' COLLATE "C"'
+    elif key == 'grid':
+        expressions = ["(floor(latitude / %s) + 0.5) * %s",
+                       "(floor(longitude / %s) + 0.5) * %s"]
+        key_parameters = (cell_size,) * 4
+        condition = "latitude IS NOT NULL AND longitude IS NOT NULL"
+        collation = ""
+    else:
+        raise ValueError(f"Unknown hotspot key : {key}")
+
+    metrics = []
+    metric_parameters = ()
+    for period in periods:
+        in_period = "FILTER (WHERE crash_date BETWEEN %s AND %s)"
+        metrics.append(sql.SQL(f"count(*) {in_period} AS {{}}, "
+                               f"coalesce(sum(number_of_persons_injured) {in_period}, 0) AS {{}}, "
+                               f"coalesce(sum(number_of_persons_killed) {in_period}, 0) AS {{}}")
+                       .format(sql.Identifier(countColumn(period.label)),
+                               sql.Identifier(f"injured_{period.label}"),
+                               sql.Identifier(f"killed_{period.label}")))
+        metric_parameters += (period.start_date, period.end_date) * 3
+
+    columns = KEY_COLUMNS[key]
+    last = labels[-1]
+    severity = sql.SQL(" + ").join(
+        sql.SQL(f"{weight} * {{}}").format(sql.Identifier(
+            countColumn(last) if metric == 'count' else f"{metric}_{last}"))
+        for metric, weight in SEVERITY_WEIGHTS.items())
+    query = sql.SQL("""
+        SELECT * FROM (
+            SELECT {}, {} FROM clean_nyc_crashes {} AND {} GROUP BY 1, 2
+        ) AS locations
+        ORDER BY {} DESC, {}
+        LIMIT %s
+    """).format(
+        sql.SQL(", ").join(sql.SQL(f"{expression} AS {{}}").format(sql.Identifier(column))
+                           for expression, column in zip(expressions, columns)),
+        sql.SQL(", ").join(metrics), sql.SQL(where_clause), sql.SQL(condition),
+        severity,
+        sql.SQL(", ").join(sql.SQL(f"{{}}{collation}").format(sql.Identifier(column))
+                           for column in columns))
+    with connection.cursor() as cursor:
+        cursor.execute(query, key_parameters + metric_parameters + parameters + (top,))
+        rows = cursor.fetchall()
+
+    metric_columns = [f"{metric}_{label}" if metric != 'count' else countColumn(label)
+                      for label in labels for metric in ('count', 'injured', 'killed')]
+    ranking = pd.DataFrame.from_records(rows, columns=columns + metric_columns)
+    ranking[metric_columns] = ranking[metric_columns].astype('int64')
+    return periodChanges(severityScores(ranking, labels, columns), labels)
+
+
+def hotspotKeys(data, key, cell_size=HOTSPOT_CELL_SIZE):
+    """
+    Helper function computing the location key of every crash of a loaded
+    dataframe, NaN where the location is unknown.
+
+    :param data: dataframe returned by loadCrashes holding HOTSPOT_COLUMNS
+    :param key: 'intersection' or 'grid'
+    :param cell_size: grid cell size in degrees
+    :return: dataframe of the key columns
+    """
+    if key == 'grid':
+        if data['latitude'].dtype != np.float64 or data['longitude'].dtype != np.float64:
+            # float32 coordinates land in other cells than the SQL ranking's
+            raise ValueError("Grid hotspots need coordinates loaded with HOTSPOT_DTYPES")
+        return pd.DataFrame({
+            'cell_latitude': (np.floor(data['latitude'].to_numpy(np.float64) /
+                                       cell_size) + 0.5) * cell_size,
+            'cell_longitude': (np.floor(data['longitude'].to_numpy(np.float64) /
+                                        cell_size) + 0.5) * cell_size,
+        })
+    if key != 'intersection':
+        raise ValueError(f"Unknown hotspot key : {key}")
+    # Normalised once per category rather than once per row
+    on_street = data['on_street_name'].str.strip().str.upper().to_numpy(object)
+    cross_street = data['cross_street_name'].str.strip().str.upper().to_numpy(object)
+    known = pd.notna(on_street) & pd.notna(cross_street)
+    first = np.full(len(data), None, dtype=object)
+    second = np.full(len(data), None, dtype=object)
+    swap = (on_street[known] > cross_street[known]).astype(bool)
+    first[known] = np.where(swap, cross_street[known], on_street[known])
+    second[known] = np.where(swap, on_street[known], cross_street[known])
+    return pd.DataFrame({'street_1': first, 'street_2': second})
+
+
+def rankHotspotsFrame(data, periods, key='intersection',
+                      cell_size=HOTSPOT_CELL_SIZE, top=20):
+    """
+    Same ranking as rankHotspots over an already loaded dataframe, in one
+    vectorized groupby.
+
+    :param data: dataframe returned by loadCrashes holding HOTSPOT_COLUMNS,
+    loaded with HOTSPOT_DTYPES
+    :param periods: list of periodComparison.Period, non-overlapping
+    :param key: 'intersection' or 'grid'
+    :param cell_size: grid cell size in degrees
+    :param top: number of locations to return
+    :return: dataframe of the top locations, see rankHotspots
+    """
+    labels = [period.label for period in periods]
+    frame = hotspotKeys(data, key, cell_size)
+    columns = KEY_COLUMNS[key]
+    frame['period'] = periodCodes(data['crash_date'], periods)
+    frame['injured'] = data['number_of_persons_injured'].fillna(0).to_numpy('int64')
+    frame['killed'] = data['number_of_persons_killed'].fillna(0).to_numpy('int64')
+    frame = frame[frame['period'] >= 0].dropna(subset=columns)
+
+    grouped = frame.groupby(columns + ['period']).agg(
+        count=('period', 'size'), injured=('injured', 'sum'),
+        killed=('killed', 'sum')).unstack('period', fill_value=0)
+    ranking = pd.DataFrame(index=grouped.index)
+    for position, label in enumerate(labels):
+        for metric in ('count', 'injured', 'killed'):
+            column = countColumn(label) if metric == 'count' else f"{metric}_{label}"
+            ranking[column] = grouped[(metric, position)] \
+                if (metric, position) in grouped else 0
+    return periodChanges(severityScores(ranking.reset_index(), labels, columns),
+                         labels).head(top)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rank crash hotspots and their year over year change")
+    parser.add_argument('--key', choices=sorted(KEY_COLUMNS),
+                        default='intersection')
+    parser.add_argument('--years', type=int, nargs='+', default=[2019, 2020])
+    parser.add_argument('--borough', default=None,
+                        help="borough to analyse, citywide by default")
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    periods = [Period(str(year), f"{year}-01-01", f"{year}-12-31")
+               for year in args.years]
+    with dbConnection.pooledConnection() as conn:
+        ranking = rankHotspots(conn, periods, args.key, args.borough,
+                               top=args.top)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(ranking)
+
+
+if __name__ == "__main__":
+    main()
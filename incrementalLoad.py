@@ -0,0 +1,214 @@
+"""
+Filename : incrementalLoad.py
+Author : Archit Joshi, Parth Sethia
+Description : Incremental, append-only ingest of NYC Crash data keyed on
+COLLISION_ID. Only rows past the stored high-water mark (plus a short
+look-back window for amended crashes) are sent to the database, upserted into
+nyc_crashes, cleaned into clean_nyc_crashes and rolled up.
+Language : python3
+"""
+import io
+import csv
+import time
+from datetime import datetime, timedelta
+import psycopg2
+import createDB
+import cleanData
+import dbConnection
+import pipelineState
+import queryCache
+
+# Crashes reported within this many days of the high-water mark are re-sent
+# so that amendments to recent records are picked up
+LOOKBACK_DAYS = 30
+
+
+def createStateTable(connection):
+    """
+    Create the pipeline_state table and the unique index upserts into
+    nyc_crashes are keyed on.
+
+    :param connection: database connection object
+    :return: None
+    """
+    pipelineState.createStateTable(connection)
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS nyc_crashes_collision_id_idx "
+                       "ON nyc_crashes (collision_id)")
+        connection.commit()
+
+
+def getHighWaterMark(connection):
+    """
+    Fetch the ingest high-water mark. Falls back to the current contents of
+    nyc_crashes when no incremental run has been recorded yet, e.g. right after
+    a full createDB.py load.
+
+    :param connection: database connection object
+    :return: (max collision_id, max crash_date) tuple
+    """
+    collision_id = pipelineState.getState(connection, 'nyc_crashes.max_collision_id')
+    crash_date = pipelineState.getState(connection, 'nyc_crashes.max_crash_date')
+    if collision_id is not None and crash_date is not None:
+        return int(collision_id), datetime.strptime(crash_date, '%Y-%m-%d').date()
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT max(collision_id), max(crash_date) FROM nyc_crashes")
+        collision_id, crash_date = cursor.fetchone()
+    return collision_id or 0, crash_date
+
+
+def isRecent(crash_date, cutoff):
+    """
+    Helper function to check whether a raw CRASH DATE falls in the look-back
+    window. Dates that don't parse are never recent.
+
+    :param crash_date: raw date string
+    :param cutoff: first date of the look-back window
+    :return: bool
+    """
+    try:
+        return datetime.strptime(crash_date, '%m/%d/%Y').date() >= cutoff
+    except ValueError:
+        return False
+
+
+def readDelta(path, max_collision_id, max_crash_date,
+              chunk_size=createDB.CHUNK_SIZE):
+    """
+    Generator streaming the csv and keeping only rows that are new
+    (collision_id above the high-water mark) or recent enough to have been
+    amended, as csv text chunks of chunk_size rows. Rows without a numeric
+    collision_id can't be upserted and are skipped.
+
+    :param path: path of the csv file
+    :param max_collision_id: collision_id high-water mark
+    :param max_crash_date: crash_date high-water mark
+    :param chunk_size: number of rows per chunk
+    :return: yields (number of rows, csv text) tuples
+    """
+    cutoff = max_crash_date - timedelta(days=LOOKBACK_DAYS) if max_crash_date else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    rows = skipped = 0
+    with open(path, newline='', encoding='utf-8') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        id_index = header.index('COLLISION_ID')
+        date_index = header.index('CRASH DATE')
+        for record in reader:
+            try:
+                collision_id = int(record[id_index])
+            except ValueError:
+                skipped += 1
+                continue
+            if collision_id > max_collision_id or cutoff is None or \
+                    isRecent(record[date_index], cutoff):
+                writer.writerow(record)
+                rows += 1
+                if rows == chunk_size:
+                    yield rows, buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                    rows = 0
+    if rows:
+        yield rows, buffer.getvalue()
+    if skipped:
+        print(f"== {skipped} rows without a COLLISION_ID skipped ==")
+
+
+def upsertDelta(connection, chunks):
+    """
+    Copy the delta into a staging table chunk by chunk and upsert it into
+    nyc_crashes. Rows that are unchanged are left alone, the inserted or
+    updated ones are kept in the changed_crashes temp table until commit.
+
+    :param connection: database connection object
+    :param chunks: iterable of (number of rows, csv text) tuples of the delta
+    :return: (number of delta rows, number of inserted or updated rows) tuple
+    """
+    rows = 0
+    with connection.cursor() as cursor:
+        cursor.execute("SET LOCAL datestyle = 'ISO, MDY'")
+        cursor.execute("CREATE TEMP TABLE staging_crashes (LIKE nyc_crashes) ON COMMIT DROP")
+        for chunk_rows, chunk in chunks:
+            cursor.copy_expert("COPY staging_crashes FROM STDIN WITH (FORMAT csv)",
+                               io.StringIO(chunk))
+            rows += chunk_rows
+
+        cursor.execute("SELECT column_name FROM information_schema.columns "
+                       "WHERE table_name = 'nyc_crashes' ORDER BY ordinal_position")
+        columns = [column for column, in cursor.fetchall()]
+        updates = ", ".join(f"{column} = EXCLUDED.{column}"
+                            for column in columns if column != 'collision_id')
+        cursor.execute("CREATE TEMP TABLE changed_crashes (LIKE nyc_crashes) ON COMMIT DROP")
+        cursor.execute(f"""
+            WITH changed AS (
+                INSERT INTO nyc_crashes SELECT * FROM staging_crashes
+                ON CONFLICT (collision_id) DO UPDATE SET {updates}
+                WHERE (nyc_crashes.*) IS DISTINCT FROM (EXCLUDED.*)
+                RETURNING nyc_crashes.*
+            )
+            INSERT INTO changed_crashes SELECT * FROM changed
+        """)
+        changed = cursor.rowcount
+    return rows, changed
+
+
+def incrementalLoad(connection, path=None):
+    """
+    Wrapper function to load only new or changed rows, clean that delta,
+    update the rollups of its crash dates and move the high-water mark forward
+    in one transaction.
+
+    :param connection: database connection object
+    :param path: path of the csv file, defaults to the csv in the working dir
+    :return: None
+    """
+    createStateTable(connection)
+    max_collision_id, max_crash_date = getHighWaterMark(connection)
+
+    start = time.perf_counter()
+    path = path or createDB.csvPath()
+    try:
+        rows, changed = upsertDelta(connection, readDelta(path, max_collision_id,
+                                                          max_crash_date))
+        # Rows re-sent by the look-back window unchanged don't touch the
+        # clean table, its version or the rollups
+        if changed:
+            print(cleanData.cleanDelta(connection, 'changed_crashes'))
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT max(collision_id), max(crash_date) FROM nyc_crashes")
+            new_collision_id, new_crash_date = cursor.fetchone()
+        # Nothing loaded yet, there is no high-water mark to remember
+        if new_collision_id is not None:
+            pipelineState.setState(connection, 'nyc_crashes.max_collision_id',
+                                   new_collision_id)
+            pipelineState.setState(connection, 'nyc_crashes.max_crash_date',
+                                   new_crash_date)
+        # Both tables now reflect this csv, a full run over it can skip them
+        signature = pipelineState.fileSignature(path)
+        pipelineState.setState(connection, 'nyc_crashes.source', signature)
+        pipelineState.setState(connection, 'clean_nyc_crashes.source', signature)
+        connection.commit()
+    except psycopg2.Error as e:
+        print(f"ERROR in incremental load : {e}")
+        connection.rollback()
+        return False
+    if changed:
+        # Cached answers were keyed on the clean table version just replaced
+        queryCache.clear()
+
+    elapsed = time.perf_counter() - start
+    print(f"== Incremental load : {rows} rows read past the high-water mark, "
+          f"{changed} inserted or updated in {elapsed:.1f}s ==")
+
+
+def main():
+    with dbConnection.pooledConnection() as connection:
+        incrementalLoad(connection)
+
+
+if __name__ == "__main__":
+    main()
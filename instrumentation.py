@@ -0,0 +1,397 @@
+"""
+Filename : instrumentation.py
+Author : Archit Joshi, Parth Sethia
+Description : Stage-level instrumentation of the NYC Crash pipeline. Stages
+decorated with @instrumented record their wall time, rows in and out and the
+memory they grew the process by, and every query run on a pooled connection records its time (plus its
+EXPLAIN (ANALYZE, BUFFERS) plan if enabled) against the stage that ran it. A
+run writes the records to a JSON report, and optionally a cProfile dump, in
+REPORT_DIR so regressions can be traced to a stage as the data grows.
+Language : python3
+"""
+import os
+import re
+import sys
+import json
+import time
+import cProfile
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+import psycopg2.extensions
+from psycopg2 import sql
+import config_template
+
+try:
+    import resource
+except ImportError:
+    # Not available on windows, only the python heap peak is reported there
+    resource = None
+
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+
+# Queries EXPLAIN ANALYZE may run a second time, statements that modify data
+# are never explained
+EXPLAINABLE = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+MODIFYING = re.compile(r"\b(insert|update|delete|merge|copy|create|drop|alter|"
+                       r"refresh|truncate)\b", re.IGNORECASE)
+
+
+def enabled():
+    """
+    Whether instrumentation is switched on in config_template.
+
+    :return: bool
+    """
+    return config_template.INSTRUMENT
+
+
+def peakRSS():
+    """
+    Peak resident set size of this process so far in MB, None on windows.
+
+    :return: peak RSS in MB
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def currentRSS():
+    """
+    Resident set size of this process right now in MB, None where /proc
+    isn't available.
+
+    :return: RSS in MB
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def resetPeakRSS():
+    """
+    Reset the peak RSS of this process to its current RSS, so peakRSS
+    reports the peak of what runs next rather than of the whole process.
+    Only possible on linux.
+
+    :return: True if the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def rowCount(value):
+    """
+    Helper function to count the rows of a stage argument or return value,
+    dataframes, arrays and lists of rows.
+
+    :param value: any value
+    :return: number of rows, None if value isn't tabular
+    """
+    if hasattr(value, 'shape') and getattr(value, 'ndim', 0) >= 1:
+        return int(value.shape[0])
+    if isinstance(value, list) and all(isinstance(row, tuple) for row in value):
+        return len(value)
+    return None
+
+
+def currentStage():
+    """
+    Record of the innermost stage running on this thread.
+
+    :return: stage record dictionary, None outside of a stage
+    """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def annotate(**values):
+    """
+    Add values to the record of the running stage, e.g. rows_out when the
+    return value doesn't tell or the rows rejected by every cleaning rule.
+    Does nothing outside of a stage.
+
+    :param values: record fields
+    :return: None
+    """
+    record = currentStage()
+    if record is not None:
+        record.update(values)
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """
+    Context manager recording one stage. Stages nest, a record names the
+    stage it ran in as its parent. Memory is recorded as the RSS at the start
+    of the stage and its growth by the end, the peak RSS is only known for
+    the whole process and is reported once per run.
+
+    :param name: stage name
+    :param rows_in: number of input rows, if known
+    :return: stage record dictionary
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    record = {
+        'stage': name,
+        'parent': stack[-1]['stage'] if stack else None,
+        'pid': os.getpid(),
+        'thread': threading.current_thread().name,
+        'started_at': datetime.now().isoformat(timespec='milliseconds'),
+        'rows_in': rows_in,
+        'rows_out': None,
+        'queries': [],
+    }
+    # The outermost stage starts tracing python allocations. A nested stage
+    # resets the peak and hands the peak it saw back to the enclosing one on
+    # exit. tracemalloc is process wide, stages running concurrently in
+    # threads share their peaks.
+    trace = config_template.TRACE_MEMORY
+    started_tracing = trace and not tracemalloc.is_tracing()
+    outer_peak = 0
+    if started_tracing:
+        tracemalloc.start()
+    elif trace:
+        outer_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+    stack.append(record)
+    rss_start = currentRSS()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['wall_time_s'] = round(time.perf_counter() - start, 4)
+        if trace:
+            peak = max(tracemalloc.get_traced_memory()[1],
+                       record.pop('_nested_peak', 0))
+            record['python_peak_mb'] = round(peak / (1024 * 1024), 2)
+            if started_tracing:
+                tracemalloc.stop()
+            elif len(stack) > 1:
+                stack[-2]['_nested_peak'] = max(
+                    stack[-2].get('_nested_peak', 0), outer_peak, peak)
+        if rss_start is not None:
+            record['rss_start_mb'] = round(rss_start, 2)
+            record['rss_delta_mb'] = round(currentRSS() - rss_start, 2)
+        stack.pop()
+        with _lock:
+            _records.append(record)
+
+
+def instrumented(function=None, name=None):
+    """
+    Decorator recording every call of a pipeline stage. Rows in are the rows
+    of the tabular arguments, rows out the rows of a tabular return value,
+    either can be set from inside the stage with annotate.
+
+    :param function: decorated function
+    :param name: stage name, module.function by default
+    :return: wrapped function
+    """
+    if function is None:
+        return functools.partial(instrumented, name=name)
+    stage_name = name or f"{function.__module__}.{function.__name__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return function(*args, **kwargs)
+        counts = [count for count in map(rowCount, list(args) + list(kwargs.values()))
+                  if count is not None]
+        with stage(stage_name, sum(counts) if counts else None) as record:
+            result = function(*args, **kwargs)
+            if record['rows_out'] is None:
+                record['rows_out'] = rowCount(result)
+        return result
+    return wrapper
+
+
+def explainable(text):
+    """
+    Whether a query only reads, so running it again under EXPLAIN ANALYZE is
+    safe.
+
+    :param text: SQL text
+    :return: bool
+    """
+    return bool(EXPLAINABLE.match(text)) and not MODIFYING.search(text)
+
+
+def tracedQuery(text, execute, explain=None, rowcount=None):
+    """
+    Run a query and record it against the running stage, with its plan when
+    EXPLAIN_QUERIES is set. Outside of a stage the query is just run.
+
+    :param text: SQL text of the query
+    :param execute: function running the query
+    :param explain: function returning the plan of the query, None if the
+    backend can't explain it
+    :param rowcount: function returning the number of rows of the query
+    :return: return value of execute
+    """
+    record = currentStage()
+    if record is None or not enabled():
+        return execute()
+    query = {'sql': " ".join(text.split())}
+    if explain is not None and config_template.EXPLAIN_QUERIES \
+            and explainable(text):
+        query['plan'] = explain()
+    start = time.perf_counter()
+    result = execute()
+    query['wall_time_s'] = round(time.perf_counter() - start, 4)
+    rows = rowcount() if rowcount is not None else -1
+    query['rows'] = rows if rows >= 0 else None
+    record['queries'].append(query)
+    return result
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    psycopg2 cursor recording its queries against the running stage. Pooled
+    connections create every cursor with this class.
+    """
+
+    def execute(self, query, vars=None):
+        run_query = super().execute
+        if currentStage() is None or not enabled():
+            return run_query(query, vars)
+        text = query.as_string(self) if isinstance(query, sql.Composable) else query
+        if isinstance(text, bytes):
+            text = text.decode()
+
+        def explain():
+            # A plain cursor, server-side cursors can't run EXPLAIN
+            with psycopg2.extensions.cursor(self.connection) as cursor:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + text,
+                               vars)
+                return cursor.fetchone()[0]
+
+        return tracedQuery(text, lambda: run_query(query, vars), explain,
+                           lambda: self.rowcount)
+
+
+def recordCount():
+    """
+    Number of stage records of this process so far.
+
+    :return: int
+    """
+    with _lock:
+        return len(_records)
+
+
+def recordsSince(mark):
+    """
+    Stage records added since recordCount returned mark. Worker processes
+    send these back with their result.
+
+    :param mark: value returned by recordCount
+    :return: list of stage records
+    """
+    with _lock:
+        return _records[mark:]
+
+
+def clearRecords(mark=0):
+    """
+    Drop the stage records added since recordCount returned mark, once they
+    are reported.
+
+    :param mark: value returned by recordCount
+    :return: None
+    """
+    with _lock:
+        del _records[mark:]
+
+
+def addRecords(records):
+    """
+    Add stage records collected in a worker process.
+
+    :param records: list of stage records
+    :return: None
+    """
+    with _lock:
+        _records.extend(records)
+
+
+def stageSummary(records):
+    """
+    Total wall time and number of calls per stage name.
+
+    :param records: list of stage records
+    :return: dictionary of stage name to summary
+    """
+    summary = {}
+    for record in records:
+        entry = summary.setdefault(record['stage'], {'calls': 0, 'wall_time_s': 0.0,
+                                                     'queries': 0})
+        entry['calls'] += 1
+        entry['wall_time_s'] = round(entry['wall_time_s'] + record['wall_time_s'], 4)
+        entry['queries'] += len(record['queries'])
+    return summary
+
+
+@contextmanager
+def runReport(name, report_dir=None):
+    """
+    Context manager instrumenting a whole run. On exit the stage records are
+    written to <report_dir>/<name>_<timestamp>.json and dropped, and with
+    PROFILE set the cProfile statistics of the main thread to a .prof file
+    next to it.
+
+    :param name: run name
+    :param report_dir: report directory, REPORT_DIR by default
+    :return: None
+    """
+    if not enabled():
+        yield
+        return
+    report_dir = report_dir or config_template.REPORT_DIR
+    mark = recordCount()
+    profiler = cProfile.Profile() if config_template.PROFILE else None
+    started_at = datetime.now()
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with stage(name):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        records = recordsSince(mark)
+        os.makedirs(report_dir, exist_ok=True)
+        base = os.path.join(report_dir, f"{name}_{started_at:%Y%m%d_%H%M%S}")
+        report = {
+            'run': name,
+            'started_at': started_at.isoformat(timespec='seconds'),
+            'wall_time_s': round(time.perf_counter() - start, 4),
+            'backend': config_template.BACKEND,
+            'process_peak_rss_mb': peakRSS(),
+            'summary': stageSummary(records),
+            'stages': records,
+        }
+        if profiler is not None:
+            profiler.dump_stats(base + ".prof")
+            report['profile'] = base + ".prof"
+        with open(base + ".json", 'w') as report_file:
+            json.dump(report, report_file, indent=2, default=str)
+        clearRecords(mark)
+        print(f"== Run report written to {base}.json ==")
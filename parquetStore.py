@@ -0,0 +1,374 @@
+"""
+Filename : parquetStore.py
+Author : Archit Joshi, Parth Sethia
+Description : Conversion of the raw NYC Crash csv into a Parquet dataset
+partitioned by year and month of CRASH_DATE and by BOROUGH, with typed columns
+and row-group statistics, and a reader that pushes borough, date and column
+filters down to the partitions and row groups. Ad-hoc analysis of one month
+of one borough reads only that borough's file of that month, without a
+database.
+Language : python3
+"""
+import os
+import time
+import uuid
+import argparse
+from datetime import date
+import pandas as pd
+import config_template
+from createDB import csvPath, csvHeader, inferColumnType, tableColumnName
+from dataAccess import COLUMN_DTYPES
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    # Only needed for the Parquet dataset
+    pa = None
+
+PARQUET_DIR = "parquet"
+# Bytes of csv parsed per streamed batch (the csv reader reads up to 32
+# blocks ahead), maximum rows per Parquet row group and rows of consecutive
+# batches collected before they are written out together
+BLOCK_SIZE = 4 << 20
+ROW_GROUP_SIZE = 100000
+WRITE_ROWS = 250000
+# Columns derived from CRASH_DATE to partition on, and the directory levels
+# of the dataset. Every borough of a month shares the same date range, so
+# only a borough directory level lets a borough filter skip data.
+PARTITION_COLUMNS = ['year', 'month']
+PARTITIONING = PARTITION_COLUMNS + ['borough']
+
+# Formats of the raw csv dates, tried in order, and times
+DATE_FORMATS = ['%m/%d/%Y', '%Y-%m-%d']
+TIME_FORMAT = '%H:%M'
+
+
+def requirePyarrow():
+    """
+    Helper function to fail early when pyarrow isn't installed.
+
+    :return: None
+    """
+    if pa is None:
+        raise ImportError("The Parquet dataset needs the pyarrow package")
+
+
+def arrowType(data_type):
+    """
+    Arrow type of a column from the postgres datatype createDB infers for it.
+
+    :param data_type: postgres datatype returned by createDB.inferColumnType
+    :return: pyarrow DataType
+    """
+    return {
+        'date': pa.date32(),
+        'time': pa.time32('s'),
+        'double precision': pa.float64(),
+        'smallint': pa.int16(),
+        'bigint': pa.int64(),
+    }.get(data_type, pa.string())
+
+
+def crashSchema(header):
+    """
+    Schema of the Parquet dataset, the typed csv columns followed by the
+    partition columns.
+
+    :param header: csv header column names
+    :return: pyarrow Schema
+    """
+    fields = [pa.field(tableColumnName(column), arrowType(inferColumnType(column)))
+              for column in header]
+    fields += [pa.field('year', pa.int16()), pa.field('month', pa.int8())]
+    return pa.schema(fields)
+
+
+def convertColumn(values, data_type):
+    """
+    Convert one string column of a csv batch to its arrow type. Values that
+    don't parse become nulls, as the cleaning stage would drop them anyway.
+
+    :param values: pyarrow string array
+    :param data_type: target pyarrow DataType
+    :return: pyarrow array
+    """
+    if data_type == pa.string():
+        return values
+    if data_type == pa.date32():
+        return pc.cast(pc.coalesce(*[pc.strptime(values, format=date_format,
+                                                 unit='s', error_is_null=True)
+                                     for date_format in DATE_FORMATS]),
+                       pa.date32())
+    if data_type == pa.time32('s'):
+        parsed = pc.strptime(values, format=TIME_FORMAT, unit='s',
+                             error_is_null=True)
+        seconds = pc.add(pc.multiply(pc.hour(parsed), 3600),
+                         pc.multiply(pc.minute(parsed), 60))
+        return pc.cast(pc.cast(seconds, pa.int32()), data_type)
+    # Empty strings are missing numbers
+    return pc.cast(pc.if_else(pc.equal(values, ""), None, values), data_type)
+
+
+def typedBatches(path, schema):
+    """
+    Generator streaming the csv in blocks of BLOCK_SIZE bytes and converting
+    every block to the dataset schema, so the file is read once and never
+    held in memory as a whole.
+
+    :param path: path of the csv file
+    :param schema: dataset schema returned by crashSchema
+    :return: yields pyarrow RecordBatch
+    """
+    columns = [field.name for field in schema if field.name not in PARTITION_COLUMNS]
+    reader = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=BLOCK_SIZE, skip_rows=1,
+                                        column_names=columns),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column: pa.string() for column in columns},
+            strings_can_be_null=True))
+    for batch in reader:
+        arrays = [convertColumn(batch.column(column), schema.field(column).type)
+                  for column in columns]
+        crash_date = arrays[columns.index('crash_date')]
+        arrays += [pc.cast(pc.year(crash_date), pa.int16()),
+                   pc.cast(pc.month(crash_date), pa.int8())]
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def frameBatch(frame, schema):
+    """
+    Convert a dataframe with the dtypes of dataAccess.loadCrashes, e.g. a
+    cleaned chunk, to a record batch of the dataset schema. The partition
+    columns are computed from crash_date.
+
+    :param frame: dataframe holding every column of the schema
+    :param schema: dataset schema returned by crashSchema
+    :return: pyarrow RecordBatch
+    """
+    arrays = []
+    for field in schema:
+        if field.name in PARTITION_COLUMNS:
+            dates = frame['crash_date'].dt
+            values = dates.year if field.name == 'year' else dates.month
+            arrays.append(pa.array(values, from_pandas=True).cast(field.type))
+        elif field.type == pa.time32('s'):
+            seconds = frame[field.name].dt.total_seconds()
+            arrays.append(pa.array(seconds, from_pandas=True)
+                          .cast(pa.int32()).cast(field.type))
+        else:
+            arrays.append(pa.array(frame[field.name], from_pandas=True)
+                          .cast(field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def writeDataset(batches, schema, output_dir=PARQUET_DIR):
+    """
+    Write record batches to the Parquet dataset in output_dir, one directory
+    per year, month and borough (year=2020/month=7/borough=BROOKLYN/, crashes
+    without a borough under __HIVE_DEFAULT_PARTITION__). Consecutive batches
+    are collected up to WRITE_ROWS rows and written to files of their own in
+    the partitions they touch, which are closed before more batches are read.
+    A writer kept open across batches holds on to memory for every partition
+    it has seen, so memory would grow with the dataset rather than stay
+    bounded by WRITE_ROWS. Row groups carry min/max statistics of every
+    column. An existing dataset is replaced partition by partition once all
+    batches are written.
+
+    :param batches: iterable of pyarrow RecordBatch of the schema
+    :param schema: dataset schema returned by crashSchema
+    :param output_dir: directory of the dataset
+    :return: number of rows written
+    """
+    partitioning = ds.partitioning(
+        pa.schema([schema.field(column) for column in PARTITIONING]),
+        flavor='hive')
+    file_options = ds.ParquetFileFormat().make_write_options(
+        compression='zstd', write_statistics=True)
+    # Files of this run are told apart from the ones they replace by name
+    run = uuid.uuid4().hex[:8]
+    written = set()
+
+    def writeFiles(pending, index):
+        ds.write_dataset(
+            pa.Table.from_batches(pending, schema=schema), output_dir,
+            schema=schema, format='parquet', partitioning=partitioning,
+            file_options=file_options, min_rows_per_group=ROW_GROUP_SIZE,
+            max_rows_per_group=ROW_GROUP_SIZE,
+            basename_template=f"part-{run}-{index}-{{i}}.parquet",
+            existing_data_behavior='overwrite_or_ignore',
+            file_visitor=lambda written_file: written.add(
+                os.path.normpath(written_file.path)))
+
+    rows = pending_rows = index = 0
+    pending = []
+    for batch in batches:
+        rows += batch.num_rows
+        pending_rows += batch.num_rows
+        pending.append(batch)
+        if pending_rows >= WRITE_ROWS:
+            writeFiles(pending, index)
+            pending, pending_rows, index = [], 0, index + 1
+    if pending:
+        writeFiles(pending, index)
+
+    # Drop the previous files of every partition this run wrote to
+    for directory in {os.path.dirname(path) for path in written}:
+        for name in os.listdir(directory):
+            path = os.path.normpath(os.path.join(directory, name))
+            if name.endswith(".parquet") and path not in written:
+                os.remove(path)
+    return rows
+
+
+def convertCsv(path=None, output_dir=PARQUET_DIR):
+    """
+    Convert the raw csv into the Parquet dataset in output_dir in one
+    streaming pass.
+
+    :param path: path of the csv file, defaults to the csv in the working dir
+    :param output_dir: directory of the dataset
+    :return: number of rows written
+    """
+    requirePyarrow()
+    path = path or csvPath()
+    schema = crashSchema(csvHeader(path))
+    start = time.perf_counter()
+    rows = writeDataset(typedBatches(path, schema), schema, output_dir)
+    elapsed = time.perf_counter() - start
+    print(f"== {rows} rows written to {output_dir} in {elapsed:.1f}s "
+          f"({rows / max(elapsed, 1e-9):,.0f} rows/sec) ==")
+    return rows
+
+
+def crashDataset(path=PARQUET_DIR):
+    """
+    Open the Parquet dataset written by convertCsv.
+
+    :param path: directory of the dataset
+    :return: pyarrow Dataset
+    """
+    requirePyarrow()
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+
+def crashFilter(borough=None, start_date=None, end_date=None):
+    """
+    Helper function to build the dataset filter of a borough and date range.
+    The borough and the year/month bounds prune whole partition directories,
+    the crash_date conditions skip row groups by their statistics.
+
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash_date to include, unbounded if None
+    :param end_date: last crash_date to include, unbounded if None
+    :return: pyarrow dataset Expression or None
+    """
+    year, month = ds.field('year'), ds.field('month')
+    conditions = []
+    if borough is not None:
+        conditions.append(ds.field('borough') == borough)
+    if start_date is not None:
+        start_date = date.fromisoformat(str(start_date))
+        conditions += [
+            (year > start_date.year) |
+            ((year == start_date.year) & (month >= start_date.month)),
+            ds.field('crash_date') >= pa.scalar(start_date, pa.date32())]
+    if end_date is not None:
+        end_date = date.fromisoformat(str(end_date))
+        conditions += [
+            (year < end_date.year) |
+            ((year == end_date.year) & (month <= end_date.month)),
+            ds.field('crash_date') <= pa.scalar(end_date, pa.date32())]
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+
+def toFrame(table):
+    """
+    Convert an arrow table read from the dataset to a dataframe with the
+    dtypes dataAccess.loadCrashes returns.
+
+    :param table: pyarrow Table
+    :return: dataframe
+    """
+    if 'crash_time' in table.column_names:
+        # Parquet stores times in milliseconds, read back seconds since
+        # midnight and convert them to a timedelta below
+        table = table.set_column(
+            table.column_names.index('crash_time'), 'crash_time',
+            pc.cast(pc.cast(table['crash_time'], pa.time32('s')), pa.int32()))
+    frame = table.to_pandas()
+    for column in frame.columns:
+        if column == 'crash_time':
+            frame[column] = pd.to_timedelta(frame[column], unit='s') \
+                .astype(COLUMN_DTYPES[column])
+        elif column in COLUMN_DTYPES:
+            frame[column] = frame[column].astype(COLUMN_DTYPES[column])
+    return frame
+
+
+def readCrashes(columns=None, borough=config_template.BOROUGH,
+                start_date=config_template.START_DATE,
+                end_date=config_template.END_DATE, path=PARQUET_DIR):
+    """
+    Read crashes from the Parquet dataset. Only the requested columns, the
+    partitions of the borough and date range and the row groups that can
+    hold matching rows are read from disk.
+
+    :param columns: columns to read, every csv column if None
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash_date to include, unbounded if None
+    :param end_date: last crash_date to include, unbounded if None
+    :param path: directory of the dataset
+    :return: dataframe sorted by crash_date
+    """
+    dataset = crashDataset(path)
+    if columns is None:
+        columns = [name for name in dataset.schema.names
+                   if name not in PARTITION_COLUMNS]
+    table = dataset.to_table(columns=list(columns),
+                             filter=crashFilter(borough, start_date, end_date))
+    if 'crash_date' in columns:
+        table = table.sort_by('crash_date')
+    return toFrame(table)
+
+
+def datasetSummary(path=PARQUET_DIR):
+    """
+    Number of files, row groups and rows of the dataset.
+
+    :param path: directory of the dataset
+    :return: dictionary of counts
+    """
+    dataset = crashDataset(path)
+    summary = {'files': 0, 'row_groups': 0, 'rows': 0}
+    for file_path in dataset.files:
+        metadata = pq.ParquetFile(file_path).metadata
+        summary['files'] += 1
+        summary['row_groups'] += metadata.num_row_groups
+        summary['rows'] += metadata.num_rows
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the raw crash csv to a partitioned Parquet dataset")
+    parser.add_argument('--csv', default=None,
+                        help="csv file, the raw data in the working dir by default")
+    parser.add_argument('--output', default=PARQUET_DIR)
+    args = parser.parse_args()
+
+    convertCsv(args.csv, args.output)
+    print(f"== {datasetSummary(args.output)} ==")
+
+
+if __name__ == "__main__":
+    main()
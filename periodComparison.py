@@ -0,0 +1,283 @@
+"""
+Filename : periodComparison.py
+Author : Archit Joshi, Parth Sethia
+Description : Period-over-period comparison of crash counts. Any number of
+date periods are compared on any set of dimensions in one grouped pass, in
+postgres or over an already loaded dataframe, and the counts come back with
+the delta and percent change of every period against a baseline period.
+Language : python3
+"""
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from psycopg2 import sql
+from cleanData import cleanTableFilter
+from dataAccess import (PERIOD_EXPRESSIONS, VEHICLE_COLUMNS, FACTOR_COLUMNS,
+                        periodKey)
+from queryCache import cachedRows
+
+# A date range compared against others, both dates are included
+Period = namedtuple('Period', ['label', 'start_date', 'end_date'])
+
+# Time frames as the hour each one starts at (the last boundary closes the
+# day) and their names
+TIME_FRAME_BOUNDARIES = [0, 6, 12, 18, 24]
+TIME_FRAME_LABELS = ['Night', 'Morning', 'Afternoon', 'Evening']
+
+# Dimensions with one value per vehicle of a crash, unnested from these
+# columns so that every vehicle counts once
+MULTI_VALUED = {
+    'vehicle_type': VEHICLE_COLUMNS,
+    'contributing_factor': FACTOR_COLUMNS,
+}
+
+
+def timeFrameCase(boundaries=TIME_FRAME_BOUNDARIES, labels=TIME_FRAME_LABELS):
+    """
+    Helper function to build the CASE expression naming the time frame of
+    crash_time.
+
+    :param boundaries: hours at which each time frame starts, plus 24
+    :param labels: name of each time frame
+    :return: sql expression string
+    """
+    hour = PERIOD_EXPRESSIONS['hour']
+    return "CASE " + " ".join(f"WHEN {hour} < {end} THEN '{label}'"
+                              for end, label in zip(boundaries[1:], labels)) + " END"
+
+
+# SQL expression of every dimension counts can be compared on
+DIMENSIONS = {
+    'zip_code': "zip_code",
+    **PERIOD_EXPRESSIONS,
+    'time_frame': timeFrameCase(),
+    # ISO day of week, 1 is Monday
+    'day_of_week': "extract(isodow from crash_date)::int",
+    'vehicle_type': "lower(vehicle_type)",
+    'contributing_factor': "lower(contributing_factor)",
+}
+
+
+def countColumn(label):
+    """
+    Helper function naming the count column of a period.
+
+    :param label: period label
+    :return: column name
+    """
+    return f"count_{label}"
+
+
+def checkDimensions(dimensions):
+    """
+    Helper function to reject dimensions the engine doesn't know.
+
+    :param dimensions: list of dimension names
+    :return: None
+    """
+    unknown = set(dimensions) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError(f"Unknown comparison dimensions : {sorted(unknown)}")
+
+
+def periodChanges(comparison, labels, baseline=None):
+    """
+    Add the delta and percent change of every period against the baseline
+    period, vectorized over all rows of the comparison. The percent change is
+    NaN where the baseline count is zero.
+
+    :param comparison: dataframe with a count column per period
+    :param labels: period labels in order
+    :param baseline: label of the baseline period, the first one if None
+    :return: the comparison with delta_<label> and pct_change_<label> columns
+    """
+    baseline = labels[0] if baseline is None else baseline
+    base = comparison[countColumn(baseline)]
+    for label in labels:
+        if label == baseline:
+            continue
+        delta = comparison[countColumn(label)] - base
+        comparison[f"delta_{label}"] = delta
+        comparison[f"pct_change_{label}"] = (delta * 100.0 /
+                                             base.where(base > 0)).round(1)
+    return comparison
+
+
+def periodFilter(periods, borough=None):
+    """
+    Helper function to build the WHERE clause selecting the crashes of the
+    periods. The bounds of the first and the last period let postgres prune
+    the monthly partitions, the per-period ranges skip the gaps between them.
+
+    :param periods: list of Period
+    :param borough: borough to analyse, all boroughs if None
+    :return: (where clause, query parameters) tuple
+    """
+    where_clause, parameters = cleanTableFilter(
+        borough, min(period.start_date for period in periods),
+        max(period.end_date for period in periods))
+    ranges = " or ".join("crash_date between %s and %s" for _ in periods)
+    return (f"{where_clause} and ({ranges})",
+            parameters + tuple(value for period in periods
+                               for value in (period.start_date, period.end_date)))
+
+
+def comparePeriods(connection, periods, dimensions, borough=None,
+                   baseline=None):
+    """
+    Count crashes of every period grouped by the dimensions in a single
+    grouped scan of clean_nyc_crashes. Every period is a filtered count of the
+    same aggregation and only the crashes of the periods are read.
+
+    :param connection: database connection object
+    :param periods: list of Period, non-overlapping
+    :param dimensions: list of dimension names, see DIMENSIONS
+    :param borough: borough to analyse, all boroughs if None
+    :param baseline: label of the baseline period, the first one if None
+    :return: dataframe of dimensions, counts, deltas and percent changes
+    """
+    checkDimensions(dimensions)
+    labels = [period.label for period in periods]
+    where_clause, parameters = periodFilter(periods, borough)
+
+    sources = [sql.SQL("clean_nyc_crashes")]
+    conditions = [sql.SQL(where_clause[len("where "):])]
+    for dimension in dimensions:
+        if dimension in MULTI_VALUED:
+            sources.append(sql.SQL("CROSS JOIN LATERAL unnest(ARRAY[{}]) AS {}({})").format(
+                sql.SQL(", ").join(sql.Identifier(column)
+                                   for column in MULTI_VALUED[dimension]),
+                sql.Identifier(f"{dimension}_values"), sql.Identifier(dimension)))
+            conditions.append(sql.SQL("{} IS NOT NULL").format(
+                sql.Identifier(dimension)))
+        else:
+            # Crashes without a value, e.g. no zip code or time (the time
+            # frame CASE has no ELSE), aren't counted, as in the frame path
+            conditions.append(sql.SQL(f"{DIMENSIONS[dimension]} IS NOT NULL"))
+
+    keys = sql.SQL(", ").join(
+        sql.SQL(f"{DIMENSIONS[dimension]} AS {{}}").format(sql.Identifier(dimension))
+        for dimension in dimensions)
+    counts = sql.SQL(", ").join(
+        sql.SQL("count(*) FILTER (WHERE crash_date BETWEEN %s AND %s) AS {}")
+        .format(sql.Identifier(countColumn(period.label)))
+        for period in periods)
+    positions = sql.SQL(", ").join(sql.Literal(position)
+                                   for position in range(1, len(dimensions) + 1))
+    query = sql.SQL("SELECT {}, {} FROM {} WHERE {} GROUP BY {} ORDER BY {}").format(
+        keys, counts, sql.SQL(" ").join(sources),
+        sql.SQL(" and ").join(conditions), positions, positions)
+
+    period_parameters = tuple(value for period in periods
+                              for value in (period.start_date, period.end_date))
+    rows = cachedRows(connection, query, period_parameters + parameters)
+    comparison = pd.DataFrame.from_records(
+        rows, columns=list(dimensions) + [countColumn(label) for label in labels])
+    return periodChanges(comparison, labels, baseline)
+
+
+def categorize_time_frame(hours, boundaries=TIME_FRAME_BOUNDARIES,
+                          labels=TIME_FRAME_LABELS):
+    """
+    Function to categorize the time into time frames. The hours are binned in
+    one vectorized pass instead of a python call per row.
+    :param hours: series of hours of the day based on 24 hrs clock
+    :param boundaries: hours at which each time frame starts, plus 24
+    :param labels: name of each time frame
+    :return: categorical series of time frames
+    """
+    return pd.cut(hours, bins=boundaries, labels=labels, right=False)
+
+
+def dimensionValues(data, dimension):
+    """
+    Helper function computing a single-valued dimension over a loaded
+    dataframe.
+
+    :param data: dataframe returned by loadCrashes
+    :param dimension: dimension name
+    :return: series of dimension values
+    """
+    if dimension == 'time_frame':
+        return categorize_time_frame(periodKey(data, 'hour'))
+    if dimension == 'day_of_week':
+        return data['crash_date'].dt.dayofweek + 1
+    return periodKey(data, dimension)
+
+
+def periodCodes(crash_dates, periods):
+    """
+    Position of the period every crash date falls in, by binary search over
+    the period start dates.
+
+    :param crash_dates: series of crash dates
+    :param periods: list of Period, non-overlapping
+    :return: array of period positions, -1 outside every period
+    """
+    starts = np.array([period.start_date for period in periods],
+                      dtype='datetime64[D]')
+    ends = np.array([period.end_date for period in periods],
+                    dtype='datetime64[D]') + np.timedelta64(1, 'D')
+    order = np.argsort(starts)
+    dates = crash_dates.to_numpy().astype('datetime64[D]')
+    candidate = np.searchsorted(starts[order], dates, side='right') - 1
+    positions = order[np.maximum(candidate, 0)]
+    inside = (candidate >= 0) & (dates < ends[positions])
+    return np.where(inside, positions, -1)
+
+
+def comparePeriodsFrame(data, periods, dimensions, baseline=None):
+    """
+    Same comparison as comparePeriods over an already loaded dataframe, in
+    one vectorized groupby. Rows are assigned to periods by interval lookup,
+    so the data is never filtered into a copy per period.
+
+    :param data: dataframe returned by loadCrashes holding crash_date and the
+    columns the dimensions are computed from
+    :param periods: list of Period, non-overlapping
+    :param dimensions: list of dimension names, see DIMENSIONS
+    :param baseline: label of the baseline period, the first one if None
+    :return: dataframe of dimensions, counts, deltas and percent changes
+    """
+    checkDimensions(dimensions)
+    labels = [period.label for period in periods]
+    keys = pd.DataFrame({'row': np.arange(len(data)),
+                         'period': periodCodes(data['crash_date'], periods)})
+    for dimension in dimensions:
+        if dimension not in MULTI_VALUED:
+            keys[dimension] = dimensionValues(data, dimension).to_numpy()
+    keys = keys[keys['period'] >= 0]
+    # One row per vehicle for multi-valued dimensions
+    for dimension in dimensions:
+        if dimension in MULTI_VALUED:
+            values = pd.concat([pd.DataFrame({
+                'row': np.arange(len(data)),
+                dimension: data[column].str.lower().to_numpy()})
+                for column in MULTI_VALUED[dimension]])
+            keys = keys.merge(values.dropna(), on='row')
+    keys = keys.dropna(subset=list(dimensions))
+
+    counts = keys.groupby(list(dimensions) + ['period'], observed=True).size() \
+        .unstack('period', fill_value=0) \
+        .reindex(columns=range(len(periods)), fill_value=0)
+    counts.columns = [countColumn(label) for label in labels]
+    return periodChanges(counts.reset_index(), labels, baseline)
+
+
+def rollUp(comparison, dimensions, baseline=None):
+    """
+    Sum a comparison over every dimension not kept, e.g. zip_code x month
+    into zip_code, and recompute the changes. Saves another pass over the
+    data for a coarser comparison.
+
+    :param comparison: dataframe returned by comparePeriods
+    :param dimensions: dimensions to keep
+    :param baseline: label of the baseline period, the first one if None
+    :return: coarser comparison dataframe
+    """
+    count_columns = [column for column in comparison.columns
+                     if column.startswith("count_")]
+    labels = [column[len("count_"):] for column in count_columns]
+    counts = comparison.groupby(dimensions, observed=True)[count_columns] \
+        .sum().reset_index()
+    return periodChanges(counts, labels, baseline)
@@ -0,0 +1,120 @@
+"""
+Filename : pipelineState.py
+Author : Archit Joshi, Parth Sethia
+Description : Small key/value metadata table remembering pipeline state such
+as the ingest high-water mark and the version stamp of the clean table.
+Language : python3
+"""
+import os
+import uuid
+import hashlib
+
+
+def createStateTable(connection):
+    """
+    Create the pipeline_state metadata table if it doesn't exist.
+
+    :param connection: database connection object
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pipeline_state (
+                key varchar PRIMARY KEY,
+                value varchar,
+                updated_at timestamptz DEFAULT now()
+            )
+        """)
+        connection.commit()
+
+
+def getState(connection, key):
+    """
+    Read a value from the pipeline_state table.
+
+    :param connection: database connection object
+    :param key: state key
+    :return: stored value or None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT value FROM pipeline_state WHERE key = %s", (key,))
+        result = cursor.fetchone()
+    return result[0] if result else None
+
+
+def setState(connection, key, value):
+    """
+    Write a value to the pipeline_state table. Doesn't commit so that the
+    state moves together with the data it describes.
+
+    :param connection: database connection object
+    :param key: state key
+    :param value: value to store, None stores NULL
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO pipeline_state (key, value, updated_at)
+            VALUES (%s, %s, now())
+            ON CONFLICT (key) DO UPDATE
+            SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+        """, (key, None if value is None else str(value)))
+
+
+def fileSignature(path):
+    """
+    Signature of a source file from its size and modification time, cheap
+    enough to check on every run without reading the file.
+
+    :param path: path of the file
+    :return: signature string
+    """
+    status = os.stat(path)
+    return f"{os.path.abspath(path)}:{status.st_size}:{status.st_mtime_ns}"
+
+
+def bumpCleanVersion(connection):
+    """
+    Stamp clean_nyc_crashes with a new version. Called whenever the cleaning
+    stage rewrites the table so that caches keyed on the version go stale.
+    Doesn't commit.
+
+    :param connection: database connection object
+    :return: the new version stamp
+    """
+    version = uuid.uuid4().hex
+    setState(connection, 'clean_nyc_crashes.version', version)
+    return version
+
+
+def getCleanVersion(connection):
+    """
+    Read the version stamp of clean_nyc_crashes.
+
+    :param connection: database connection object
+    :return: version stamp or None if the table was never stamped
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM information_schema.tables "
+                       "WHERE table_name = 'pipeline_state')")
+        exists = cursor.fetchone()[0]
+    return getState(connection, 'clean_nyc_crashes.version') if exists else None
+
+
+def tableVersion(connection):
+    """
+    Version stamp of clean_nyc_crashes, read on every call so that a bump by
+    another process is seen right away. Tables cleaned before version stamps
+    existed are fingerprinted by row count and max crash_date/collision_id.
+
+    :param connection: database connection object
+    :return: version string
+    """
+    version = getCleanVersion(connection)
+    if version is not None:
+        return version
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT count(*), max(crash_date), max(collision_id) "
+                       "FROM clean_nyc_crashes")
+        fingerprint = "-".join(str(value) for value in cursor.fetchone())
+    return hashlib.sha1(fingerprint.encode()).hexdigest()
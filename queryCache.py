@@ -0,0 +1,159 @@
+"""
+Filename : queryCache.py
+Author : Archit Joshi, Parth Sethia
+Description : On-disk cache of analysis query results, keyed on the query,
+its parameters and the version stamp of clean_nyc_crashes. Repeated answers
+to the README questions are read from a local file while the clean table is
+unchanged. Entries expire after QUERY_CACHE_TTL seconds, the least recently
+used ones are evicted beyond QUERY_CACHE_MAX_ENTRIES and the cleaning stage
+clears the cache when it rewrites the table.
+Language : python3
+"""
+import os
+import glob
+import json
+import time
+import pickle
+import hashlib
+from psycopg2 import sql
+import config_template
+import dbConnection
+import pipelineState
+import duckdbBackend
+
+# Next to the dataframe cache of dataCache
+QUERY_CACHE_DIR = os.path.join("cache", "queries")
+
+
+def queryText(connection, query):
+    """
+    Helper function to render a query as SQL text for the cache key.
+
+    :param connection: database connection object
+    :param query: sql.Composable or string
+    :return: SQL string
+    """
+    if not isinstance(query, sql.Composable):
+        return query
+    if dbConnection.embedded():
+        return duckdbBackend.composableString(query)
+    return query.as_string(connection)
+
+
+def cacheKey(text, parameters, version):
+    """
+    Helper function to hash a query, its parameters, the database it runs on
+    and the clean table version into the cache key.
+
+    :param text: SQL text of the query
+    :param parameters: query parameters
+    :param version: clean table version stamp
+    :return: hex digest
+    """
+    database = dbConnection.duckdbPath() if dbConnection.embedded() else \
+        f"{config_template.HOST}:{config_template.PORT}/{config_template.DB_NAME}"
+    request = json.dumps([database, " ".join(text.split()),
+                          [str(value) for value in parameters or ()], version])
+    return hashlib.sha1(request.encode()).hexdigest()
+
+
+def readEntry(path, ttl):
+    """
+    Read a cached result unless it is missing or older than the TTL. A hit
+    touches the file, the modification times order entries by last use.
+
+    :param path: path of the entry
+    :param ttl: time to live in seconds, None for no expiry
+    :return: cached rows, None on a miss
+    """
+    try:
+        with open(path, 'rb') as entry_file:
+            entry = pickle.load(entry_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    try:
+        if ttl is not None and time.time() - entry['created'] > ttl:
+            os.remove(path)
+            return None
+        os.utime(path)
+    except FileNotFoundError:
+        # Evicted by another process in the meantime
+        pass
+    return entry['rows']
+
+
+def writeEntry(path, rows, cache_dir, max_entries):
+    """
+    Write a result to the cache and evict the least recently used entries
+    beyond max_entries. The entry is written to a temporary file first so
+    concurrent readers never see a partial one.
+
+    :param path: path of the entry
+    :param rows: query result rows
+    :param cache_dir: directory holding the entries
+    :param max_entries: maximum number of entries kept
+    :return: None
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as entry_file:
+        pickle.dump({'created': time.time(), 'rows': rows}, entry_file)
+    os.replace(temporary, path)
+
+    entries = glob.glob(os.path.join(cache_dir, "*.pkl"))
+    if len(entries) > max_entries:
+        entries.sort(key=lambda entry: os.path.getmtime(entry))
+        for stale in entries[:len(entries) - max_entries]:
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                # Evicted by another process in the meantime
+                pass
+
+
+def cachedRows(connection, query, parameters=None, version=None,
+               cache_dir=QUERY_CACHE_DIR):
+    """
+    Rows of a query on the clean data, from the cache when the same query
+    with the same parameters already ran against the current version of
+    clean_nyc_crashes, otherwise from the database, refreshing the cache.
+
+    :param connection: database connection object
+    :param query: sql.Composable or string
+    :param parameters: query parameters
+    :param version: clean table version stamp, looked up if None
+    :param cache_dir: directory holding the entries
+    :return: list of row tuples
+    """
+    if not config_template.QUERY_CACHE:
+        with connection.cursor() as cursor:
+            cursor.execute(query, parameters)
+            return cursor.fetchall()
+
+    version = version or pipelineState.tableVersion(connection)
+    path = os.path.join(cache_dir, cacheKey(queryText(connection, query),
+                                            parameters, version) + ".pkl")
+    rows = readEntry(path, config_template.QUERY_CACHE_TTL)
+    if rows is not None:
+        return rows
+    with connection.cursor() as cursor:
+        cursor.execute(query, parameters)
+        rows = cursor.fetchall()
+    writeEntry(path, rows, cache_dir, config_template.QUERY_CACHE_MAX_ENTRIES)
+    return rows
+
+
+def clear(cache_dir=QUERY_CACHE_DIR):
+    """
+    Drop every cached result, called when the clean table is rewritten.
+
+    :param cache_dir: directory holding the entries
+    :return: number of entries removed
+    """
+    entries = glob.glob(os.path.join(cache_dir, "*.pkl"))
+    for entry in entries:
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
+    return len(entries)
@@ -0,0 +1,158 @@
+"""
+Filename : rollups.py
+Author : Archit Joshi, Parth Sethia
+Description : Indexes and daily/hourly rollup tables over the clean NYC Crash
+data. The dataAnalysis question queries read these pre-aggregated rows instead
+of grouping the whole clean table. Incremental loads only recompute the crash
+dates they touched. Run this script to rebuild them.
+Language : python3
+"""
+import time
+import psycopg2
+import dbConnection
+import duckdbBackend
+from instrumentation import instrumented
+
+INDEXES = {
+    'clean_nyc_crashes_date_idx': "(crash_date)",
+}
+
+# Rollup tables as (name, query, columns of the unique index). {filter}
+# restricts the query to some crash dates when only those are recomputed.
+ROLLUPS = [
+    ('daily_crash_counts', """
+        SELECT crash_date, borough,
+               count(*) AS crash_count,
+               sum(number_of_persons_injured) AS persons_injured,
+               sum(number_of_persons_killed) AS persons_killed
+        FROM clean_nyc_crashes {filter}
+        GROUP BY crash_date, borough
+    """, "(crash_date, borough)"),
+    ('hourly_crash_counts', """
+        SELECT crash_date, borough,
+               extract(hour from crash_time)::smallint AS crash_hour,
+               count(*) AS crash_count
+        FROM clean_nyc_crashes {filter}
+        GROUP BY crash_date, borough, crash_hour
+    """, "(crash_date, borough, crash_hour)"),
+]
+
+
+@instrumented
+def createIndexes(connection):
+    """
+    Create the crash_date index the date range filters of the analysis
+    queries use. Hour and day-of-week questions read the rollups instead.
+    Indexes created on the partitioned table cascade to every monthly
+    partition.
+
+    :param connection: database connection object
+    :return: None
+    """
+    if dbConnection.embedded():
+        # DuckDB prunes its columnar row groups with min/max zone maps
+        return
+    with connection.cursor() as cursor:
+        for name, definition in INDEXES.items():
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} "
+                           f"ON clean_nyc_crashes {definition}")
+        connection.commit()
+    print("== Indexes created on clean_nyc_crashes ==")
+
+
+def dropRollupView(cursor, name):
+    """
+    Helper function to drop a rollup left behind as a materialized view by
+    earlier versions, so a table can take its name.
+
+    :param cursor: database cursor
+    :param name: rollup name
+    :return: None
+    """
+    cursor.execute("SELECT 1 FROM pg_matviews WHERE matviewname = %s", (name,))
+    if cursor.fetchone():
+        cursor.execute(f"DROP MATERIALIZED VIEW {name}")
+
+
+@instrumented
+def createRollups(connection):
+    """
+    Create the rollup tables, populated from the current contents of
+    clean_nyc_crashes. Existing rollups are replaced.
+
+    :param connection: database connection object
+    :return: None
+    """
+    if dbConnection.embedded():
+        for name, query, _ in ROLLUPS:
+            duckdbBackend.createRollup(connection, name, query.format(filter=""))
+        print("== Rollup tables created ==")
+        return
+    with connection.cursor() as cursor:
+        for name, query, unique_columns in ROLLUPS:
+            dropRollupView(cursor, name)
+            cursor.execute(f"DROP TABLE IF EXISTS {name}")
+            cursor.execute(f"CREATE TABLE {name} AS {query.format(filter='')}")
+            cursor.execute(f"CREATE UNIQUE INDEX {name}_key ON {name} {unique_columns}")
+        connection.commit()
+    print("== Rollup tables created ==")
+
+
+@instrumented
+def refreshRollups(connection):
+    """
+    Recompute every row of the rollup tables. Readers keep seeing the old
+    rows until the rebuild of each table commits.
+
+    :param connection: database connection object
+    :return: None
+    """
+    if dbConnection.embedded():
+        # Rollups are plain tables on the embedded backend, rebuild them
+        for name, query, _ in ROLLUPS:
+            duckdbBackend.createRollup(connection, name, query.format(filter=""))
+        return
+    with connection.cursor() as cursor:
+        for name, query, _ in ROLLUPS:
+            start = time.perf_counter()
+            try:
+                cursor.execute(f"DELETE FROM {name}")
+                cursor.execute(f"INSERT INTO {name} {query.format(filter='')}")
+                connection.commit()
+            except psycopg2.Error as e:
+                print(f"Error while refreshing {name} : {e}")
+                connection.rollback()
+                return False
+            print(f"== {name} refreshed in {time.perf_counter() - start:.2f}s ==")
+
+
+def updateRollups(connection, dates_table):
+    """
+    Recompute the rollup rows of the crash dates listed in dates_table only,
+    after a delta was merged into clean_nyc_crashes. Rollups that don't exist
+    yet are created from the whole clean table. Doesn't commit, the caller
+    commits together with the delta.
+
+    :param connection: database connection object
+    :param dates_table: table with a crash_date column of the touched dates
+    :return: None
+    """
+    touched = f"WHERE crash_date IN (SELECT crash_date FROM {dates_table})"
+    with connection.cursor() as cursor:
+        for name, query, unique_columns in ROLLUPS:
+            dropRollupView(cursor, name)
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {name} AS {query.format(filter='')}")
+            cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}_key "
+                           f"ON {name} {unique_columns}")
+            cursor.execute(f"DELETE FROM {name} {touched}")
+            cursor.execute(f"INSERT INTO {name} {query.format(filter=touched)}")
+
+
+def main():
+    with dbConnection.pooledConnection() as conn:
+        createIndexes(conn)
+        createRollups(conn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Filename : scheduler.py
+Author : Archit Joshi, Parth Sethia
+Description : Small DAG scheduler for the visualisation and analysis stages.
+Stages whose dependencies are done run concurrently, CPU-bound stages in a
+process pool and database-bound stages in a thread pool, and every stage is
+timed and instrumented. Interactive chart windows can only be opened from the
+main thread, so chart stages run there unless the run is headless.
+Language : python3
+"""
+import time
+from collections import namedtuple
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                FIRST_COMPLETED, wait)
+import config_template
+import chartOutput
+import instrumentation
+
+# A unit of work. kind is 'process' for CPU-bound stages, 'thread' for stages
+# that mostly wait on the database and 'main' for stages run one at a time on
+# the calling thread.
+Stage = namedtuple('Stage', ['name', 'function', 'args', 'kwargs',
+                             'depends_on', 'kind'])
+
+
+def stage(name, function, *args, depends_on=(), kind=None, **kwargs):
+    """
+    Helper function to declare a stage. Stages that may draw charts default
+    to worker processes in headless mode and to the calling thread when the
+    charts are shown in a window.
+
+    :param name: unique stage name
+    :param function: module level function to run
+    :param args: positional arguments of the function, pickled to the worker
+    of a process stage so keep them small
+    :param depends_on: names of the stages that must finish first
+    :param kind: 'process', 'thread' or 'main', see above if None
+    :param kwargs: keyword arguments of the function
+    :return: Stage
+    """
+    if kind is None:
+        kind = 'process' if config_template.HEADLESS else 'main'
+    return Stage(name, function, args, kwargs, tuple(depends_on), kind)
+
+
+def timedCall(name, function, args, kwargs, collect):
+    """
+    Run a stage function and measure its wall time, runs inside the worker.
+    Charts the stage queued in headless mode are written before it counts as
+    finished.
+
+    :param name: stage name
+    :param function: stage function
+    :param args: positional arguments
+    :param kwargs: keyword arguments
+    :param collect: return the instrumentation records of the stage, for
+    stages running in another process
+    :return: (return value, elapsed seconds, instrumentation records) tuple
+    """
+    mark = instrumentation.recordCount()
+    start = time.perf_counter()
+    if instrumentation.enabled():
+        with instrumentation.stage(name):
+            result = function(*args, **kwargs)
+            chartOutput.flushFigures()
+    else:
+        result = function(*args, **kwargs)
+        chartOutput.flushFigures()
+    elapsed = time.perf_counter() - start
+    return result, elapsed, instrumentation.recordsSince(mark) if collect else []
+
+
+def runStages(stages, workers=None):
+    """
+    Run stages as soon as all of their dependencies have finished, in a
+    process pool or a thread pool of the given size depending on their kind,
+    or on the calling thread while the pooled stages keep running. Per-stage
+    timings and the end-to-end wall time are logged.
+
+    :param stages: list of Stage
+    :param workers: worker count of each pool, defaults to the cpu count
+    :return: (dictionary of stage name to return value, dictionary of stage
+    name to elapsed seconds) tuple
+    """
+    by_name = {item.name: item for item in stages}
+    for item in stages:
+        missing = set(item.depends_on) - set(by_name)
+        if missing:
+            raise ValueError(f"Stage {item.name} depends on unknown stages {sorted(missing)}")
+
+    results, timings = {}, {}
+    pending = list(stages)
+    running = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as processes, \
+            ThreadPoolExecutor(max_workers=workers) as threads:
+        pools = {'process': processes, 'thread': threads}
+        while pending or running:
+            # Submit every stage whose dependencies are done
+            ready = [item for item in pending
+                     if all(name in results for name in item.depends_on)]
+            for item in ready:
+                pending.remove(item)
+                if item.kind == 'main':
+                    continue
+                future = pools[item.kind].submit(timedCall, item.name,
+                                                 item.function, item.args,
+                                                 item.kwargs,
+                                                 item.kind == 'process')
+                running[future] = item.name
+            # Then run the ready stages of the calling thread
+            for item in [item for item in ready if item.kind == 'main']:
+                results[item.name], timings[item.name], _ = timedCall(
+                    item.name, item.function, item.args, item.kwargs, False)
+                print(f"== Stage {item.name} finished in {timings[item.name]:.2f}s ==")
+            if not running:
+                if ready:
+                    continue
+                raise ValueError(f"Stages {[item.name for item in pending]} "
+                                 f"have circular dependencies")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], timings[name], records = future.result()
+                instrumentation.addRecords(records)
+                print(f"== Stage {name} finished in {timings[name]:.2f}s ==")
+
+    elapsed = time.perf_counter() - start
+    print(f"== {len(stages)} stages finished in {elapsed:.2f}s "
+          f"(sum of stages {sum(timings.values()):.2f}s) ==")
+    return results, timings
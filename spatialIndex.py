@@ -0,0 +1,239 @@
+"""
+Filename : spatialIndex.py
+Author : Archit Joshi, Parth Sethia
+Description : Typed point column and spatial index on clean_nyc_crashes, and
+bounding-box and radius lookups answered by the index instead of pulling
+every point to the client. Uses a PostGIS geography column when the
+extension is available and the built-in point type otherwise, both indexed
+with GiST.
+Language : python3
+"""
+import time
+import argparse
+from math import cos, radians
+import psycopg2
+from psycopg2 import sql
+import config_template
+import dbConnection
+import cleanData
+import dataAccess
+
+SPATIAL_COLUMN = 'crash_point'
+SPATIAL_INDEX = 'clean_nyc_crashes_point_idx'
+LOOKUP_COLUMNS = ['collision_id', 'crash_date', 'crash_time', 'latitude',
+                  'longitude']
+
+# Mean earth radius and length of one degree of latitude in metres
+EARTH_RADIUS_M = 6371008.8
+METRES_PER_DEGREE = 111320.0
+
+# Column definition per storage, the built-in point is (longitude, latitude)
+# like the PostGIS one
+SPATIAL_TYPES = {
+    'geography': ("geography(Point, 4326)",
+                  "ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)::geography"),
+    'point': ("point", "point(longitude, latitude)"),
+}
+
+# Great-circle distance in metres from the centre given as (latitude,
+# latitude, longitude) parameters, for the built-in point storage
+HAVERSINE = f"""
+    2 * {EARTH_RADIUS_M} * asin(sqrt(
+        power(sin(radians(latitude - %s) / 2), 2) +
+        cos(radians(%s)) * cos(radians(latitude)) *
+        power(sin(radians(longitude - %s) / 2), 2)))
+"""
+
+
+def postgisAvailable(connection):
+    """
+    Helper function to enable PostGIS if it is installed on the server.
+    Tried inside a savepoint so a missing extension doesn't abort the
+    caller's transaction.
+
+    :param connection: database connection object
+    :return: True if PostGIS is enabled
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SAVEPOINT postgis_check")
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+        except psycopg2.Error:
+            cursor.execute("ROLLBACK TO SAVEPOINT postgis_check")
+            return False
+        cursor.execute("RELEASE SAVEPOINT postgis_check")
+    return True
+
+
+def addSpatialColumn(connection):
+    """
+    Add the generated point column and its GiST index to clean_nyc_crashes
+    if they don't exist. The column is computed from latitude and longitude
+    when rows are inserted, so cleaning needs no extra step. Doesn't commit.
+
+    :param connection: database connection object
+    :return: 'geography' or 'point', the storage used
+    """
+    storage = spatialStorage(connection)
+    if storage is None:
+        storage = 'geography' if postgisAvailable(connection) else 'point'
+        column_type, expression = SPATIAL_TYPES[storage]
+        with connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE clean_nyc_crashes ADD COLUMN "
+                           f"{SPATIAL_COLUMN} {column_type} "
+                           f"GENERATED ALWAYS AS ({expression}) STORED")
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {SPATIAL_INDEX} "
+                       f"ON clean_nyc_crashes USING gist ({SPATIAL_COLUMN})")
+    return storage
+
+
+def spatialStorage(connection):
+    """
+    Type of the point column of clean_nyc_crashes.
+
+    :param connection: database connection object
+    :return: 'geography', 'point' or None if the column doesn't exist
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT udt_name FROM information_schema.columns "
+                       "WHERE table_name = 'clean_nyc_crashes' AND column_name = %s",
+                       (SPATIAL_COLUMN,))
+        result = cursor.fetchone()
+    return result[0] if result else None
+
+
+def spatialLookup(connection, spatial_condition, spatial_parameters, columns,
+                  borough, start_date, end_date, distance=None,
+                  distance_parameters=(), radius_m=None):
+    """
+    Helper function to run a lookup filtered by a spatial condition the
+    GiST index answers, plus the usual borough and date filter.
+
+    :param connection: database connection object
+    :param spatial_condition: sql condition on the point column
+    :param spatial_parameters: parameters of the condition
+    :param columns: clean table columns to return
+    :param borough: borough filter, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
+    :param distance: sql expression of the distance in metres, also returned
+    as distance_m and used to order the rows
+    :param distance_parameters: parameters of the distance expression
+    :param radius_m: maximum distance in metres
+    :return: dataframe of the matching crashes
+    """
+    where_clause, parameters = cleanData.cleanTableFilter(borough, start_date,
+                                                          end_date)
+    conditions = [where_clause[len("where "):]] if where_clause else []
+    conditions.append(spatial_condition)
+    query = sql.SQL("SELECT {} FROM clean_nyc_crashes WHERE {}").format(
+        dataAccess.selectList(columns), sql.SQL(" and ".join(conditions)))
+    query_parameters = parameters + tuple(spatial_parameters)
+    if distance is not None:
+        # Rank the candidates the index returns by their exact distance
+        query = sql.SQL("SELECT * FROM (SELECT {}, {} AS distance_m FROM "
+                        "clean_nyc_crashes WHERE {}) AS nearby "
+                        "WHERE distance_m <= %s ORDER BY distance_m").format(
+            dataAccess.selectList(columns), sql.SQL(distance),
+            sql.SQL(" and ".join(conditions)))
+        query_parameters = tuple(distance_parameters) + query_parameters + \
+            (radius_m,)
+
+    start = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute(query, query_parameters)
+        rows = cursor.fetchall()
+    print(f"== {len(rows)} crashes found in "
+          f"{(time.perf_counter() - start) * 1000:.1f}ms ==")
+    if distance is None:
+        return dataAccess.toFrame(rows, columns)
+    data = dataAccess.toFrame([row[:-1] for row in rows], columns)
+    data['distance_m'] = [float(row[-1]) for row in rows]
+    return data
+
+
+def crashesInBoundingBox(connection, south, west, north, east,
+                         columns=LOOKUP_COLUMNS, borough=None,
+                         start_date=None, end_date=None):
+    """
+    Crashes inside a latitude/longitude bounding box.
+
+    :param connection: database connection object
+    :param south: minimum latitude
+    :param west: minimum longitude
+    :param north: maximum latitude
+    :param east: maximum longitude
+    :param columns: clean table columns to return
+    :param borough: borough filter, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
+    :return: dataframe of the matching crashes
+    """
+    if spatialStorage(connection) == 'geography':
+        condition = (f"{SPATIAL_COLUMN} && "
+                     f"ST_MakeEnvelope(%s, %s, %s, %s, 4326)::geography")
+    else:
+        condition = f"{SPATIAL_COLUMN} <@ box(point(%s, %s), point(%s, %s))"
+    return spatialLookup(connection, condition, (west, south, east, north),
+                         columns, borough, start_date, end_date)
+
+
+def crashesWithinRadius(connection, latitude, longitude, radius_m,
+                        columns=LOOKUP_COLUMNS, borough=None,
+                        start_date=None, end_date=None):
+    """
+    Crashes within a radius of a location, e.g. within 500 m of an
+    intersection in July 2020, nearest first.
+
+    :param connection: database connection object
+    :param latitude: latitude of the centre
+    :param longitude: longitude of the centre
+    :param radius_m: radius in metres
+    :param columns: clean table columns to return
+    :param borough: borough filter, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
+    :return: dataframe of the matching crashes with a distance_m column
+    """
+    if spatialStorage(connection) == 'geography':
+        centre = "ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography"
+        return spatialLookup(
+            connection, f"ST_DWithin({SPATIAL_COLUMN}, {centre}, %s)",
+            (longitude, latitude, radius_m), columns, borough, start_date,
+            end_date, f"ST_Distance({SPATIAL_COLUMN}, {centre})",
+            (longitude, latitude), radius_m)
+
+    # The index narrows the rows down to the box around the circle, the
+    # exact great-circle distance is computed for those only
+    delta_latitude = radius_m / METRES_PER_DEGREE
+    delta_longitude = radius_m / (METRES_PER_DEGREE *
+                                  max(cos(radians(latitude)), 1e-6))
+    return spatialLookup(
+        connection, f"{SPATIAL_COLUMN} <@ box(point(%s, %s), point(%s, %s))",
+        (longitude - delta_longitude, latitude - delta_latitude,
+         longitude + delta_longitude, latitude + delta_latitude),
+        columns, borough, start_date, end_date, HAVERSINE,
+        (latitude, latitude, longitude), radius_m)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the crashes near a location")
+    parser.add_argument('latitude', type=float)
+    parser.add_argument('longitude', type=float)
+    parser.add_argument('--radius', type=float, default=500,
+                        help="radius in metres")
+    parser.add_argument('--borough', default=config_template.BOROUGH)
+    parser.add_argument('--start', default=config_template.START_DATE)
+    parser.add_argument('--end', default=config_template.END_DATE)
+    args = parser.parse_args()
+
+    with dbConnection.pooledConnection() as conn:
+        print(crashesWithinRadius(conn, args.latitude, args.longitude,
+                                  args.radius, borough=args.borough,
+                                  start_date=args.start, end_date=args.end))
+
+
+if __name__ == "__main__":
+    main()
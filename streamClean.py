@@ -0,0 +1,313 @@
+"""
+Filename : streamClean.py
+Author : Archit Joshi, Parth Sethia
+Description : Streaming cleaning of the raw NYC Crash csv for exports too
+large to load at once. The csv is read in chunks by a generator pipeline, the
+cleaning rules of cleanData are applied vectorized to every chunk and the
+clean rows are written incrementally to clean_nyc_crashes or to the Parquet
+dataset of parquetStore. Peak memory is bounded by the chunk size rather than
+the size of the export.
+Language : python3
+"""
+import io
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+import dbConnection
+import duckdbBackend
+import cleanData
+import createDB
+import parquetStore
+import pipelineState
+import queryCache
+import rollups
+from cleanData import CLEANING_RULES
+
+# Vectorized counterparts of cleanData.CLEANING_RULES, in the same order so
+# that a row is attributed to the same rule in both paths
+FRAME_RULES = {
+    'null_borough': lambda chunk: chunk['borough'].isna(),
+    'null_coordinates': lambda chunk: (chunk['latitude'].isna() |
+                                       chunk['longitude'].isna()),
+    'zero_coordinates': lambda chunk: ((chunk['latitude'] == 0) |
+                                       (chunk['longitude'] == 0)),
+    'null_crash_date': lambda chunk: chunk['crash_date'].isna(),
+}
+
+# pandas dtype of every postgres datatype createDB infers, dates and times
+# are read as text and parsed per chunk
+FRAME_DTYPES = {
+    'date': 'object',
+    'time': 'object',
+    'double precision': 'float64',
+    'smallint': 'Int16',
+    'bigint': 'Int64',
+    'varchar': 'object',
+}
+
+
+def readRawChunks(path, chunk_size=createDB.CHUNK_SIZE):
+    """
+    Generator streaming the raw csv in typed chunks with the column names and
+    dtypes of dataAccess.loadCrashes.
+
+    :param path: path of the csv file
+    :param chunk_size: number of rows per chunk
+    :return: yields dataframes
+    """
+    header = createDB.csvHeader(path)
+    names = [createDB.tableColumnName(column) for column in header]
+    dtypes = {name: FRAME_DTYPES[createDB.inferColumnType(column)]
+              for name, column in zip(names, header)}
+    for chunk in pd.read_csv(path, header=0, names=names, dtype=dtypes,
+                             chunksize=chunk_size):
+        # Dates are parsed with each of the raw formats in turn
+        raw_dates = chunk['crash_date']
+        chunk['crash_date'] = pd.NaT
+        for date_format in parquetStore.DATE_FORMATS:
+            chunk['crash_date'] = chunk['crash_date'].fillna(
+                pd.to_datetime(raw_dates, format=date_format, errors='coerce'))
+        chunk['crash_time'] = pd.to_timedelta(chunk['crash_time'] + ':00',
+                                              errors='coerce')
+        yield chunk
+
+
+def rangeRules(borough=None, start_date=None, end_date=None):
+    """
+    Helper function to build the rules restricting the clean output to a
+    borough and date range, checked after the cleaning rules.
+
+    :param borough: borough to keep, all boroughs if None
+    :param start_date: first crash_date to keep, unbounded if None
+    :param end_date: last crash_date to keep, unbounded if None
+    :return: dictionary of rule name to vectorized condition
+    """
+    rules = {}
+    if borough is not None:
+        rules['other_borough'] = lambda chunk: chunk['borough'] != borough
+    if start_date is not None:
+        rules['before_start_date'] = \
+            lambda chunk: chunk['crash_date'] < pd.Timestamp(start_date)
+    if end_date is not None:
+        rules['after_end_date'] = \
+            lambda chunk: chunk['crash_date'] > pd.Timestamp(end_date)
+    return rules
+
+
+def cleanChunks(chunks, report, rules=FRAME_RULES):
+    """
+    Generator applying the cleaning rules to every chunk. Every rule is one
+    vectorized mask over the chunk and each rejected row is counted against
+    the first rule that rejects it.
+
+    :param chunks: iterable of raw dataframes
+    :param report: dictionary of rule name to number of rejected rows, 'kept'
+    for the number of clean rows, updated as chunks are cleaned
+    :param rules: dictionary of rule name to vectorized condition, in order
+    :return: yields clean dataframes
+    """
+    names = list(rules)
+    for chunk in chunks:
+        masks = [rule(chunk).fillna(False).to_numpy(bool) for rule in rules.values()]
+        rejected_by = np.select(masks, np.arange(len(names)), default=-1)
+        counts = np.bincount(rejected_by + 1, minlength=len(names) + 1)
+        report['kept'] = report.get('kept', 0) + int(counts[0])
+        for name, count in zip(names, counts[1:]):
+            report[name] = report.get(name, 0) + int(count)
+        yield chunk[rejected_by == -1]
+
+
+def serialiseChunk(chunk):
+    """
+    Helper function to render dates and times of a clean chunk as ISO text,
+    the form COPY and the embedded backend read them in.
+
+    :param chunk: clean dataframe
+    :return: dataframe with text crash_date and crash_time
+    """
+    chunk = chunk.copy()
+    chunk['crash_date'] = chunk['crash_date'].dt.strftime('%Y-%m-%d')
+    chunk['crash_time'] = (pd.Timestamp(0) + chunk['crash_time']).dt.strftime('%H:%M:%S')
+    return chunk
+
+
+def databaseSink(connection, chunks):
+    """
+    Write clean chunks to clean_nyc_crashes as they arrive, creating the
+    monthly partitions of each chunk before it is sent with COPY FROM STDIN.
+    Doesn't commit.
+
+    :param connection: database connection object
+    :param chunks: iterable of clean dataframes
+    :return: number of rows written
+    """
+    rows = 0
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        if dbConnection.embedded():
+            duckdbBackend.appendFrame(connection, 'clean_nyc_crashes',
+                                      serialiseChunk(chunk))
+        else:
+            cleanData.createMonthlyPartitions(connection,
+                                              chunk['crash_date'].min().date(),
+                                              chunk['crash_date'].max().date())
+            buffer = io.StringIO()
+            serialiseChunk(chunk).to_csv(buffer, header=False, index=False)
+            buffer.seek(0)
+            with connection.cursor() as cursor:
+                # The generated point column is left out of the column list
+                cursor.copy_expert(sql.SQL("COPY clean_nyc_crashes ({}) FROM STDIN "
+                                           "WITH (FORMAT csv)").format(
+                    sql.SQL(", ").join(sql.Identifier(column)
+                                       for column in chunk.columns)), buffer)
+        rows += len(chunk)
+    return rows
+
+
+def createEmptyCleanTable(connection, path):
+    """
+    Replace clean_nyc_crashes by an empty table. The raw table is only
+    created, empty, when it doesn't exist since the clean table copies its
+    columns. Doesn't commit.
+
+    :param connection: database connection object
+    :param path: path of the csv file
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM information_schema.tables "
+                       "WHERE lower(table_name) = 'nyc_crashes'")
+        raw_exists = cursor.fetchone()[0] > 0
+    if not raw_exists:
+        createDB.createSchema(connection, path)
+    cleanData.wipeOldTable(connection)
+    if dbConnection.embedded():
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TABLE clean_nyc_crashes AS "
+                           "SELECT * FROM nyc_crashes WHERE false")
+    else:
+        # Monthly partitions are created chunk by chunk
+        cleanData.createCleanTable(connection, source_table='clean_nyc_crashes')
+
+
+def streamToDatabase(connection, path=None, chunk_size=createDB.CHUNK_SIZE,
+                     borough=None, start_date=None, end_date=None):
+    """
+    Clean the raw csv into clean_nyc_crashes chunk by chunk without loading
+    it into nyc_crashes first, then stamp, index and roll up the clean table
+    like cleanData does.
+
+    :param connection: database connection object
+    :param path: path of the csv file, defaults to the csv in the working dir
+    :param chunk_size: number of rows per chunk
+    :param borough: borough to keep, all boroughs if None
+    :param start_date: first crash_date to keep, unbounded if None
+    :param end_date: last crash_date to keep, unbounded if None
+    :return: report of rejected rows per rule, False on error
+    """
+    path = path or createDB.csvPath()
+    report = {}
+    rules = {**FRAME_RULES, **rangeRules(borough, start_date, end_date)}
+    try:
+        createEmptyCleanTable(connection, path)
+        databaseSink(connection, cleanChunks(readRawChunks(path, chunk_size),
+                                             report, rules))
+        pipelineState.createStateTable(connection)
+        pipelineState.bumpCleanVersion(connection)
+        if borough is None and start_date is None and end_date is None:
+            pipelineState.setState(connection, 'clean_nyc_crashes.source',
+                                   pipelineState.fileSignature(path))
+        else:
+            # A subset of the csv is never current for a full run
+            pipelineState.setState(connection, 'clean_nyc_crashes.source', None)
+        connection.commit()
+        queryCache.clear()
+    except (psycopg2.Error, OSError, ValueError) as e:
+        print(f"Error encountered while cleaning : {e}")
+        connection.rollback()
+        return False
+    rollups.createIndexes(connection)
+    rollups.createRollups(connection)
+    return report
+
+
+def streamToParquet(path=None, output_dir=parquetStore.PARQUET_DIR,
+                    chunk_size=createDB.CHUNK_SIZE, borough=None,
+                    start_date=None, end_date=None):
+    """
+    Clean the raw csv into the Parquet dataset of parquetStore chunk by
+    chunk, without a database. Memory is bounded by the chunk size and the
+    WRITE_ROWS rows parquetStore collects before writing, check it with
+    benchmark.py --stream-memory.
+
+    :param path: path of the csv file, defaults to the csv in the working dir
+    :param output_dir: directory of the dataset
+    :param chunk_size: number of rows per chunk
+    :param borough: borough to keep, all boroughs if None
+    :param start_date: first crash_date to keep, unbounded if None
+    :param end_date: last crash_date to keep, unbounded if None
+    :return: report of rejected rows per rule
+    """
+    parquetStore.requirePyarrow()
+    path = path or createDB.csvPath()
+    schema = parquetStore.crashSchema(createDB.csvHeader(path))
+    report = {}
+    rules = {**FRAME_RULES, **rangeRules(borough, start_date, end_date)}
+    chunks = cleanChunks(readRawChunks(path, chunk_size), report, rules)
+    parquetStore.writeDataset((parquetStore.frameBatch(chunk, schema)
+                               for chunk in chunks if not chunk.empty),
+                              schema, output_dir)
+    return report
+
+
+def printReport(report, elapsed):
+    """
+    Print the rows kept and rejected by each rule.
+
+    :param report: dictionary returned by streamToDatabase or streamToParquet
+    :param elapsed: seconds the cleaning took
+    :return: None
+    """
+    kept = report.pop('kept', 0)
+    total = kept + sum(report.values())
+    print(f"== Clean data stored, {kept} of {total} rows kept in {elapsed:.1f}s "
+          f"({total / max(elapsed, 1e-9):,.0f} rows/sec) ==")
+    for rule in [rule for rule, _ in CLEANING_RULES] + \
+            [rule for rule in report if rule not in FRAME_RULES]:
+        print(f"   rejected by {rule} : {report.get(rule, 0)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Clean the raw crash csv in chunks of bounded memory")
+    parser.add_argument('--csv', default=None,
+                        help="csv file, the raw data in the working dir by default")
+    parser.add_argument('--sink', choices=['database', 'parquet'],
+                        default='database')
+    parser.add_argument('--output', default=parquetStore.PARQUET_DIR,
+                        help="dataset directory of the parquet sink")
+    parser.add_argument('--chunk-size', type=int, default=createDB.CHUNK_SIZE)
+    parser.add_argument('--borough', default=None)
+    parser.add_argument('--start', default=None)
+    parser.add_argument('--end', default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.sink == 'parquet':
+        report = streamToParquet(args.csv, args.output, args.chunk_size,
+                                 args.borough, args.start, args.end)
+    else:
+        dbConnection.ensureDatabase()
+        with dbConnection.pooledConnection() as conn:
+            report = streamToDatabase(conn, args.csv, args.chunk_size,
+                                      args.borough, args.start, args.end)
+    if report is not False:
+        printReport(report, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
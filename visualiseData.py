@@ -6,97 +6,202 @@ heatmaps and cluster maps.
 Language : python3
 """
 
+import os
+import glob
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import folium
 import psycopg2
+import numpy as np
 import pandas as pd
+from chartOutput import showFigure
 import matplotlib.pyplot as plt
 from branca.colormap import linear
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
 from folium.plugins import HeatMap
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
 import config_template
+import dbConnection
+from dataAccess import loadCrashes
+from cleanData import cleanTableFilter
+from scheduler import runStages, stage
+from instrumentation import instrumented, runReport
+
+# Heatmap grid cell size in degrees (about 100 m in NYC)
+HEATMAP_CELL_SIZE = 0.001
+
+# Cluster maps collapse crashes sharing a location to this many decimals
+# (about 1 m) and draw at most this many distinct locations
+CLUSTER_PRECISION = 5
+CLUSTER_MAX_LOCATIONS = 50000
+
+# Javascript building one marker per [lat, lon, crashes] row in the browser
+CLUSTER_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {crashes: row[2]});
+    marker.bindPopup('Location: ' + row[0] + ', ' + row[1] +
+                     '<br>Crashes: ' + row[2]);
+    return marker;
+}
+"""
 
+# Javascript labelling every cluster with the crashes it holds
+CLUSTER_ICON_FUNCTION = """
+function (cluster) {
+    var crashes = 0;
+    cluster.getAllChildMarkers().forEach(function (marker) {
+        crashes += marker.options.crashes;
+    });
+    var size = crashes < 100 ? 'small' : crashes < 1000 ? 'medium' : 'large';
+    return L.divIcon({
+        html: '<div><span>' + crashes + '</span></div>',
+        className: 'marker-cluster marker-cluster-' + size,
+        iconSize: new L.Point(40, 40)
+    });
+}
+"""
+
+# Fitted k-means centroids are cached here, labels are predicted in batches
+MODEL_CACHE_DIR = "model_cache"
+KMEANS_BATCH_SIZE = 100000
+
+# Lower case vehicle type codes that are counted as another vehicle
+VEHICLE_ALIASES = {'motorcycle': 'bike'}
+
+# Columns of clean_nyc_crashes the maps, clustering and vehicle charts need
+VISUALISE_COLUMNS = ['crash_date', 'latitude', 'longitude',
+                     'vehicle_type_code_1', 'vehicle_type_code_2',
+                     'vehicle_type_code_3', 'vehicle_type_code_4']
 
-def connectDB():
-    """
-    Helper function to connect to a database db_720 to load NYC Crash data to.
-    If database doesn't exist, the function will create the database and
-    re-attempt to establish connection.
 
-    :return: database connection object
+@instrumented
+def connectDB(borough=config_template.BOROUGH,
+              start_date=config_template.START_DATE,
+              end_date=config_template.END_DATE):
     """
-    host = 'localhost'
-    username = 'postgres'
-    password = config_template.DB_PASSWORD
-    port = '5432'
-    database = config_template.DB_NAME
+    Helper function to borrow a pooled database connection and load the
+    clean NYC Crash data for one borough and date range.
 
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
+    :return: clean crash data in a dataframe
+    """
     try:
-        # Attempt to connect to the existing database
-        conn = psycopg2.connect(database=database, user=username,
-                                password=password, host=host,
-                                port=port)
-        data = pd.read_sql("SELECT * FROM clean_nyc_crashes", conn)
-        return data
+        with dbConnection.pooledConnection() as conn:
+            return loadCrashes(conn, VISUALISE_COLUMNS, borough, start_date,
+                               end_date)
     except psycopg2.Error as e:
         print(
             f"Connection error, check credentials or run createDB.py --> {e}")
 
 
-def separateData(data):
+def separateData(data, years=(2019, 2020)):
     """
     Function to split the filtered database data into 2019 and 2020 data for
-    comparison and analysis.
+    comparison and analysis. loadCrashes returns rows ordered by crash_date,
+    so every year is a contiguous block of rows found by binary search and
+    returned as a positional slice of the frame. pandas may or may not copy
+    the data of a slice, treat the slices as read-only and copy one before
+    adding columns to it.
 
     :param data: original data in a dataframe
-    :return: 2019 and 2020 data split
+    :param years: years to split out
+    :return: one slice of data per year
     """
-    data['crash_date'] = pd.to_datetime(data['crash_date'], format='%Y-%m-%d')
-
-    # Create masks to filter data for 2019 and 2020
-    mask_2019 = (data['crash_date'].dt.year == 2019)
-    mask_2020 = (data['crash_date'].dt.year == 2020)
-
-    # Create separate DataFrames for 2019 and 2020
-    data_2019 = data[mask_2019].copy()
-    data_2020 = data[mask_2020].copy()
+    if not data['crash_date'].is_monotonic_increasing:
+        data = data.sort_values('crash_date', kind='stable', ignore_index=True)
+    starts = data['crash_date'].searchsorted(
+        [pd.Timestamp(year, 1, 1) for year in years])
+    ends = data['crash_date'].searchsorted(
+        [pd.Timestamp(year + 1, 1, 1) for year in years])
+    return tuple(data.iloc[start:end] for start, end in zip(starts, ends))
 
-    # Reset index if needed
-    data_2019.reset_index(drop=True, inplace=True)
-    data_2020.reset_index(drop=True, inplace=True)
 
-    return data_2019, data_2020
+def binPoints(latitude, longitude, cell_size=HEATMAP_CELL_SIZE):
+    """
+    Pre-aggregate crash coordinates into a weighted grid, so a heatmap embeds
+    one point per occupied cell instead of one point per crash. Only occupied
+    cells are counted, so memory doesn't depend on how far apart outlying
+    coordinates are.
+
+    :param latitude: array of latitudes
+    :param longitude: array of longitudes
+    :param cell_size: grid cell size in degrees
+    :return: (array of [cell latitude, cell longitude, crash count] rows,
+    total number of crashes) tuple
+    """
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    keep = ~(np.isnan(latitude) | np.isnan(longitude))
+    latitude, longitude = latitude[keep], longitude[keep]
+    if len(latitude) == 0:
+        return np.empty((0, 3)), 0
+
+    # Cell indices aligned to multiples of the cell size, as floor() in SQL
+    cells = np.column_stack([np.floor(latitude / cell_size),
+                             np.floor(longitude / cell_size)])
+    cells, counts = np.unique(cells, axis=0, return_counts=True)
+    bins = np.column_stack([(cells + 0.5) * cell_size, counts])
+    return bins, len(latitude)
+
+
+def binPointsSQL(connection, cell_size=HEATMAP_CELL_SIZE,
+                 borough=config_template.BOROUGH,
+                 start_date=config_template.START_DATE,
+                 end_date=config_template.END_DATE):
+    """
+    Same grid as binPoints but aggregated in postgres, only the occupied cells
+    are sent to the client.
+
+    :param connection: database connection object
+    :param cell_size: grid cell size in degrees
+    :param borough: borough to analyse, all boroughs if None
+    :param start_date: first crash date to include
+    :param end_date: last crash date to include
+    :return: (array of [cell latitude, cell longitude, crash count] rows,
+    total number of crashes) tuple
+    """
+    where_clause, parameters = cleanTableFilter(borough, start_date, end_date)
+    bin_query = f"""
+        SELECT (floor(latitude / %s) + 0.5) * %s AS cell_latitude,
+               (floor(longitude / %s) + 0.5) * %s AS cell_longitude,
+               count(*) AS crash_count
+        FROM clean_nyc_crashes {where_clause}
+        GROUP BY 1, 2
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(bin_query, (cell_size,) * 4 + parameters)
+        bins = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+    return bins, int(bins[:, 2].sum())
 
 
-def generateHeatMap(data, year):
+def saveHeatMap(bins, total, year):
     """
-    Function to visualize the data as a heatmap using the folium library.
+    Render weighted heatmap cells with folium and save the map.
 
-    :param data: cleaned nyc crash data
+    :param bins: array of [latitude, longitude, crash count] rows
+    :param total: total number of crashes, used for the color scale
     :param year: year value (2019/2020)
     :return: None
     """
-    # Convert latitude and longitude columns to float
-    data['latitude'] = data['latitude'].astype(float)
-    data['longitude'] = data['longitude'].astype(float)
-
-    # Extract necessary columns
-    data = data[['latitude', 'longitude']].dropna().values.tolist()
-
-    # Create a base map centered at an average location
-    m = folium.Map(location=[sum(p[0] for p in data) / len(data),
-                             sum(p[1] for p in data) / len(data)],
+    # Create a base map centered at the crash-weighted average location
+    m = folium.Map(location=[float(np.average(bins[:, 0], weights=bins[:, 2])),
+                             float(np.average(bins[:, 1], weights=bins[:, 2]))],
                    zoom_start=12)
 
-    # Convert the data into a format that HeatMap can understand
-    heat_data = [[point[0], point[1]] for point in data]
+    # Weights are scaled to (0, 1] with the busiest cell at 1
+    heat_data = np.column_stack([bins[:, :2], bins[:, 2] / bins[:, 2].max()])
 
     # Create a color scale legend
-    color_scale = linear.RdYlBu_03.scale(0, len(heat_data))
+    color_scale = linear.RdYlBu_03.scale(0, total)
     m.add_child(color_scale)
 
     # Create HeatMap layer
-    HeatMap(heat_data, gradient={0.4: 'blue', 0.65: 'lime', 1: 'red'},
+    HeatMap(heat_data.round(6).tolist(),
+            gradient={0.4: 'blue', 0.65: 'lime', 1: 'red'},
             opacity=0.4).add_to(
         m)
 
@@ -106,37 +211,126 @@ def generateHeatMap(data, year):
     print(f"{filename} generated and saved successfully")
 
 
-def clusterData(data, year):
+@instrumented
+def drawHeatMap(bins, total, year):
+    """
+    Draw the heatmap of binned crashes, skipped when there are none.
+
+    :param bins: array of [latitude, longitude, crash count] rows
+    :param total: total number of crashes
+    :param year: year value (2019/2020)
+    :return: None
+    """
+    if total == 0:
+        print(f"No crashes to draw for {year}, heatmap not generated")
+        return False
+    saveHeatMap(bins, total, year)
+
+
+@instrumented
+def generateHeatMap(data, year, cell_size=HEATMAP_CELL_SIZE):
     """
-    Using folium to perform clustering on terrain map of Brooklyn.
+    Function to visualize the data as a heatmap using the folium library.
+    Points are binned to a grid first, pass cell_size=None to embed every
+    crash as its own point.
 
     :param data: cleaned nyc crash data
     :param year: year value (2019/2020)
+    :param cell_size: grid cell size in degrees, None for raw points
     :return: None
     """
-    # Convert latitude and longitude columns to float
-    data['latitude'] = data['latitude'].astype(float)
-    data['longitude'] = data['longitude'].astype(float)
+    if cell_size is None:
+        points = data[['latitude', 'longitude']].dropna().to_numpy(np.float64)
+        bins, total = np.column_stack([points, np.ones(len(points))]), len(points)
+    else:
+        bins, total = binPoints(data['latitude'].to_numpy(),
+                                data['longitude'].to_numpy(), cell_size)
+    return drawHeatMap(bins, total, year)
 
-    # Extract necessary columns
-    data = data[['latitude', 'longitude']].dropna().values.tolist()
 
-    # Create a base map centered at an average location
-    m = folium.Map(location=[sum(p[0] for p in data) / len(data),
-                             sum(p[1] for p in data) / len(data)],
-                   zoom_start=12)
+@instrumented
+def generateHeatMapSQL(connection, year, cell_size=HEATMAP_CELL_SIZE,
+                       borough=config_template.BOROUGH):
+    """
+    Heatmap of one year binned in postgres, without pulling the points.
+
+    :param connection: database connection object
+    :param year: year to draw
+    :param cell_size: grid cell size in degrees
+    :param borough: borough to analyse, all boroughs if None
+    :return: None
+    """
+    bins, total = binPointsSQL(connection, cell_size, borough,
+                               f"{year}-01-01", f"{year}-12-31")
+    return drawHeatMap(bins, total, year)
 
-    # Convert the data into a format that MarkerCluster can understand
-    marker_data = [[point[0], point[1]] for point in data]
 
-    # Create a MarkerCluster layer
-    marker_cluster = MarkerCluster().add_to(m)
+def locationCounts(latitude, longitude, precision=CLUSTER_PRECISION):
+    """
+    Collapse crashes at the same location into one row with a crash count.
+
+    :param latitude: array of latitudes
+    :param longitude: array of longitudes
+    :param precision: number of decimals two locations must share
+    :return: array of [latitude, longitude, crash count] rows
+    """
+    points = np.column_stack([np.asarray(latitude, dtype=np.float64),
+                              np.asarray(longitude, dtype=np.float64)])
+    points = points[~np.isnan(points).any(axis=1)].round(precision)
+    locations, counts = np.unique(points, axis=0, return_counts=True)
+    return np.column_stack([locations, counts])
 
-    # Add markers to the MarkerCluster
-    for point in marker_data:
-        folium.Marker(location=[point[0], point[1]],
-                      popup=f"Location: {point[0]}, {point[1]}").add_to(
-            marker_cluster)
+
+@instrumented
+def clusterData(data, year, max_locations=CLUSTER_MAX_LOCATIONS, seed=42):
+    """
+    Using folium to perform clustering on terrain map of Brooklyn. Crashes at
+    the same location are collapsed into one marker and markers are built in
+    the browser by a FastMarkerCluster javascript callback, so the html only
+    holds a compact array of [lat, lon, crashes] rows. Cluster icons show the
+    number of crashes they hold at every zoom level.
+
+    :param data: cleaned nyc crash data
+    :param year: year value (2019/2020)
+    :param max_locations: cap on the number of distinct locations drawn, a
+    random sample is drawn above it, None for no cap
+    :param seed: random seed of the sample
+    :return: None
+    """
+    return drawClusterMap(locationCounts(data['latitude'].to_numpy(),
+                                         data['longitude'].to_numpy()),
+                          year, max_locations, seed)
+
+
+@instrumented
+def drawClusterMap(locations, year, max_locations=CLUSTER_MAX_LOCATIONS, seed=42):
+    """
+    Draw the cluster map of crash locations collapsed by locationCounts.
+
+    :param locations: array of [latitude, longitude, crash count] rows
+    :param year: year value (2019/2020)
+    :param max_locations: cap on the number of distinct locations drawn, a
+    random sample is drawn above it, None for no cap
+    :param seed: random seed of the sample
+    :return: None
+    """
+    if len(locations) == 0:
+        print(f"No crashes to draw for {year}, cluster map not generated")
+        return False
+    if max_locations is not None and len(locations) > max_locations:
+        sample = np.random.default_rng(seed).choice(len(locations),
+                                                    max_locations, replace=False)
+        locations = locations[sample]
+
+    # Create a base map centered at the crash-weighted average location
+    m = folium.Map(location=[float(np.average(locations[:, 0], weights=locations[:, 2])),
+                             float(np.average(locations[:, 1], weights=locations[:, 2]))],
+                   zoom_start=12)
+
+    # Create the clustered layer, markers are created client side
+    FastMarkerCluster(locations.tolist(), callback=CLUSTER_MARKER_CALLBACK,
+                      icon_create_function=CLUSTER_ICON_FUNCTION,
+                      options={'disableClusteringAtZoom': 18}).add_to(m)
 
     # Save the map
     filename = f"clustered_map_{year}.html"
@@ -144,52 +338,207 @@ def clusterData(data, year):
     print(f"{filename} generated and saved successfully")
 
 
-def kMeansClustering(data, year):
+def fitCentroids(points, k, method='minibatch', sample_size=None, seed=42):
+    """
+    Fit k-means centroids on crash coordinates. MiniBatchKMeans and fitting on
+    a random sample keep the fit time flat as the number of crashes grows.
+
+    :param points: array of [latitude, longitude] rows
+    :param k: number of clusters
+    :param method: 'minibatch' for MiniBatchKMeans, 'full' for KMeans
+    :param sample_size: fit on a random sample of this many points, None to
+    fit on every point
+    :param seed: random seed
+    :return: (fitted model, array of k centroids) tuple
     """
-    Function to perform k-means clustering on the data.
+    if sample_size is not None and len(points) > sample_size:
+        sample = np.random.default_rng(seed).choice(len(points), sample_size,
+                                                    replace=False)
+        points = points[sample]
+    if method == 'minibatch':
+        kmeans = MiniBatchKMeans(n_clusters=k, random_state=seed,
+                                 batch_size=4096, n_init=3)
+    else:
+        kmeans = KMeans(n_clusters=k, random_state=seed)
+    kmeans.fit(points)
+    return kmeans, kmeans.cluster_centers_
 
-    :param data: cleaned nyc crash data
-    :param year: year value (2019/2020)
-    :return: None
+
+def predictClusters(points, centroids, batch_size=KMEANS_BATCH_SIZE):
     """
-    # Convert latitude and longitude columns to float with high precision
-    data['latitude'] = data['latitude'].astype(float)
-    data['longitude'] = data['longitude'].astype(float)
+    Assign every point to its nearest centroid in fixed-size batches, so the
+    distance matrix never holds more than one batch.
 
-    # Extract necessary columns
-    data_1 = data[['latitude', 'longitude']]
+    :param points: array of [latitude, longitude] rows
+    :param centroids: array of centroids
+    :param batch_size: number of points per batch
+    :return: array of cluster labels
+    """
+    labels = np.empty(len(points), dtype=np.int32)
+    for start in range(0, len(points), batch_size):
+        batch = points[start:start + batch_size]
+        distances = ((batch[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+        labels[start:start + batch_size] = distances.argmin(axis=1)
+    return labels
 
-    # Specify the number of clusters (adjust as needed)
-    k = 4
 
-    # Perform K-Means clustering
-    kmeans = KMeans(n_clusters=k, random_state=42)
-    data['cluster'] = kmeans.fit_predict(data_1)
+def centroidCachePath(points, borough, year, k, method, sample_size,
+                      cache_dir=MODEL_CACHE_DIR):
+    """
+    Helper function to build the path of cached centroids. The name is keyed
+    on a hash of the points the model is fitted on, so a different date
+    range or a re-cleaned table never reuses centroids of other data, and on
+    every fitting parameter.
+
+    :param points: array of [latitude, longitude] rows the model is fitted on
+    :param borough: borough the model was fitted on
+    :param year: year the model was fitted on
+    :param k: number of clusters
+    :param method: fitting method
+    :param sample_size: size of the sample the model is fitted on, None for all
+    :param cache_dir: directory holding cached models
+    :return: path of the .npz file
+    """
+    name = str(borough).lower().replace(' ', '_')
+    digest = hashlib.sha1(np.ascontiguousarray(points).tobytes()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"kmeans_{name}_{year}_{k}_{method}_"
+                                   f"{sample_size or 'all'}_{digest}.npz")
+
+
+@instrumented
+def kMeansClustering(data, year, k=4, method='minibatch', sample_size=None,
+                     borough=config_template.BOROUGH, render='hexbin',
+                     cache_dir=MODEL_CACHE_DIR):
+    """
+    Function to perform k-means clustering on the data. Fitted centroids are
+    cached on disk per (borough, year, k, method, sample size) and reused
+    while the points are unchanged, labels are predicted in batches. The
+    defaults fit MiniBatchKMeans and draw a hexbin density plot. The original
+    KMeans fit and per-point scatter are method='full' and render='scatter'.
+
+    :param data: cleaned nyc crash data
+    :param year: year value (2019/2020)
+    :param k: number of clusters
+    :param method: 'minibatch' for MiniBatchKMeans, 'full' for KMeans
+    :param sample_size: fit on a random sample of this many points
+    :param borough: borough the data belongs to, part of the cache key
+    :param render: 'hexbin' draws crash density with the centroids on top,
+    'scatter' draws every point colored by cluster
+    :param cache_dir: directory holding cached models, None to disable
+    :return: array of cluster labels
+    """
+    points = data[['latitude', 'longitude']].dropna().to_numpy(np.float64)
+
+    path = centroidCachePath(points, borough, year, k, method, sample_size,
+                             cache_dir) if cache_dir else None
+    if path and os.path.exists(path):
+        centroids = np.load(path)['centroids']
+    else:
+        _, centroids = fitCentroids(points, k, method, sample_size)
+        if path:
+            # Centroids of older data for the same model are never read again
+            for stale in glob.glob(path.rsplit('_', 1)[0] + "_*.npz"):
+                os.remove(stale)
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(path, centroids=centroids)
+    labels = predictClusters(points, centroids)
 
     # Visualize the clusters
     plt.figure(figsize=(12, 8))
-    plt.scatter(data['longitude'], data['latitude'], c=data['cluster'],
-                cmap='viridis', s=50, edgecolors='black')
+    if render == 'hexbin':
+        plt.hexbin(points[:, 1], points[:, 0], gridsize=150, bins='log',
+                   cmap='viridis', mincnt=1)
+        plt.colorbar(label='Crashes (log scale)')
+        plt.scatter(centroids[:, 1], centroids[:, 0], c=np.arange(k),
+                    cmap='tab10', s=250, marker='X', edgecolors='white')
+    else:
+        plt.scatter(points[:, 1], points[:, 0], c=labels, cmap='viridis', s=2,
+                    rasterized=True)
     plt.title(f'K-Means Clustering of Car Crashes (k={k}) for year {year}')
     plt.xlabel('Longitude')
     plt.ylabel('Latitude')
-    plt.show()
+    showFigure(f'kmeans_{year}_k{k}')
+    return labels
 
-def categorize_vehicle(vehicle_type_code):
-    if vehicle_type_code.lower() in ['bike', 'motorcycle']:
-        return 'bike'
-    else:
-        return vehicle_type_code.lower()
 
-def accidentsByVehicleType(data_2019):
-    # Flatten the DataFrame into a single column
-    flattened_df = data_2019[['vehicle_type_code_1', 'vehicle_type_code_2', 'vehicle_type_code_3', 'vehicle_type_code_4',]].stack().reset_index(name='vehicle_type_code')
+def evaluateK(points, k, silhouette_size, seed=42):
+    """
+    Fit one k of a k-sweep, runs in a worker process.
+
+    :param points: array of [latitude, longitude] rows to fit on
+    :param k: number of clusters
+    :param silhouette_size: number of points the silhouette score is computed on
+    :param seed: random seed
+    :return: (k, inertia, silhouette score) tuple
+    """
+    kmeans, _ = fitCentroids(points, k, 'minibatch', seed=seed)
+    score = silhouette_score(points, kmeans.labels_,
+                             sample_size=min(silhouette_size, len(points)),
+                             random_state=seed)
+    return k, kmeans.inertia_, score
+
+
+@instrumented
+def kSweep(data, k_values=range(2, 11), sample_size=100000,
+           silhouette_size=10000, workers=None, seed=42):
+    """
+    Evaluate a range of k in parallel worker processes on a sample of the
+    crashes and report inertia and silhouette score for each.
+
+    :param data: cleaned nyc crash data
+    :param k_values: values of k to evaluate
+    :param sample_size: number of points every k is fitted on
+    :param silhouette_size: number of points the silhouette score is computed on
+    :param workers: number of worker processes, defaults to the cpu count
+    :param seed: random seed
+    :return: list of (k, inertia, silhouette score) tuples ordered by k
+    """
+    points = data[['latitude', 'longitude']].dropna().to_numpy(np.float64)
+    if len(points) > sample_size:
+        points = points[np.random.default_rng(seed).choice(
+            len(points), sample_size, replace=False)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(evaluateK, [points] * len(k_values),
+                                    k_values, [silhouette_size] * len(k_values)))
+    print(f"{'k':>3} {'inertia':>14} {'silhouette':>11}")
+    for k, inertia, score in results:
+        print(f"{k:>3} {inertia:>14.6f} {score:>11.4f}")
+    return results
+
 
-    # Categorize vehicles and filter out non-bike vehicles
-    flattened_df['vehicle'] = flattened_df['vehicle_type_code'].apply(categorize_vehicle)
+def categorize_vehicle(vehicle_type_codes, aliases=VEHICLE_ALIASES):
+    """
+    Normalise vehicle type codes to lower case and apply the alias table.
+    The work is done once per distinct code on the categories of a
+    categorical column rather than once per row.
 
-    # Group by vehicle type and count accidents
-    accident_counts = flattened_df.groupby('vehicle')['vehicle'].count()
+    :param vehicle_type_codes: series of vehicle type codes
+    :param aliases: mapping of lower case code to the vehicle it counts as
+    :return: categorical series of normalised vehicle types
+    """
+    codes = vehicle_type_codes.astype('category')
+    normalised = codes.cat.categories.astype(str).str.lower().map(
+        lambda code: aliases.get(code, code))
+    vehicles = pd.Index(normalised.unique())
+    # Re-point every old category code at its normalised category. The
+    # trailing -1 is what the -1 code of missing values indexes, which also
+    # covers a column without any category
+    new_codes = np.append(vehicles.get_indexer(normalised), -1)
+    old_codes = codes.cat.codes.to_numpy()
+    return pd.Series(pd.Categorical.from_codes(new_codes[old_codes], vehicles),
+                     index=vehicle_type_codes.index)
+
+
+def accidentsByVehicleType(data_2019, aliases=VEHICLE_ALIASES):
+    vehicle_columns = ['vehicle_type_code_1', 'vehicle_type_code_2',
+                       'vehicle_type_code_3', 'vehicle_type_code_4']
+
+    # Count normalised vehicle types per column and add the counts up,
+    # empty codes are not counted
+    accident_counts = pd.concat(
+        [categorize_vehicle(data_2019[column], aliases).value_counts()
+         for column in vehicle_columns], axis=1).sum(axis=1)
 
     # Sort by accident count in descending order and limit to top 10
     accident_counts = accident_counts.sort_values(ascending=False).head(10)
@@ -197,6 +546,7 @@ def accidentsByVehicleType(data_2019):
     # returning the results
     return accident_counts
 
+
 def accidentsByVehicleTypeBarChart(accidents_count_2019, accidents_count_2020):
     fig, axs = plt.subplots(1, 2, figsize=(12, 6))
     axs[0].bar(accidents_count_2019.index, accidents_count_2019.values)
@@ -214,23 +564,68 @@ def accidentsByVehicleTypeBarChart(accidents_count_2019, accidents_count_2020):
 
     # Adjust layout and show plot
     plt.tight_layout()
-    plt.show()
+    showFigure('accidents_by_vehicle_type')
+
+@instrumented
+def vehicleTypeCharts(data_2019, data_2020):
+    """
+    Count accidents by vehicle type for both years and chart them side by side.
+
+    :param data_2019: cleaned nyc crash data of 2019
+    :param data_2020: cleaned nyc crash data of 2020
+    :return: None
+    """
+    accidentsByVehicleTypeBarChart(accidentsByVehicleType(data_2019),
+                                   accidentsByVehicleType(data_2020))
+
 
-def main():
-    dataframe = connectDB()
+def main(borough=config_template.BOROUGH, start_date=config_template.START_DATE,
+         end_date=config_template.END_DATE, dataframe=None, k_values=None):
+    # Load the data unless the caller already loaded it (see bdAnalytics.py)
+    if dataframe is None:
+        dataframe = connectDB(borough, start_date, end_date)
 
     # Sort data into 2019 data and 2020 data
     crash_data_2019, crash_data_2020 = separateData(dataframe)
 
-    # Data visualization and clustering
-    generateHeatMap(crash_data_2019, '2019')
-    generateHeatMap(crash_data_2020, '2020')
-    clusterData(crash_data_2020, '2019')
-    clusterData(crash_data_2019, '2020')
-    kMeansClustering(crash_data_2019, '2019')
-    kMeansClustering(crash_data_2020, '2020')
-    accidentsByVehicleTypeBarChart(accidentsByVehicleType(crash_data_2019), accidentsByVehicleType(crash_data_2020))
+    # Only evaluate the candidate k for each year when a k-sweep is asked for
+    if k_values is not None:
+        for year, crash_data in (('2019', crash_data_2019), ('2020', crash_data_2020)):
+            print(f"== k-sweep for {year} ==")
+            kSweep(crash_data, k_values, workers=config_template.WORKERS)
+        return
+
+    # The cheap vectorized aggregation happens here, the stages get the
+    # small aggregates (and the coordinates k-means is fitted on) rather than
+    # the year frames, which keeps what is pickled to the workers small
+    stages = []
+    for year, crash_data in (('2019', crash_data_2019), ('2020', crash_data_2020)):
+        latitude = crash_data['latitude'].to_numpy()
+        longitude = crash_data['longitude'].to_numpy()
+        stages += [
+            stage(f'heatmap_{year}', drawHeatMap,
+                  *binPoints(latitude, longitude), year),
+            stage(f'cluster_map_{year}', drawClusterMap,
+                  locationCounts(latitude, longitude), year),
+            stage(f'kmeans_{year}', kMeansClustering,
+                  crash_data[['latitude', 'longitude']], year, borough=borough),
+        ]
+    stages.append(stage('vehicle_types', accidentsByVehicleTypeBarChart,
+                        accidentsByVehicleType(crash_data_2019),
+                        accidentsByVehicleType(crash_data_2020)))
+
+    # Data visualization and clustering run concurrently, in worker processes
+    # when headless
+    runStages(stages, workers=config_template.WORKERS)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Heatmaps, cluster maps, k-means and vehicle type charts")
+    parser.add_argument('--k-sweep', type=int, nargs='+', default=None,
+                        metavar='K',
+                        help="evaluate these k (inertia and silhouette) instead "
+                             "of drawing the charts, e.g. --k-sweep 2 3 4 5 6")
+    args = parser.parse_args()
+    with runReport('visualiseData'):
+        main(k_values=args.k_sweep)
@@ -0,0 +1,84 @@
+"""
+Filename : windowAnalysis.py
+Author : Archit Joshi, Parth Sethia
+Description : Windowed aggregation over daily NYC crash counts. Finds the top-K
+non-overlapping windows of consecutive calendar days with the most accidents
+using prefix sums.
+Language : python3
+"""
+import numpy as np
+
+
+def denseDailySeries(rows, start_date, end_date):
+    """
+    Build a calendar-filled daily series from (date, count) rows. Days without
+    any crash are filled with zero so that consecutive positions in the series
+    are always consecutive calendar days.
+
+    :param rows: iterable of (date, count) tuples
+    :param start_date: first day of the series
+    :param end_date: last day of the series
+    :return: (numpy array of days, numpy array of counts) tuple
+    """
+    days = np.arange(np.datetime64(start_date, 'D'),
+                     np.datetime64(end_date, 'D') + 1)
+    counts = np.zeros(len(days), dtype=np.int64)
+    for day, count in rows:
+        position = (np.datetime64(day, 'D') - days[0]).astype(int)
+        if 0 <= position < len(days):
+            counts[position] += count
+    return days, counts
+
+
+def rollingSums(counts, window):
+    """
+    Sum of every run of `window` consecutive values in O(n) using a prefix sum.
+
+    :param counts: numpy array of daily counts
+    :param window: window length in days
+    :return: numpy array where element i is the sum of counts[i:i + window]
+    """
+    prefix = np.concatenate(([0], np.cumsum(counts)))
+    return prefix[window:] - prefix[:-window]
+
+
+def pickNonOverlapping(candidates, window, k):
+    """
+    Greedily pick the k best windows that don't overlap each other.
+
+    :param candidates: iterable of (start position, total) ordered by total
+    descending
+    :param window: window length in days
+    :param k: number of windows to pick
+    :return: list of (start position, total) tuples
+    """
+    chosen = []
+    for start, total in candidates:
+        if all(abs(start - other) >= window for other, _ in chosen):
+            chosen.append((start, total))
+            if len(chosen) == k:
+                break
+    return chosen
+
+
+def topWindows(days, counts, window, k=1):
+    """
+    Find the top-K non-overlapping windows of consecutive days with the most
+    accidents.
+
+    :param days: numpy array of days from denseDailySeries
+    :param counts: numpy array of counts from denseDailySeries
+    :param window: window length in days
+    :param k: number of windows to return
+    :return: list of (first day, last day, total accidents) tuples
+    """
+    if window > len(counts):
+        return []
+    sums = rollingSums(counts, window)
+    # Stable sort so that ties resolve to the earliest window
+    order = np.argsort(-sums, kind='stable')
+    chosen = pickNonOverlapping(((int(start), int(sums[start]))
+                                 for start in order), window, k)
+    return [(days[start].item(), days[start + window - 1].item(), total)
+            for start, total in chosen]
+